@@ -1,12 +1,22 @@
+import asyncio
+import signal
 import socket
 import sys
 import time
+from queue import Queue
 from threading import Thread
 
+import aiohttp
 import requests
 
 from cbagent.metadata_client import MetadataClient
-from cbagent.stores import PerfStore
+from cbagent.sketches import SketchStore
+from cbagent.stores import (
+    BufferedPerfStore,
+    ChangeFilter,
+    PerfStore,
+    SeriesCache,
+)
 from logger import logger
 
 
@@ -14,8 +24,19 @@ class Collector:
 
     COLLECTOR = None
 
+    MAX_CONCURRENCY = 16  # Concurrent requests in the async mode
+
+    REQUEST_TIMEOUT = 2  # Seconds
+
+    MIN_INTERVAL = 1  # Seconds, the adaptive sampling interval after a change
+
+    MAX_INTERVAL = 60  # Seconds, the longest gap between two stored values
+
+    METRIC_INTERVALS = {}  # Per-metric (min, max) intervals of adaptive sampling
+
     def __init__(self, settings):
         self.session = requests.Session()
+        self.responses = None  # ResponseCache, shared by the collectors of CbAgent
         self.cloud = settings.cloud
         self.cloud_enabled = self.cloud['enabled']
         if self.cloud_enabled:
@@ -33,13 +54,57 @@ class Collector:
         self.ssh_username = getattr(settings, 'ssh_username', None)
         self.ssh_password = getattr(settings, 'ssh_password', None)
 
-        self.store = PerfStore(settings.cbmonitor_host)
+        cache = SeriesCache() if getattr(settings, 'local_cache', False) else None
+        changes = None
+        if getattr(settings, 'adaptive_sampling', False):
+            changes = ChangeFilter(min(self.MIN_INTERVAL, self.interval),
+                                   max(self.MAX_INTERVAL, self.interval))
+            changes.set_intervals(self.COLLECTOR, self.METRIC_INTERVALS)
+        if getattr(settings, 'buffered_store', False):
+            self.store = BufferedPerfStore(settings.cbmonitor_host, cache, changes)
+        else:
+            self.store = PerfStore(settings.cbmonitor_host, cache, changes)
+        self.current_interval = self.interval
         self.mc = MetadataClient(settings)
 
+        self.sketches = None
+        if getattr(settings, 'sketches', False):
+            self.sketches = SketchStore()
+
         self.metrics = set()
+        self.metadata_queue = Queue()
         self.updater = None
 
+        self.async_sampling = getattr(settings, 'async_sampling', False) and \
+            not self.cloud_enabled
+        self.async_session = None
+        self.semaphore = None
+        self.pending_sample = None
+
     def get_http(self, path, server=None, port=8091, json=True):
+        if self.responses is not None and json and self.responses.match(path):
+            key = server or self.master_node, port, path
+            response = self.responses.get(
+                key, path, lambda headers: self._request(path, server, port, headers))
+            if response is not None:
+                return response
+        return self._get_http(path, server, port, json)
+
+    def _request(self, path, server, port, headers):
+        server = server or self.master_node
+        try:
+            if self.cloud_enabled:
+                server, port = self.session.translate_host_and_port(server, port)
+                url = "http://{}:{}{}".format(server, port, path)
+                r = self.session.get(url=url, headers=headers)
+            else:
+                url = "http://{}:{}{}".format(server, port, path)
+                r = self.session.get(url=url, auth=self.auth, headers=headers)
+        except requests.ConnectionError:
+            return None, None, None  # _get_http reports and handles the error
+        return r.status_code, r.headers.get('ETag'), r.text
+
+    def _get_http(self, path, server=None, port=8091, json=True):
         server = server or self.master_node
         try:
             if self.cloud_enabled:
@@ -58,6 +123,40 @@ class Collector:
             logger.warn("Connection error: {}".format(url))
             return self.refresh_nodes_and_retry(path, server, port, json)
 
+    async def get_http_async(self, path, server=None, port=8091, json=True):
+        if self.responses is not None and json and self.responses.match(path):
+            key = server or self.master_node, port, path
+            response = await self.responses.get_async(
+                key, path, lambda headers: self._request_async(path, server, port, headers))
+            if response is not None:
+                return response
+        return await self._get_http_async(path, server, port, json)
+
+    async def _request_async(self, path, server, port, headers):
+        url = "http://{}:{}{}".format(server or self.master_node, port, path)
+        try:
+            async with self.semaphore:
+                async with self.async_session.get(
+                        url=url, headers=headers, timeout=self.REQUEST_TIMEOUT) as r:
+                    return r.status, r.headers.get('ETag'), await r.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None, None, None
+
+    async def _get_http_async(self, path, server=None, port=8091, json=True):
+        server = server or self.master_node
+        url = "http://{}:{}{}".format(server, port, path)
+        try:
+            async with self.semaphore:
+                async with self.async_session.get(
+                        url=url, timeout=self.REQUEST_TIMEOUT) as r:
+                    if r.status in (200, 201, 202):
+                        if json:
+                            return await r.json(content_type=None)
+                        return await r.text()
+                    logger.warn("Bad response: {}".format(url))
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            logger.warn("Connection error: {}".format(url))
+
     def refresh_nodes_and_retry(self, path, server=None, port=8091, json=True):
         time.sleep(self.interval)
 
@@ -97,6 +196,14 @@ class Collector:
             else:
                 yield bucket["name"]
 
+    async def get_buckets_async(self, with_stats=False):
+        buckets = await self.get_http_async(path="/pools/default/buckets")
+        return [
+            (bucket["name"], bucket["stats"]) if with_stats else bucket["name"]
+            for bucket in buckets or ()
+            if self.buckets is None or bucket["name"] in self.buckets
+        ]
+
     def get_nodes(self):
         pool = self.get_http(path="/pools/default")
         for node in pool["nodes"]:
@@ -116,35 +223,135 @@ class Collector:
             for index in self.indexes:
                 yield index, self.buckets[0], None, None
 
-    def _update_metric_metadata(self, metrics, bucket=None, index=None, server=None):
+    def _update_metric_metadata(self):
+        while True:
+            metrics, bucket, index, server = self.metadata_queue.get()
+            try:
+                self.mc.add_metrics(metrics, bucket, index, server, self.COLLECTOR)
+            except Exception as e:
+                logger.error('Failed to register the metrics of {}: {}'
+                             .format(self.__class__.__name__, e))
+                for metric in metrics:  # Queued again by the next sample
+                    self.metrics.discard(hash((metric, bucket, index, server)))
+            finally:
+                self.metadata_queue.task_done()
+
+    def update_metric_metadata(self, metrics, bucket=None, index=None, server=None):
+        """Register the new metrics in the background."""
+        new_metrics = []
         for metric in metrics:
             metric = metric.replace('/', '_')
             metric_hash = hash((metric, bucket, index, server))
             if metric_hash not in self.metrics:
                 self.metrics.add(metric_hash)
-                self.mc.add_metric(metric, bucket, index, server, self.COLLECTOR)
+                new_metrics.append(metric)
+        if not new_metrics:
+            return
 
-    def update_metric_metadata(self, *args, **kwargs):
+        self.metadata_queue.put((new_metrics, bucket, index, server))
         if self.updater is None or not self.updater.is_alive():
-            self.updater = Thread(
-                target=self._update_metric_metadata, args=args, kwargs=kwargs
-            )
-            self.updater.daemon = True
+            self.updater = Thread(target=self._update_metric_metadata, daemon=True)
             self.updater.start()
-            self.updater.join()
+
+    def update_sketches(self, stats, server=None, bucket=None, index=None):
+        if self.sketches is not None:
+            db = self.store.build_dbname(self.cluster, server, bucket, index,
+                                         self.COLLECTOR)
+            self.sketches.update(db, stats)
+
+    def sampling_interval(self) -> float:
+        """Return the time until the next sample.
+
+        With adaptive sampling, the interval drops when the values move and
+        then doubles at every sample until it is back to the base interval.
+        """
+        changes = self.store.changes
+        if changes is None:
+            return self.interval
+        interval = changes.pop_interval(self.cluster, self.COLLECTOR)
+        if interval is not None:
+            self.current_interval = interval
+        else:
+            self.current_interval = min(2 * self.current_interval, self.interval)
+        return self.current_interval
 
     def sample(self):
         raise NotImplementedError
 
+    async def sample_async(self):
+        """Collect one sample without blocking other collectors.
+
+        Collectors that issue many requests per sample should override this
+        method and fan them out with get_http_async. By default the blocking
+        sample() runs in a worker thread. A timeout cannot stop that thread, so
+        the ticks are skipped until the overrunning sample completes.
+        """
+        if self.pending_sample is not None and not self.pending_sample.done():
+            logger.warn('Skipping a sample in {}, the previous one is still running'
+                        .format(self.__class__.__name__))
+            return
+        self.pending_sample = asyncio.get_event_loop().run_in_executor(None, self.sample)
+        await asyncio.shield(self.pending_sample)
+
+    async def collect_async(self):
+        self.semaphore = asyncio.Semaphore(self.MAX_CONCURRENCY)
+        auth = aiohttp.BasicAuth(*self.auth)
+        async with aiohttp.ClientSession(auth=auth) as self.async_session, \
+                aiohttp.ClientSession() as self.store.async_session:
+            t0 = time.time()
+            while True:
+                try:
+                    await asyncio.wait_for(self.sample_async(),
+                                           timeout=self.interval)
+                except asyncio.TimeoutError:
+                    logger.warn("Sampling took longer than {}s in {}"
+                                .format(self.interval, self.__class__.__name__))
+                except IndexError:
+                    pass
+                except Exception as e:
+                    logger.warn("Unexpected exception in {}: {}"
+                                .format(self.__class__.__name__, e))
+                # Keep a fixed sampling period, skipping the missed ones
+                t0 = max(t0 + self.sampling_interval(), time.time())
+                await asyncio.sleep(t0 - time.time())
+
+    def terminate(self, *args):
+        self.store.flush()
+        if self.sketches is not None:
+            self.sketches.dump()
+        if self.responses is not None:
+            logger.info('{}: {}'.format(self.__class__.__name__,
+                                        self.responses.summary()))
+        if self.store.changes is not None:
+            logger.info('{}: {}'.format(self.__class__.__name__,
+                                        self.store.changes.summary()))
+        sys.exit()
+
+    def handle_sigterm(self):
+        """Flush the buffered state when the collector process is terminated."""
+        if isinstance(self.store, BufferedPerfStore) or \
+                self.store.changes is not None or \
+                self.sketches is not None or self.responses is not None:
+            signal.signal(signal.SIGTERM, self.terminate)
+
     def collect(self):
+        self.handle_sigterm()
+        if self.async_sampling:
+            try:
+                asyncio.get_event_loop().run_until_complete(self.collect_async())
+            except KeyboardInterrupt:
+                sys.exit()
+            return
+
         while True:
             try:
                 t0 = time.time()
                 self.sample()
                 delta = time.time() - t0
-                if delta >= self.interval:
+                interval = self.sampling_interval()
+                if delta >= interval:
                     continue
-                time.sleep(self.interval - delta)
+                time.sleep(interval - delta)
             except KeyboardInterrupt:
                 sys.exit()
             except IndexError:
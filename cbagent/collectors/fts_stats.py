@@ -1,3 +1,5 @@
+import asyncio
+
 from cbagent.collectors.collector import Collector
 from perfrunner.helpers import rest
 
@@ -59,6 +61,13 @@ class FTSCollector(Collector):
         for host in self.fts_nodes:
             self.cbft_stats[host] = self.rest.get_fts_stats(host)
 
+    async def collect_stats_async(self):
+        stats = await asyncio.gather(*(
+            self.get_http_async(path='/api/nsstats', server=host, port=8094)
+            for host in self.fts_nodes
+        ))
+        self.cbft_stats = dict(zip(self.fts_nodes, stats))
+
     def get_fts_stats_by_name(self, host, bucket, index, name):
         if name in self.cbft_stats[host]:
             return self.cbft_stats[host][name]
@@ -81,9 +90,8 @@ class FTSCollector(Collector):
 
     def update_metadata(self):
         self.mc.add_cluster()
-        for metric in self.METRICS:
-            for host in self.fts_nodes:
-                self.mc.add_metric(metric, server=host, collector=self.COLLECTOR)
+        for host in self.fts_nodes:
+            self.mc.add_metrics(self.METRICS, server=host, collector=self.COLLECTOR)
 
     def sample(self):
         self.collect_stats()
@@ -96,6 +104,18 @@ class FTSCollector(Collector):
                                   server=host,
                                   collector=self.COLLECTOR)
 
+    async def sample_async(self):
+        await self.collect_stats_async()
+        if None in self.cbft_stats.values():
+            return
+        self.update_metric_metadata(self.METRICS)
+        samples = self.measure()
+        await asyncio.gather(*(
+            self.store.append_async(samples[host], cluster=self.cluster,
+                                    server=host, collector=self.COLLECTOR)
+            for host in self.fts_nodes if host in samples
+        ))
+
 
 class ElasticStats(FTSCollector):
 
@@ -112,6 +132,10 @@ class ElasticStats(FTSCollector):
     def collect_stats(self):
         self.cbft_stats = self.rest.get_elastic_stats(self.host)
 
+    async def collect_stats_async(self):
+        self.cbft_stats = await self.get_http_async(path='/_stats',
+                                                    server=self.host, port=9200)
+
     def elastic_query_total(self):
         return self.cbft_stats["_all"]["total"]["search"]["query_total"]
 
@@ -137,8 +161,7 @@ class ElasticStats(FTSCollector):
 
     def update_metadata(self):
         self.mc.add_cluster()
-        for metric in self.METRICS:
-            self.mc.add_metric(metric, collector=self.COLLECTOR)
+        self.mc.add_metrics(self.METRICS, collector=self.COLLECTOR)
 
     def sample(self):
         self.collect_stats()
@@ -148,3 +171,12 @@ class ElasticStats(FTSCollector):
             if samples:
                 self.store.append(samples, cluster=self.cluster,
                                   collector=self.COLLECTOR)
+
+    async def sample_async(self):
+        await self.collect_stats_async()
+        if self.cbft_stats:
+            self.update_metric_metadata(self.METRICS)
+            samples = self.measure()
+            if samples:
+                await self.store.append_async(samples, cluster=self.cluster,
+                                              collector=self.COLLECTOR)
@@ -18,9 +18,8 @@ class JTSCollector(Collector):
         self.mc.add_cluster()
         for bucket in self.get_buckets():
             self.mc.add_bucket(bucket)
-            for metric in self.METRICS:
-                self.mc.add_metric(metric, bucket=bucket,
-                                   collector=self.COLLECTOR)
+            self.mc.add_metrics(self.METRICS, bucket=bucket,
+                                collector=self.COLLECTOR)
 
     def _consolidate_results(self, filename_pattern: str, storage_name: str):
         all_results = dict()
@@ -1,11 +1,13 @@
 import asyncio
-import csv
 import glob
-from typing import Iterator
+from typing import Iterator, Optional
 
+import numpy as np
 from aiohttp import ClientSession
 
 from cbagent.collectors.collector import Collector
+from cbagent.stores import BufferedPerfStore
+from spring.reservoir import LatencyHistogram, Reservoir
 
 
 class Latency(Collector):
@@ -18,9 +20,8 @@ class Latency(Collector):
         self.mc.add_cluster()
         for bucket in self.get_buckets():
             self.mc.add_bucket(bucket)
-            for metric in self.METRICS:
-                self.mc.add_metric(metric, bucket=bucket,
-                                   collector=self.COLLECTOR)
+            self.mc.add_metrics(self.METRICS, bucket=bucket,
+                                collector=self.COLLECTOR)
 
     def sample(self):
         pass
@@ -30,31 +31,52 @@ class KVLatency(Latency):
 
     COLLECTOR = "spring_latency"
 
-    METRICS = "latency_get", "latency_set"
+    METRICS = "latency_get", "latency_set", "latency_get_batch", "latency_set_batch"
 
     PATTERN = '*-worker-*'
 
     def collect(self):
         pass
 
+    MAX_SAMPLES = Reservoir.MAX_CAPACITY
+
+    @classmethod
+    def merged_histogram(cls) -> Optional[LatencyHistogram]:
+        return LatencyHistogram.load_all(glob.glob(cls.PATTERN))
+
     def read_stats(self) -> Iterator:
+        """Yield the timestamps and latencies (in seconds) of every operation."""
         for filename in glob.glob(self.PATTERN):
-            with open(filename) as fh:
-                reader = csv.reader(fh)
-                for operation, timestamp, latency in reader:
-                    yield operation, timestamp, latency
+            if filename.endswith(Reservoir.SUFFIX):
+                for operation, (timestamps, latencies) in \
+                        Reservoir.load(filename).items():
+                    yield operation, timestamps, latencies
+
+        histogram = self.merged_histogram()
+        if histogram is not None:
+            yield from histogram.sample_arrays(max_samples=self.MAX_SAMPLES)
 
     async def post_results(self, bucket: str):
+        db = self.store.build_dbname(cluster=self.cluster, bucket=bucket,
+                                     collector=self.COLLECTOR)
         async with ClientSession() as self.store.async_session:
-            for operation, timestamp, latency in self.read_stats():
-                data = {
-                    'latency_' + operation: float(latency) * 1000,  # Latency in ms
-                }
-                await self.store.append_async(data=data,
-                                              timestamp=int(timestamp),
-                                              cluster=self.cluster,
-                                              bucket=bucket,
-                                              collector=self.COLLECTOR)
+            for operation, timestamps, latencies in self.read_stats():
+                metric = 'latency_' + operation
+                latencies = latencies.astype(np.float64) * 1000  # Latency in ms
+                if isinstance(self.store, BufferedPerfStore):
+                    await self.store.extend_async(db, metric, timestamps, latencies)
+                else:
+                    for timestamp, latency in zip(timestamps, latencies):
+                        await self.store.append_async(data={metric: float(latency)},
+                                                      timestamp=int(timestamp),
+                                                      cluster=self.cluster,
+                                                      bucket=bucket,
+                                                      collector=self.COLLECTOR)
+                if self.sketches is not None:
+                    self.sketches.extend(db, metric, latencies)
+            await self.store.flush_async()
+            if self.sketches is not None:
+                self.sketches.dump()
 
     def reconstruct(self):
         loop = asyncio.get_event_loop()
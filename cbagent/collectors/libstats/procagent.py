@@ -0,0 +1,284 @@
+"""Sample /proc at a fixed cadence and stream the changes as JSON lines.
+
+StatsAgent runs this script once per host over SSH. It is executed by the
+system Python of the host (2.7 or 3.x), therefore it only relies on the
+standard library and has no type annotations.
+
+Every line has the sampling time ("t"), the metrics that changed since the
+previous line ("d") and the metrics that disappeared ("r"), e.g. when a
+monitored process exits. Rates are computed between two consecutive samples.
+"""
+import json
+import os
+import sys
+import time
+
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+SECTOR_SIZE = 512  # /proc/diskstats always counts 512-byte sectors
+
+TCP_STATES = {'01': 'ESTABLISHED', '06': 'TIME_WAIT'}
+
+
+def read(path):
+    with open(path) as fh:
+        return fh.read()
+
+
+def parse_stat(stat):
+    """Split /proc/<pid>/stat into the command name and the remaining fields."""
+    start, end = stat.index('('), stat.rindex(')')
+    return stat[start + 1:end], stat[end + 2:].split()
+
+
+class ProcessProbe:
+
+    """Report the RSS, virtual size and CPU usage of the given processes.
+
+    If several processes match a name, the one with the largest RSS is used,
+    like "ps | grep | sort | tail" does.
+    """
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.pids = {}
+        self.cpu_ticks = {}
+
+    def find_pid(self, process):
+        name = process[:15]  # TASK_COMM_LEN
+        pid, max_rss = None, -1
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                comm, fields = parse_stat(read('/proc/{}/stat'.format(entry)))
+            except (IOError, OSError, ValueError):
+                continue
+            if name in comm and int(fields[21]) > max_rss:
+                pid, max_rss = entry, int(fields[21])
+        return pid
+
+    def read_stat(self, process):
+        pid = self.pids.get(process)
+        if pid is not None:
+            try:
+                comm, fields = parse_stat(read('/proc/{}/stat'.format(pid)))
+                if process[:15] in comm:
+                    return pid, fields
+            except (IOError, OSError, ValueError):
+                pass
+        pid = self.pids[process] = self.find_pid(process)
+        if pid is not None:
+            try:
+                return pid, parse_stat(read('/proc/{}/stat'.format(pid)))[1]
+            except (IOError, OSError, ValueError):
+                pass
+        return None, None
+
+    def sample(self, now):
+        samples = {}
+        for process in self.processes:
+            pid, fields = self.read_stat(process)
+            if fields is None:
+                self.cpu_ticks.pop(process, None)
+                continue
+            samples[process + '_rss'] = int(fields[21]) * PAGE_SIZE
+            samples[process + '_vsize'] = int(fields[20])
+
+            ticks = int(fields[11]) + int(fields[12])  # utime + stime
+            last = self.cpu_ticks.get(process)
+            if last is not None and last[0] == pid and now > last[1]:
+                cpu = 100.0 * (ticks - last[2]) / CLK_TCK / (now - last[1])
+                samples[process + '_cpu'] = cpu
+            self.cpu_ticks[process] = pid, now, ticks
+        return samples
+
+
+class DiskProbe:
+
+    """Report the block device statistics of the given partitions.
+
+    Either the rates reported by "iostat -dkx" or the total number of bytes
+    read and written since boot.
+    """
+
+    def __init__(self, partitions, totals=False):
+        self.totals = totals
+        self.devices = {}
+        for purpose, path in partitions.items():
+            device = self.find_device(path)
+            if device is not None:
+                self.devices[purpose] = device
+        self.last = {}
+
+    @staticmethod
+    def find_device(path):
+        path = os.path.realpath(path)
+        device, mount_point = None, ''
+        for line in read('/proc/mounts').splitlines():
+            source, target = line.split()[:2]
+            if not source.startswith('/dev/'):
+                continue
+            if (path == target or path.startswith(target.rstrip('/') + '/')) \
+                    and len(target) > len(mount_point):
+                device, mount_point = source, target
+        if device is not None:
+            return os.path.basename(os.path.realpath(device))  # LVM -> dm-N
+
+    def sample(self, now):
+        stats = {}
+        for line in read('/proc/diskstats').splitlines():
+            fields = line.split()
+            stats[fields[2]] = [int(v) for v in fields[3:14]]
+
+        samples = {}
+        for purpose, device in self.devices.items():
+            if device not in stats:
+                continue
+            curr = stats[device]
+            if self.totals:
+                samples[purpose + '_bytes_read'] = curr[2] * SECTOR_SIZE
+                samples[purpose + '_bytes_written'] = curr[6] * SECTOR_SIZE
+                continue
+
+            last = self.last.get(purpose)
+            self.last[purpose] = now, curr
+            if last is None or now <= last[0]:
+                continue
+            elapsed = now - last[0]
+            delta = [c - p for c, p in zip(curr, last[1])]
+            ios = delta[0] + delta[4]
+            samples[purpose + '_rps'] = delta[0] / elapsed
+            samples[purpose + '_wps'] = delta[4] / elapsed
+            samples[purpose + '_rbps'] = delta[2] * SECTOR_SIZE / elapsed
+            samples[purpose + '_wbps'] = delta[6] * SECTOR_SIZE / elapsed
+            samples[purpose + '_avgqusz'] = delta[10] / 1000.0 / elapsed
+            samples[purpose + '_await'] = \
+                float(delta[3] + delta[7]) / ios if ios else 0.0
+            samples[purpose + '_util'] = min(delta[9] / 10.0 / elapsed, 100.0)
+        return samples
+
+
+class NetProbe:
+
+    """Report the traffic of the default interface and the TCP connections."""
+
+    def __init__(self):
+        self.iface = self.detect_iface()
+        self.last = None
+
+    @staticmethod
+    def detect_iface():
+        for line in read('/proc/net/route').splitlines()[1:]:
+            fields = line.split()
+            if fields[1] == '00000000':
+                return fields[0]
+
+    def sample(self, now):
+        samples = {}
+        for line in read('/proc/net/dev').splitlines()[2:]:
+            iface, counters = line.split(':', 1)
+            if iface.strip() != self.iface:
+                continue
+            counters = [int(v) for v in counters.split()]
+            last, self.last = self.last, (now, counters)
+            if last is not None and now > last[0]:
+                elapsed = now - last[0]
+                for metric, i in (('in_bytes_per_sec', 0),
+                                  ('in_packets_per_sec', 1),
+                                  ('out_bytes_per_sec', 8),
+                                  ('out_packets_per_sec', 9)):
+                    samples[metric] = (counters[i] - last[1][i]) / elapsed
+
+        for state in TCP_STATES.values():
+            samples[state] = 0
+        for path in '/proc/net/tcp', '/proc/net/tcp6':
+            try:
+                lines = read(path).splitlines()[1:]
+            except (IOError, OSError):
+                continue
+            for line in lines:
+                state = TCP_STATES.get(line.split()[3])
+                if state:
+                    samples[state] += 1
+        return samples
+
+
+class MemInfoProbe:
+
+    def sample(self, now):
+        samples = {}
+        for line in read('/proc/meminfo').splitlines():
+            fields = line.split()
+            samples[fields[0].rstrip(':')] = 1024 * int(fields[1])  # KB -> Bytes
+        return samples
+
+
+class VMStatProbe:
+
+    def sample(self, now):
+        samples = {'allocstall': 0}
+        for line in read('/proc/vmstat').splitlines():
+            metric, value = line.split()[:2]
+            if 'allocstall' in metric:
+                samples['allocstall'] += int(value)
+            else:
+                samples[metric] = int(value)
+        return samples
+
+
+def create_probes(config):
+    probes = []
+    if config.get('processes'):
+        probes.append(ProcessProbe(config['processes']))
+    if config.get('iostat'):
+        probes.append(DiskProbe(config['iostat']))
+    if config.get('disk'):
+        probes.append(DiskProbe(config['disk'], totals=True))
+    if config.get('net'):
+        probes.append(NetProbe())
+    if config.get('meminfo'):
+        probes.append(MemInfoProbe())
+    if config.get('vmstat'):
+        probes.append(VMStatProbe())
+    return probes
+
+
+def main():
+    config = json.loads(sys.argv[1])
+    interval = float(config['interval'])
+    probes = create_probes(config)
+
+    state = {}
+    next_time = time.time()
+    while True:
+        now = time.time()
+        samples = {}
+        for probe in probes:
+            samples.update(probe.sample(now))
+        for metric, value in samples.items():
+            if isinstance(value, float):
+                samples[metric] = round(value, 3)
+
+        changes = dict((metric, value) for metric, value in samples.items()
+                       if state.get(metric) != value)
+        removed = [metric for metric in state if metric not in samples]
+        state = samples
+
+        line = {'t': round(now, 3), 'd': changes}
+        if removed:
+            line['r'] = removed
+        try:
+            sys.stdout.write(json.dumps(line, separators=(',', ':')) + '\n')
+            sys.stdout.flush()
+        except IOError:  # The collector has gone away
+            return
+
+        next_time += interval
+        time.sleep(max(0, next_time - time.time()))
+
+
+if __name__ == '__main__':
+    main()
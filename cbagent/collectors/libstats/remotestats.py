@@ -1,8 +1,10 @@
 import sys
+from threading import local
 
 from decorator import decorator
-from fabric.api import env, hide, parallel, run, settings
-from fabric.tasks import execute
+from fabric.api import env
+
+from perfrunner.remote.ssh import SSHPool
 
 env.shell = '/bin/bash -l -c -o pipefail'
 env.keepalive = 60
@@ -20,24 +22,35 @@ def parallel_task(server_side=True):
         else:
             hosts = self.workers
 
-        with settings(user=self.user, password=self.password, warn_only=True):
-            with hide("running", "output"):
-                return execute(parallel(task), *args, hosts=hosts, **kargs)
+        def call(host):
+            self.context.host = host
+            return task(*args, **kargs)
+
+        return self.ssh.map(hosts, call)
 
     return _parallel_task
 
 
 class RemoteStats:
 
+    """Run the sampling commands over persistent SSH sessions.
+
+    The tasks decorated with parallel_task run concurrently in threads, one
+    per host, and self.run executes commands on the host of the current
+    thread. Sessions are opened on first use and reused for every sample.
+    """
+
     def __init__(self, hosts, workers, user, password, interval=None):
         self.hosts = hosts
         self.user = user
         self.password = password
         self.workers = workers
         self.interval = interval
+        self.ssh = SSHPool(user, password)
+        self.context = local()
 
-    def run(self, *args, **kwargs):
+    def run(self, command, timeout=None, **kwargs):
         try:
-            return run(*args, **kwargs)
+            return self.ssh.run(self.context.host, command, timeout)
         except KeyboardInterrupt:
             sys.exit()
@@ -0,0 +1,157 @@
+import json
+import shlex
+import subprocess
+import time
+from threading import Event, Lock, Thread
+from typing import Dict, List, Optional
+
+import paramiko
+
+from cbagent.collectors.libstats import procagent
+from cbagent.collectors.libstats.remotestats import RemoteStats
+from logger import logger
+
+LOCAL_HOSTS = 'localhost', '127.0.0.1'
+
+PYTHON = '$(command -v python3 || command -v python)'
+
+
+class AgentChannel(Thread):
+
+    """Run the stats agent on a single host and merge the samples it streams.
+
+    The agent is started once over SSH and keeps running until the channel is
+    closed. Local hosts run the agent in a subprocess instead, which makes it
+    possible to test the agent without an SSH server.
+    """
+
+    RETRY_DELAY = 5  # seconds
+
+    MAX_AGE = 3  # Samples older than MAX_AGE intervals are considered stale
+
+    def __init__(self, host: str, user: str, password: str, command: str,
+                 interval: float):
+        super().__init__(daemon=True)
+        self.host = host
+        self.user = user
+        self.password = password
+        self.command = command
+        self.interval = interval
+
+        self.client = None  # type: paramiko.SSHClient
+        self.process = None  # type: subprocess.Popen
+        self.stopped = Event()
+
+        self.lock = Lock()
+        self.samples = {}  # type: Dict[str, float]
+        self.last_update = 0.0
+
+    def open(self):
+        if self.host in LOCAL_HOSTS:
+            self.process = subprocess.Popen(self.command, shell=True,
+                                            stdout=subprocess.PIPE,
+                                            universal_newlines=True)
+            return self.process.stdout
+
+        self.client = paramiko.SSHClient()
+        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.client.connect(hostname=self.host, username=self.user,
+                            password=self.password)
+        self.client.get_transport().set_keepalive(60)
+        _, stdout, _ = self.client.exec_command(self.command)
+        return stdout
+
+    def close(self):
+        with self.lock:  # Called by both stop() and run()
+            process, self.process = self.process, None
+            client, self.client = self.client, None
+        if process is not None:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            process.stdout.close()
+        if client is not None:
+            client.close()
+
+    def update(self, line: str):
+        message = json.loads(line)
+        with self.lock:
+            self.samples.update(message['d'])
+            for metric in message.get('r', []):
+                self.samples.pop(metric, None)
+            self.last_update = time.time()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                for line in self.open():
+                    self.update(line)
+            except Exception as e:
+                logger.warn('Stats agent failed on {}: {}'.format(self.host, e))
+            finally:
+                self.close()
+            if not self.stopped.wait(self.RETRY_DELAY):
+                logger.info('Restarting stats agent on {}'.format(self.host))
+
+    def stop(self):
+        self.stopped.set()
+        self.close()
+
+    def get_samples(self) -> Dict[str, float]:
+        with self.lock:
+            if time.time() - self.last_update > self.MAX_AGE * self.interval:
+                return {}
+            return self.samples.copy()
+
+
+class StatsAgent(RemoteStats):
+
+    """Sample /proc on every host with a long-lived agent (see procagent).
+
+    Unlike the other samplers, sampling does not run any remote command: the
+    agents sample the hosts at a fixed cadence on their own and the latest
+    samples are returned immediately. Agents are started on first use so that
+    they belong to the collector process.
+    """
+
+    def __init__(self, hosts: List[str], workers: List[str], user: str,
+                 password: str, interval: float, server_probes: dict = None,
+                 client_probes: dict = None):
+        super().__init__(hosts, workers, user, password, interval)
+        self.server_probes = server_probes
+        self.client_probes = client_probes
+        self.servers = {}  # type: Dict[str, AgentChannel]
+        self.clients = {}  # type: Dict[str, AgentChannel]
+
+    def command(self, probes: dict) -> str:
+        with open(procagent.__file__) as fh:
+            source = fh.read()
+        config = json.dumps(dict(probes, interval=self.interval))
+        return 'exec {} -u -c {} {}'.format(PYTHON, shlex.quote(source),
+                                            shlex.quote(config))
+
+    def start(self, hosts: List[str], probes: Optional[dict]) -> Dict[str, AgentChannel]:
+        channels = {}
+        if probes:
+            command = self.command(probes)
+            for host in hosts:
+                channels[host] = AgentChannel(host, self.user, self.password,
+                                              command, self.interval)
+                channels[host].start()
+        return channels
+
+    def stop(self):
+        for channel in list(self.servers.values()) + list(self.clients.values()):
+            channel.stop()
+
+    def get_server_samples(self) -> Dict[str, Dict[str, float]]:
+        if not self.servers:
+            self.servers = self.start(self.hosts, self.server_probes)
+        return {host: channel.get_samples()
+                for host, channel in self.servers.items()}
+
+    def get_client_samples(self) -> Dict[str, Dict[str, float]]:
+        if not self.clients:
+            self.clients = self.start(self.workers, self.client_probes)
+        return {host: channel.get_samples()
+                for host, channel in self.clients.items()}
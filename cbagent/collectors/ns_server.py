@@ -1,3 +1,5 @@
+import asyncio
+
 from cbagent.collectors.collector import Collector
 
 
@@ -5,6 +7,18 @@ class NSServer(Collector):
 
     COLLECTOR = "ns_server"
 
+    # Disk sizes and item counts only move during loads, compaction and rebalance
+    METRIC_INTERVALS = dict.fromkeys((
+        "couch_docs_actual_disk_size",
+        "couch_docs_data_size",
+        "couch_total_disk_size",
+        "couch_views_actual_disk_size",
+        "couch_views_data_size",
+        "curr_items",
+        "curr_items_tot",
+        "vb_replica_curr_items",
+    ), (5, 300))
+
     def _get_stats_uri(self):
         for bucket, stats in self.get_buckets(with_stats=True):
             uri = stats["uri"]
@@ -12,6 +26,10 @@ class NSServer(Collector):
 
     def _get_stats(self, uri):
         samples = self.get_http(path=uri)  # get last minute samples
+        return self._parse_stats(samples)
+
+    @staticmethod
+    def _parse_stats(samples):
         stats = {}
 
         if samples["op"]["lastTStamp"] == 0:
@@ -32,6 +50,20 @@ class NSServer(Collector):
             self.store.append(stats, cluster=self.cluster, bucket=bucket,
                               collector=self.COLLECTOR)
 
+    async def _sample_bucket(self, uri, bucket):
+        samples = await self.get_http_async(path=uri)
+        stats = samples and self._parse_stats(samples)
+        if not stats:
+            return
+        self.update_metric_metadata(stats.keys(), bucket)
+        await self.store.append_async(stats, cluster=self.cluster,
+                                      bucket=bucket, collector=self.COLLECTOR)
+
+    async def sample_async(self):
+        buckets = await self.get_buckets_async(with_stats=True)
+        await asyncio.gather(*(self._sample_bucket(stats["uri"], bucket)
+                               for bucket, stats in buckets))
+
     def update_metadata(self):
         self.mc.add_cluster()
 
@@ -45,7 +77,10 @@ class NSServerOverview(NSServer):
 
     def _get_overview_stats(self):
         overview = self.get_http(path='/pools/default/overviewStats')
+        return self._parse_overview_stats(overview)
 
+    @staticmethod
+    def _parse_overview_stats(overview):
         stats = {}
         for metric, values in overview.items():
             stats[metric] = values[-1]  # only the most recent sample
@@ -59,6 +94,15 @@ class NSServerOverview(NSServer):
         self.store.append(overview, cluster=self.cluster,
                           collector=self.COLLECTOR)
 
+    async def sample_async(self):
+        overview = await self.get_http_async(path='/pools/default/overviewStats')
+        if not overview:
+            return
+
+        await self.store.append_async(self._parse_overview_stats(overview),
+                                      cluster=self.cluster,
+                                      collector=self.COLLECTOR)
+
     def update_metadata(self):
         self.update_metric_metadata(self.METRICS)
 
@@ -70,7 +114,10 @@ class NSServerSystem(NSServer):
 
     def _get_system_stats(self):
         all_stats = self.get_http(path='/pools/default')
+        return self._parse_system_stats(all_stats)
 
+    @staticmethod
+    def _parse_system_stats(all_stats):
         server_stats = {}
         for node in all_stats["nodes"]:
             stats = {}
@@ -89,6 +136,18 @@ class NSServerSystem(NSServer):
                               server=server,
                               collector=self.COLLECTOR)
 
+    async def sample_async(self):
+        all_stats = await self.get_http_async(path='/pools/default')
+        if not all_stats:
+            return
+
+        server_stats = self._parse_system_stats(all_stats)
+        await asyncio.gather(*(
+            self.store.append_async(stats, cluster=self.cluster, server=server,
+                                    collector=self.COLLECTOR)
+            for server, stats in server_stats.items()
+        ))
+
     def update_metadata(self):
         self.mc.add_cluster()
 
@@ -101,14 +160,19 @@ class XdcrStats(Collector):
 
     COLLECTOR = "xdcr_stats"
 
+    URI = '/_uistats?bucket={}&zoom=minute'
+
     def _get_stats_uri(self):
         for bucket in self.get_buckets():
-            uri = '/_uistats?bucket={}&zoom=minute'.format(bucket)
+            uri = self.URI.format(bucket)
             yield bucket, uri
 
     def _get_stats(self, bucket, uri):
         samples = self.get_http(path=uri)
+        return self._parse_stats(bucket, samples)
 
+    @staticmethod
+    def _parse_stats(bucket, samples):
         stats = dict()
         for metric, values in samples['stats']['@xdcr-{}'.format(bucket)].items():
             if 'replications' in metric:
@@ -125,6 +189,20 @@ class XdcrStats(Collector):
             self.store.append(stats, cluster=self.cluster, bucket=bucket,
                               collector=self.COLLECTOR)
 
+    async def _sample_bucket(self, bucket, uri):
+        samples = await self.get_http_async(path=uri)
+        stats = samples and self._parse_stats(bucket, samples)
+        if not stats:
+            return
+        self.update_metric_metadata(stats.keys(), bucket)
+        await self.store.append_async(stats, cluster=self.cluster,
+                                      bucket=bucket, collector=self.COLLECTOR)
+
+    async def sample_async(self):
+        buckets = await self.get_buckets_async()
+        await asyncio.gather(*(self._sample_bucket(bucket, self.URI.format(bucket))
+                               for bucket in buckets))
+
     def update_metadata(self):
         self.mc.add_cluster()
 
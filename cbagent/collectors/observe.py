@@ -1,5 +1,8 @@
-from threading import Thread
-from time import sleep, time
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from threading import local
+from time import time
 
 import numpy
 import pkg_resources
@@ -7,6 +10,7 @@ from decorator import decorator
 
 from cbagent.collectors import Latency
 from cbagent.collectors.libstats.pool import Pool
+from cbagent.sketches import SketchStore
 from logger import logger
 from perfrunner.helpers.misc import uhex
 from spring.docgen import Document, Key
@@ -31,20 +35,34 @@ def timeit(method, *args, **kargs):
 
 class ObserveIndexLatency(Latency):
 
-    COLLECTOR = "observe"
+    """Measure the time it takes to index a new document.
 
-    METRICS = "latency_observe",
+    Probes are started on an open-loop schedule, at PROBE_RATE per second
+    in total. The buckets take turns, so each bucket gets an equal share of
+    the rate. At most PROBES run at the same time and a tick is skipped when
+    all probes are busy. A probe creates a document, polls the index until
+    it finds the document and deletes it. The blocking SDK calls run in a
+    pool of PROBES threads, so a bucket never uses more than PROBES clients.
+    The latencies are always recorded in quantile sketches, which have a
+    fixed size whatever the number of probes.
+    """
 
-    NUM_THREADS = 10
+    COLLECTOR = "observe"
 
-    MAX_POLLING_INTERVAL = 1
+    METRICS = "latency_observe",
 
-    INITIAL_REQUEST_INTERVAL = 0.01
+    PROBE_RATE = 10  # Probes per second, shared by all buckets
 
-    MAX_REQUEST_INTERVAL = 2
+    PROBES = 10  # Concurrent probes
 
     def __init__(self, settings):
         super().__init__(settings)
+        self.probe_rate = float(getattr(settings, 'observe_rate', self.PROBE_RATE))
+        self.probes = int(getattr(settings, 'observe_probes', self.PROBES))
+        self.slots = None
+        self.skipped = 0
+        if self.sketches is None:
+            self.sketches = SketchStore()
         self.pools = self.init_pool(settings)
 
     def init_pool(self, settings):
@@ -56,6 +74,8 @@ class ObserveIndexLatency(Latency):
                 username=bucket,
                 password=settings.bucket_password,
                 collections=settings.collections,
+                initial=1,
+                max_clients=self.probes,
                 quiet=True,
             )
             pools.append((bucket, pool))
@@ -67,49 +87,91 @@ class ObserveIndexLatency(Latency):
         while not rows:
             rows = tuple(client.query("A", "id_by_city", key=key))
 
-    def _create_doc(self, pool):
-        client = pool.get_client()
+    @staticmethod
+    def _create_doc(client):
         key = uhex()
         client.set(key, {"city": key})
-        return client, key
+        return key
 
-    def _post_wait_operations(self, end_time, start_time, key, client, pool):
+    @staticmethod
+    def _post_wait_operations(end_time, start_time, key, client):
         latency = (end_time - start_time) * 1000  # s -> ms
-        sleep_time = max(0, self.MAX_POLLING_INTERVAL - (end_time - start_time))
 
         client.delete(key)
-        pool.release_client(client)
-        return {"latency_observe": latency}, sleep_time
+        return {"latency_observe": latency}
 
-    def _measure_lags(self, pool):
-        client, key = self._create_doc(pool)
+    def _measure_lags(self, client):
+        key = self._create_doc(client)
         t0, t1 = self._wait_until_indexed(client, key)
         return self._post_wait_operations(end_time=t1, start_time=t0, key=key,
-                                          client=client, pool=pool)
+                                          client=client)
 
-    def sample(self):
+    def record(self, bucket, pool):
+        client = pool.get_client()
+        try:
+            stats = self._measure_lags(client)
+        finally:
+            pool.release_client(client)
+        self.store.append(stats,
+                          cluster=self.cluster,
+                          bucket=bucket,
+                          collector=self.COLLECTOR)
+        self.update_sketches(stats, bucket=bucket)
+
+    async def probe(self, bucket, pool):
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, self.record,
+                                                           bucket, pool)
+        except Exception as e:
+            logger.warn(e)
+        finally:
+            self.slots.release()
+
+    async def schedule(self, bucket, pool, interval, offset):
+        t0 = time() + offset
+        await asyncio.sleep(offset)
         while True:
-            try:
-                for bucket, pool in self.pools:
-                    stats, sleep_time = self._measure_lags(pool)
-                    self.store.append(stats,
-                                      cluster=self.cluster,
-                                      bucket=bucket,
-                                      collector=self.COLLECTOR)
-                    sleep(sleep_time)
-            except Exception as e:
-                logger.warn(e)
+            if self.slots.locked():
+                self.skipped += 1
+            else:
+                await self.slots.acquire()
+                asyncio.ensure_future(self.probe(bucket, pool))
+            # Keep a fixed probe rate, skipping the missed ticks
+            t0 = max(t0 + interval, time())
+            await asyncio.sleep(t0 - time())
+
+    def sample(self):
+        pass
+
+    def terminate(self, *args):
+        logger.info('{}: {} probes skipped, all probes were busy'
+                    .format(self.__class__.__name__, self.skipped))
+        super().terminate(*args)
+
+    async def run(self):
+        self.slots = asyncio.Semaphore(self.probes)
+        interval = len(self.pools) / self.probe_rate  # Per bucket
+        await asyncio.gather(*(
+            self.schedule(bucket, pool, interval, offset=i / self.probe_rate)
+            for i, (bucket, pool) in enumerate(self.pools)
+        ))
 
     def collect(self):
-        threads = [Thread(target=self.sample) for _ in range(self.NUM_THREADS)]
-        for t in threads:
-            t.start()
-        for t in threads:
-            t.join()
+        self.handle_sigterm()
+        loop = asyncio.get_event_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.probes))
+        try:
+            loop.run_until_complete(self.run())
+        except KeyboardInterrupt:
+            sys.exit()
 
 
 class ObserveSecondaryIndexLatency(ObserveIndexLatency):
 
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.local = local()  # Every thread has its own query client
+
     @timeit
     def _wait_until_secondary_indexed(self, key, cb, query):
         row = None
@@ -118,39 +180,30 @@ class ObserveSecondaryIndexLatency(ObserveIndexLatency):
             row = cb.n1ql_query(query).get_single_result()
 
     @staticmethod
-    def create_alt_mail_doc(pool):
-        client = pool.get_client()
-
+    def create_alt_mail_doc(client):
         key = uhex()
         client.set(key, {"alt_email": key})
-        return client, key
-
-    def _measure_lags(self, pool, cb=None, query=None):
-        client, key = self.create_alt_mail_doc(pool)
+        return key
+
+    def _query_client(self):
+        if not hasattr(self.local, 'cb'):
+            connection_string = 'couchbase://{}/{}?password={}'.format(
+                self.master_node, self.buckets[0], self.auth[1])
+            self.local.cb = Bucket(connection_string)
+            query = N1QLQuery("select alt_email from `bucket-1` where alt_email=$c",
+                              c="abc")
+            query.adhoc = False
+            self.local.query = query
+        return self.local.cb, self.local.query
+
+    def _measure_lags(self, client):
+        cb, query = self._query_client()
+        key = self.create_alt_mail_doc(client)
 
         t0, t1 = self._wait_until_secondary_indexed(key, cb, query)
 
         return self._post_wait_operations(end_time=t1, start_time=t0, key=key,
-                                          client=client, pool=pool)
-
-    def sample(self):
-        connection_string = 'couchbase://{}/{}?password={}'.format(
-            self.master_node, self.buckets[0], self.auth[1])
-        cb = Bucket(connection_string)
-        query = N1QLQuery("select alt_email from `bucket-1` where alt_email=$c", c="abc")
-        query.adhoc = False
-
-        while True:
-            try:
-                for bucket, pool in self.pools:
-                    stats, sleep_time = self._measure_lags(pool, cb=cb, query=query)
-                    self.store.append(stats,
-                                      cluster=self.cluster,
-                                      bucket=bucket,
-                                      collector=self.COLLECTOR)
-                    sleep(sleep_time)
-            except Exception as e:
-                logger.warn(e)
+                                          client=client)
 
 
 class DurabilityLatency(ObserveIndexLatency, Latency):
@@ -166,17 +219,13 @@ class DurabilityLatency(ObserveIndexLatency, Latency):
 
         self.new_docs = Document(workload.size)
 
-        self.pools = self.init_pool(settings)
-
     @staticmethod
     def gen_key() -> Key:
         return Key(number=numpy.random.random_integers(0, 10 ** 9),
                    prefix='endure',
                    fmtr='hex')
 
-    def endure(self, pool, metric):
-        client = pool.get_client()
-
+    def endure(self, client, metric):
         key = self.gen_key()
         doc = self.new_docs.next(key)
 
@@ -191,25 +240,11 @@ class DurabilityLatency(ObserveIndexLatency, Latency):
 
         latency = 1000 * (time() - t0)  # Latency in ms
 
-        sleep_time = max(0, self.MAX_POLLING_INTERVAL - latency)
-
         client.delete(key.string)
-        pool.release_client(client)
-        return {metric: latency}, sleep_time
+        return {metric: latency}
 
-    def sample(self):
-        while True:
-            for bucket, pool in self.pools:
-                for metric in self.METRICS:
-                    try:
-                        stats, sleep_time = self.endure(pool, metric)
-                        self.store.append(stats,
-                                          cluster=self.cluster,
-                                          bucket=bucket,
-                                          collector=self.COLLECTOR)
-                        sleep(sleep_time)
-                    except Exception as e:
-                        logger.warn(e)
-
-    def collect(self):
-        ObserveIndexLatency.collect(self)
+    def _measure_lags(self, client):
+        stats = {}
+        for metric in self.METRICS:
+            stats.update(self.endure(client, metric))
+        return stats
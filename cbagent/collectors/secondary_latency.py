@@ -37,6 +37,7 @@ class SecondaryLatencyStats(Collector):
         if stats:
             self.update_metric_metadata(stats.keys())
             self.store.append(stats, cluster=self.cluster, collector=self.COLLECTOR)
+            self.update_sketches(stats)
 
     def update_metadata(self):
         self.mc.add_cluster()
@@ -1,3 +1,5 @@
+import asyncio
+
 from cbagent.collectors.collector import Collector
 
 
@@ -5,9 +7,22 @@ class SecondaryStats(Collector):
 
     COLLECTOR = "secondary_stats"
 
+    # Index sizes and item counts change slowly outside of the initial build
+    METRIC_INTERVALS = dict.fromkeys((
+        "index_data_size",
+        "index_disk_size",
+        "index_items_count",
+        "index_num_docs_indexed",
+    ), (5, 300))
+
+    URI = "/pools/default/buckets/@index-{}/stats"
+
     def _get_secondary_stats(self, bucket):
-        uri = "/pools/default/buckets/@index-{}/stats".format(bucket)
-        samples = self.get_http(path=uri)
+        samples = self.get_http(path=self.URI.format(bucket))
+        return self._parse_secondary_stats(samples)
+
+    @staticmethod
+    def _parse_secondary_stats(samples):
         stats = dict()
         for metric, values in samples['op']['samples'].items():
             metric = metric.replace('/', '_')
@@ -22,6 +37,19 @@ class SecondaryStats(Collector):
                 self.store.append(stats, cluster=self.cluster,
                                   bucket=bucket, collector=self.COLLECTOR)
 
+    async def _sample_bucket(self, bucket):
+        samples = await self.get_http_async(path=self.URI.format(bucket))
+        stats = samples and self._parse_secondary_stats(samples)
+        if stats:
+            self.update_metric_metadata(stats.keys(), bucket=bucket)
+            await self.store.append_async(stats, cluster=self.cluster,
+                                          bucket=bucket,
+                                          collector=self.COLLECTOR)
+
+    async def sample_async(self):
+        buckets = await self.get_buckets_async()
+        await asyncio.gather(*(self._sample_bucket(bucket) for bucket in buckets))
+
     def update_metadata(self):
         self.mc.add_cluster()
 
@@ -16,7 +16,9 @@ class SecondaryStorageStatsMM(SecondaryStats):
         port = '9102'
         uri = "/stats/storage/mm"
         samples = self.get_http(path=uri, server=server, port=port, json=False)
+        return self._parse_secondary_storage_stats_mm(samples)
 
+    def _parse_secondary_storage_stats_mm(self, samples):
         stats = {}
         for line in samples.split("\n"):
             if "resident" in line:
@@ -33,3 +35,13 @@ class SecondaryStorageStatsMM(SecondaryStats):
             self.update_metric_metadata(stats.keys())
             self.store.append(stats, cluster=self.cluster,
                               collector=self.COLLECTOR)
+
+    async def sample_async(self):
+        samples = await self.get_http_async(path="/stats/storage/mm",
+                                            server=self.index_node, port='9102',
+                                            json=False)
+        stats = samples and self._parse_secondary_storage_stats_mm(samples)
+        if stats:
+            self.update_metric_metadata(stats.keys())
+            await self.store.append_async(stats, cluster=self.cluster,
+                                          collector=self.COLLECTOR)
@@ -1,9 +1,12 @@
+from typing import Tuple
+
 from cbagent.collectors.collector import Collector
 from cbagent.collectors.libstats.iostat import DiskStats, IOStat
 from cbagent.collectors.libstats.meminfo import MemInfo
 from cbagent.collectors.libstats.net import NetStat
 from cbagent.collectors.libstats.pcstat import PCStat
 from cbagent.collectors.libstats.psstats import PSStats
+from cbagent.collectors.libstats.statsagent import StatsAgent
 from cbagent.collectors.libstats.sysdig import SysdigStat
 from cbagent.collectors.libstats.typeperfstats import TPStats
 from cbagent.collectors.libstats.vmstat import VMStat
@@ -29,11 +32,34 @@ class System(Collector):
     def sample(self):
         raise NotImplementedError
 
+    def agent_probes(self) -> Tuple[dict, dict]:
+        """Return the stats agent probes of the servers and the clients."""
+        return {}, {}
+
+    def sample_agent(self):
+        for node, stats in self.agent.get_server_samples().items():
+            self.add_stats(node, stats)
+
+        for node, stats in self.agent.get_client_samples().items():
+            self.add_stats(node, stats)
+
     def __init__(self, settings):
         self.settings = settings
 
         super().__init__(settings)
 
+        self.agent = None
+        if getattr(settings, 'stats_agent', False):
+            server_probes, client_probes = self.agent_probes()
+            if server_probes or client_probes:
+                self.agent = StatsAgent(hosts=self.nodes,
+                                        workers=self.workers,
+                                        user=self.ssh_username,
+                                        password=self.ssh_password,
+                                        interval=self.interval,
+                                        server_probes=server_probes,
+                                        client_probes=client_probes)
+
 
 class PS(System):
 
@@ -48,7 +74,14 @@ class PS(System):
                                password=self.ssh_password,
                                interval=self.interval)
 
+    def agent_probes(self) -> Tuple[dict, dict]:
+        return {'processes': self.settings.server_processes}, \
+            {'processes': self.settings.client_processes}
+
     def sample(self):
+        if self.agent:
+            return self.sample_agent()
+
         for process in self.settings.server_processes:
             for node, stats in self.sampler.get_server_samples(process).items():
                 self.add_stats(node, stats)
@@ -72,7 +105,14 @@ class IO(System):
                               user=self.ssh_username,
                               password=self.ssh_password)
 
+    def agent_probes(self) -> Tuple[dict, dict]:
+        return {'iostat': self.settings.partitions['server']}, \
+            {'iostat': self.settings.partitions['client']}
+
     def sample(self):
+        if self.agent:
+            return self.sample_agent()
+
         for node, stats in self.sampler.get_server_samples(self.partitions).items():
             self.add_stats(node, stats)
 
@@ -96,12 +136,21 @@ class Disk(System):
 
         self.initial_stats = {}
 
+    def agent_probes(self) -> Tuple[dict, dict]:
+        return {'disk': self.settings.partitions['server']}, {}
+
+    def add_stats(self, node, stats):
+        if stats and not self.initial_stats.get(node):
+            self.initial_stats[node] = stats.copy()
+        for metric, value in stats.items():
+            stats[metric] -= self.initial_stats[node][metric]
+        super().add_stats(node, stats)
+
     def sample(self):
+        if self.agent:
+            return self.sample_agent()
+
         for node, stats in self.sampler.get_server_samples(self.partitions).items():
-            if not self.initial_stats.get(node):
-                self.initial_stats[node] = stats.copy()
-            for metric, value in stats.items():
-                stats[metric] -= self.initial_stats[node][metric]
             self.add_stats(node, stats)
 
 
@@ -136,7 +185,13 @@ class Net(System):
                                user=self.ssh_username,
                                password=self.ssh_password)
 
+    def agent_probes(self) -> Tuple[dict, dict]:
+        return {'net': True}, {}
+
     def sample(self):
+        if self.agent:
+            return self.sample_agent()
+
         for node, stats in self.sampler.get_samples().items():
             self.add_stats(node, stats)
 
@@ -151,6 +206,9 @@ class TypePerf(PS):
                                user=self.ssh_username,
                                password=self.ssh_password)
 
+    def agent_probes(self) -> Tuple[dict, dict]:
+        return {}, {}  # There is no /proc on Windows
+
 
 class Sysdig(System):
 
@@ -182,7 +240,13 @@ class Memory(System):
                                user=self.ssh_username,
                                password=self.ssh_password)
 
+    def agent_probes(self) -> Tuple[dict, dict]:
+        return {'meminfo': True}, {}
+
     def sample(self):
+        if self.agent:
+            return self.sample_agent()
+
         for node, stats in self.sampler.get_samples().items():
             self.add_stats(node, stats)
 
@@ -199,6 +263,12 @@ class VMSTAT(System):
                               user=self.ssh_username,
                               password=self.ssh_password)
 
+    def agent_probes(self) -> Tuple[dict, dict]:
+        return {'vmstat': True}, {}
+
     def sample(self):
+        if self.agent:
+            return self.sample_agent()
+
         for node, stats in self.sampler.get_samples().items():
             self.add_stats(node, stats)
@@ -1,3 +1,7 @@
+import asyncio
+import sys
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep, time
 
 import numpy
@@ -18,8 +22,24 @@ def new_client(host, bucket, password, timeout):
     return client
 
 
+def vbucket(key: str, num_vbuckets: int) -> int:
+    """Map a key to its vBucket like the client libraries do."""
+    return ((zlib.crc32(key.encode()) >> 16) & 0x7fff) % num_vbuckets
+
+
 class XdcrLag(Latency):
 
+    """Measure the XDCR lag with marker documents.
+
+    Every bucket has PROBES concurrent probes. Each probe owns a pair of
+    clients and a group of vBuckets (the vBucket space is split into PROBES
+    contiguous groups). A probe writes a marker document to the source
+    cluster and polls the destination cluster until the document arrives,
+    then starts again at most every MAX_SAMPLING_INTERVAL. A slow replication
+    therefore only delays its own probe. The lags are stored in the xdcr_lag
+    series and in one series per vBucket group.
+    """
+
     COLLECTOR = "xdcr_lag"
 
     METRICS = "xdcr_lag",
@@ -30,33 +50,54 @@ class XdcrLag(Latency):
 
     MAX_SAMPLING_INTERVAL = 0.25  # 250 ms
 
+    PROBES = 8  # Concurrent probes per bucket
+
     def __init__(self, settings, workload):
         super().__init__(settings)
 
         self.interval = self.MAX_SAMPLING_INTERVAL
 
-        self.clients = []
+        self.probes = []
         for bucket in self.get_buckets():
-            src_client = new_client(host=settings.master_node,
-                                    bucket=bucket,
-                                    password=settings.bucket_password,
-                                    timeout=self.TIMEOUT)
-            dst_client = new_client(host=settings.dest_master_node,
-                                    bucket=bucket,
-                                    password=settings.bucket_password,
-                                    timeout=self.TIMEOUT)
-            self.clients.append((bucket, src_client, dst_client))
+            num_vbuckets = self.get_num_vbuckets(bucket)
+            for group in range(self.PROBES):
+                src_client = new_client(host=settings.master_node,
+                                        bucket=bucket,
+                                        password=settings.bucket_password,
+                                        timeout=self.TIMEOUT)
+                dst_client = new_client(host=settings.dest_master_node,
+                                        bucket=bucket,
+                                        password=settings.bucket_password,
+                                        timeout=self.TIMEOUT)
+                self.probes.append((bucket, group, num_vbuckets,
+                                    src_client, dst_client))
 
         self.new_docs = Document(workload.size)
 
+    def get_num_vbuckets(self, bucket: str) -> int:
+        info = self.get_http(path='/pools/default/buckets/{}'.format(bucket))
+        return len(info['vBucketServerMap']['vBucketMap'])
+
     @staticmethod
-    def gen_key() -> Key:
-        return Key(number=numpy.random.random_integers(0, 10 ** 9),
-                   prefix='xdcr',
-                   fmtr='hex')
+    def group_metric(group: int) -> str:
+        return 'xdcr_lag_vbg{}'.format(group)
 
-    def measure(self, src_client, dst_client):
-        key = self.gen_key()
+    def update_metadata(self):
+        super().update_metadata()
+        metrics = [self.group_metric(group) for group in range(self.PROBES)]
+        for bucket in self.get_buckets():
+            self.mc.add_metrics(metrics, bucket=bucket, collector=self.COLLECTOR)
+
+    def gen_key(self, group: int, num_vbuckets: int) -> Key:
+        """Generate a random key that belongs to the given vBucket group."""
+        while True:
+            key = Key(number=numpy.random.random_integers(0, 10 ** 9),
+                      prefix='xdcr',
+                      fmtr='hex')
+            if vbucket(key.string, num_vbuckets) * self.PROBES // num_vbuckets == group:
+                return key
+
+    def measure(self, src_client, dst_client, key: Key) -> float:
         doc = self.new_docs.next(key)
 
         polling_interval = self.INITIAL_POLLING_INTERVAL
@@ -77,12 +118,41 @@ class XdcrLag(Latency):
         src_client.remove(key.string, quiet=True)
         dst_client.remove(key.string, quiet=True)
 
-        return {'xdcr_lag': (t1 - t0) * 1000}  # s -> ms
+        return (t1 - t0) * 1000  # s -> ms
+
+    def record(self, bucket: str, group: int, src_client, dst_client, key: Key):
+        lag = self.measure(src_client, dst_client, key)
+        lags = {'xdcr_lag': lag, self.group_metric(group): lag}
+        self.store.append(lags,
+                          cluster=self.cluster,
+                          bucket=bucket,
+                          collector=self.COLLECTOR)
+        self.update_sketches(lags, bucket=bucket)
+
+    async def probe(self, bucket: str, group: int, num_vbuckets: int,
+                    src_client, dst_client):
+        loop = asyncio.get_event_loop()
+        while True:
+            t0 = time()
+            key = self.gen_key(group, num_vbuckets)
+            try:
+                # The SDK clients are blocking and must not be shared by threads
+                await loop.run_in_executor(None, self.record, bucket, group,
+                                           src_client, dst_client, key)
+            except Exception as e:
+                logger.warn('XDCR probe failed on {}: {}'.format(bucket, e))
+            await asyncio.sleep(max(t0 + self.MAX_SAMPLING_INTERVAL - time(), 0))
 
     def sample(self):
-        for bucket, src_client, dst_client in self.clients:
-            lags = self.measure(src_client, dst_client)
-            self.store.append(lags,
-                              cluster=self.cluster,
-                              bucket=bucket,
-                              collector=self.COLLECTOR)
+        pass
+
+    def collect(self):
+        self.handle_sigterm()
+        loop = asyncio.get_event_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=len(self.probes)))
+        try:
+            loop.run_until_complete(
+                asyncio.gather(*(self.probe(*probe) for probe in self.probes))
+            )
+        except KeyboardInterrupt:
+            sys.exit()
@@ -1,4 +1,6 @@
-from typing import Dict, List
+import json
+import os
+from typing import Dict, Iterable, List, Set
 
 import requests
 from decorator import decorator
@@ -33,6 +35,7 @@ class RestClient:
         r = self.session.post(url=url, data=data)
         if r.status_code == 500:
             raise InternalServerError(url)
+        return r
 
     @interrupt
     def get(self, url, params):
@@ -44,10 +47,15 @@ class RestClient:
 
 class MetadataClient(RestClient):
 
+    ROOT = 'metadata'  # Local record of the registered metrics
+
+    METRIC_FIELDS = 'name', 'bucket', 'index', 'server', 'collector'
+
     def __init__(self, settings):
         super(MetadataClient, self).__init__()
         self.settings = settings
         self.base_url = "http://{}/cbmonitor".format(settings.cbmonitor_host)
+        self.bulk_api = True
 
     def get_clusters(self) -> List[str]:
         url = self.base_url + "/get_clusters/"
@@ -120,6 +128,60 @@ class MetadataClient(RestClient):
                 data[extra_param] = eval(extra_param)
         self.post(url, data)
 
+    def record_path(self) -> str:
+        return os.path.join(self.ROOT, '{}.json'.format(self.settings.cluster))
+
+    def get_registered(self) -> Set[tuple]:
+        """Read the metrics already registered by any process of this run."""
+        try:
+            with open(self.record_path()) as fh:
+                return {tuple(json.loads(line)) for line in fh}
+        except FileNotFoundError:
+            return set()
+
+    def record(self, metrics: List[tuple]):
+        os.makedirs(self.ROOT, exist_ok=True)
+        lines = ''.join(json.dumps(metric) + '\n' for metric in metrics)
+        with open(self.record_path(), 'a') as fh:
+            fh.write(lines)  # A single write, the file is shared by processes
+
+    def add_metrics(self, names: Iterable[str], bucket: str = None,
+                    index: str = None, server: str = None,
+                    collector: str = None):
+        """Register many metrics of the same series with a single request.
+
+        The metrics that are already in the local record are skipped. The
+        metrics are registered one by one if cbmonitor does not support the
+        bulk API.
+        """
+        registered = self.get_registered()
+        metrics = [(name, bucket, index, server, collector) for name in names]
+        metrics = [metric for metric in metrics if metric not in registered]
+        if not metrics:
+            return
+
+        if self.bulk_api:
+            url = self.base_url + "/add_metrics/"
+            data = {
+                "cluster": self.settings.cluster,
+                "metrics": json.dumps([
+                    {field: value
+                     for field, value in zip(self.METRIC_FIELDS, metric)
+                     if value is not None}
+                    for metric in metrics
+                ]),
+            }
+            r = self.post(url, data)
+            if r is not None and r.status_code == 404:
+                logger.info('Bulk metric registration is not supported, '
+                            'registering the metrics one by one')
+                self.bulk_api = False
+        if not self.bulk_api:
+            for metric in metrics:
+                self.add_metric(*metric)
+
+        self.record(metrics)
+
     def add_snapshot(self, name: str):
         url = self.base_url + "/add_snapshot/"
         data = {"cluster": self.settings.cluster, "name": name}
@@ -0,0 +1,154 @@
+import asyncio
+import json
+import re
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+from threading import Lock
+from typing import Awaitable, Callable, Optional, Tuple
+
+# Numeric arrays with at least two elements, e.g. the per-second samples
+TAIL_PATTERN = re.compile(
+    r'\[(?:\s*(?:[-+\d.eE]+|null)\s*,)+\s*([-+\d.eE]+|null)\s*\]'
+)
+
+OK_STATUSES = 200, 201, 202
+
+NOT_MODIFIED = 304
+
+
+def parse_tail(text: str):
+    """Parse a stats response keeping only the last element of sample arrays.
+
+    The ns_server stats endpoints return up to a minute of samples per metric
+    while the collectors only store the most recent one. Dropping the other
+    samples before decoding saves about a third of the parsing time and most
+    of the memory used by the cached responses.
+    """
+    return json.loads(TAIL_PATTERN.sub(r'[\1]', text))
+
+
+Rule = namedtuple('Rule', ('pattern', 'ttl', 'parser'))
+
+Entry = namedtuple('Entry', ('body', 'etag', 'expires'))
+
+
+class ResponseCache:
+
+    """Cache the parsed REST responses shared by many collectors.
+
+    Only the paths that match one of RULES are cached. A response is reused
+    until its TTL expires, it is then revalidated with If-None-Match when the
+    server provided an ETag, a 304 reply reuses the parsed body. Concurrent
+    requests for the same key are sent once. Failed requests are not cached.
+
+    The parsed responses are shared and must not be modified.
+    """
+
+    TTL = 1.0  # Seconds
+
+    RULES = (
+        Rule(re.compile(r'/pools/default(/buckets)?$'), TTL, json.loads),
+        Rule(re.compile(r'/pools/default/buckets/[^/?]+/stats($|\?)'), TTL, parse_tail),
+        Rule(re.compile(r'/pools/default/overviewStats$'), TTL, parse_tail),
+        Rule(re.compile(r'/_uistats\?'), TTL, parse_tail),
+    )
+
+    def __init__(self, rules: Tuple[Rule, ...] = RULES):
+        self.rules = rules
+        self.lock = Lock()
+        self.entries = {}
+        self.futures = {}
+        self.tasks = {}
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def match(self, path: str) -> Optional[Rule]:
+        for rule in self.rules:
+            if rule.pattern.match(path):
+                return rule
+
+    def lookup(self, key: tuple) -> Tuple[Optional[Entry], bool]:
+        """Return the current entry and whether it can be used as is."""
+        entry = self.entries.get(key)
+        fresh = entry is not None and entry.expires > time.time()
+        if fresh:
+            self.hits += 1
+        return entry, fresh
+
+    def update(self, key: tuple, rule: Rule, entry: Optional[Entry],
+               status: Optional[int], etag: Optional[str], text: Optional[str]):
+        not_modified = status == NOT_MODIFIED and entry is not None
+        if not_modified:
+            body = entry.body
+        elif status in OK_STATUSES:
+            body = rule.parser(text)
+        else:
+            return None
+        with self.lock:
+            self.not_modified += not_modified
+            self.entries[key] = Entry(body, etag or entry and entry.etag,
+                                      time.time() + rule.ttl)
+        return body
+
+    @staticmethod
+    def headers(entry: Optional[Entry]) -> dict:
+        if entry is not None and entry.etag:
+            return {'If-None-Match': entry.etag}
+        return {}
+
+    def get(self, key: tuple, path: str, fetch: Callable):
+        """Return the parsed response or None if the request failed.
+
+        fetch(headers) must return the status, the ETag and the text of the
+        response. The status is None if the request failed.
+        """
+        rule = self.match(path)
+        with self.lock:
+            entry, fresh = self.lookup(key)
+            if fresh:
+                return entry.body
+            future = self.futures.get(key)
+            owner = future is None
+            if owner:
+                future = self.futures[key] = Future()
+                self.misses += 1
+            else:
+                self.hits += 1
+        if owner:
+            try:
+                future.set_result(self.update(key, rule, entry,
+                                              *fetch(self.headers(entry))))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self.lock:
+                    del self.futures[key]
+        return future.result()
+
+    async def _refresh_async(self, key: tuple, rule: Rule, entry: Optional[Entry],
+                             fetch: Callable[[dict], Awaitable]):
+        try:
+            return self.update(key, rule, entry, *await fetch(self.headers(entry)))
+        finally:
+            del self.tasks[key]
+
+    async def get_async(self, key: tuple, path: str, fetch: Callable[[dict], Awaitable]):
+        rule = self.match(path)
+        with self.lock:
+            entry, fresh = self.lookup(key)
+            if fresh:
+                return entry.body
+            task = self.tasks.get(key)
+            if task is None:
+                task = self.tasks[key] = asyncio.ensure_future(
+                    self._refresh_async(key, rule, entry, fetch))
+                self.misses += 1
+            else:
+                self.hits += 1
+        return await asyncio.shield(task)
+
+    def summary(self) -> str:
+        return 'REST response cache: {} hits, {} misses, {} not modified'\
+            .format(self.hits, self.misses, self.not_modified)
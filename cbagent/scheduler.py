@@ -0,0 +1,163 @@
+import asyncio
+import heapq
+import signal
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import aiohttp
+import requests
+
+from cbagent.collectors.collector import Collector
+from cbagent.responses import ResponseCache
+from logger import logger
+
+
+class SamplingStats:
+
+    def __init__(self):
+        self.samples = 0
+        self.overruns = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+
+    def update(self, lag: float, elapsed: float):
+        self.samples += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.total_lag += lag
+        self.max_lag = max(self.max_lag, lag)
+
+    def summary(self) -> str:
+        samples = self.samples or 1
+        return '{} samples, {} overruns, time {:.3f}s avg {:.3f}s max, ' \
+            'lag {:.3f}s avg {:.3f}s max'.format(self.samples, self.overruns,
+                                                 self.total_time / samples,
+                                                 self.max_time,
+                                                 self.total_lag / samples,
+                                                 self.max_lag)
+
+
+class CollectorScheduler:
+
+    """Run the periodic collectors in a single process and event loop.
+
+    Collectors are kept in a timer heap ordered by their next sampling time.
+    The ones that support async sampling run in the event loop, the others
+    run in a small thread pool. All collectors share the HTTP sessions, the
+    store and the REST response cache. A tick is skipped (overrun) when the
+    previous sample of the same collector is still running. The lag is the
+    delay between the planned and the actual start of a sample.
+    """
+
+    POOL_SIZE = 8  # Threads for the collectors that only have blocking sample()
+
+    REPORT_INTERVAL = 60  # Seconds
+
+    def __init__(self, collectors: List[Collector]):
+        self.collectors = collectors
+        self.responses = collectors[0].responses or ResponseCache()
+        self.stats = [SamplingStats() for _ in collectors]
+        self.tasks = {}
+
+        self.store = collectors[0].store
+        session = requests.Session()
+        for collector in collectors:
+            if self.store.changes is not None:
+                self.store.changes.intervals.update(collector.store.changes.intervals)
+            collector.responses = self.responses
+            collector.store = self.store
+            if not collector.cloud_enabled:
+                collector.session = session
+
+    @staticmethod
+    def can_schedule(collector: Collector) -> bool:
+        """Check that the collector relies on the default sampling loop."""
+        return type(collector).collect is Collector.collect
+
+    def report(self):
+        for collector, stats in zip(self.collectors, self.stats):
+            logger.info('{} ({}): {}'.format(collector.__class__.__name__,
+                                             collector.cluster,
+                                             stats.summary()))
+        logger.info(self.responses.summary())
+        if self.store.changes is not None:
+            logger.info(self.store.changes.summary())
+
+    def next_time(self, i: int, t: float, now: float) -> float:
+        interval = self.collectors[i].sampling_interval()
+        t += interval
+        while t <= now:  # Skip the ticks that are already over
+            t += interval
+            self.stats[i].overruns += 1
+        return t
+
+    def launch(self, i: int, planned: float):
+        task = self.tasks.get(i)
+        if task is not None and not task.done():
+            self.stats[i].overruns += 1
+            return
+        self.tasks[i] = asyncio.ensure_future(self.sample(i, planned))
+
+    async def sample(self, i: int, planned: float):
+        collector = self.collectors[i]
+        t0 = time.time()
+        try:
+            if collector.async_sampling:
+                await collector.sample_async()
+            else:
+                await asyncio.get_event_loop().run_in_executor(None, collector.sample)
+        except IndexError:
+            pass
+        except Exception as e:
+            logger.warn("Unexpected exception in {}: {}"
+                        .format(collector.__class__.__name__, e))
+        self.stats[i].update(lag=max(t0 - planned, 0), elapsed=time.time() - t0)
+
+    async def schedule(self):
+        loop = asyncio.get_event_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.POOL_SIZE))
+
+        semaphore = asyncio.Semaphore(Collector.MAX_CONCURRENCY)
+        auth = aiohttp.BasicAuth(*self.collectors[0].auth)
+        async with aiohttp.ClientSession(auth=auth) as session, \
+                aiohttp.ClientSession() as self.store.async_session:
+            for collector in self.collectors:
+                collector.async_session = session
+                collector.semaphore = semaphore
+
+            now = time.time()
+            timers = [(now, i) for i in range(len(self.collectors))]
+            report_time = now + self.REPORT_INTERVAL
+            while True:
+                delay = timers[0][0] - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                now = time.time()
+                while timers[0][0] <= now:
+                    planned, i = heapq.heappop(timers)
+                    self.launch(i, planned)
+                    heapq.heappush(timers, (self.next_time(i, planned, now), i))
+
+                if now >= report_time:
+                    self.report()
+                    report_time += self.REPORT_INTERVAL
+
+    def terminate(self, *args):
+        self.report()
+        self.store.flush()
+        for collector in self.collectors:
+            if collector.sketches is not None:
+                collector.sketches.dump()
+        sys.exit()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.terminate)
+        try:
+            asyncio.get_event_loop().run_until_complete(self.schedule())
+        except KeyboardInterrupt:
+            sys.exit()
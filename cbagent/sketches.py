@@ -0,0 +1,198 @@
+import json
+import math
+import os
+import time
+from threading import Lock
+from typing import Iterable, List, Optional
+from urllib.parse import quote
+
+import numpy as np
+
+
+class QuantileSketch:
+
+    """Estimate the quantiles of a stream with a relative error guarantee.
+
+    This is DDSketch (https://arxiv.org/abs/1908.10693): positive values are
+    counted in logarithmic bins (gamma^(i - 1), gamma^i] with
+    gamma = (1 + alpha) / (1 - alpha). Let x be the exact percentile with the
+    "lower" interpolation of numpy, i.e. the value of rank
+    floor(q / 100 * (n - 1)). The estimate then satisfies
+    |estimate - x| <= alpha * x. Values <= 0 are counted separately and
+    estimated as 0.
+
+    The memory usage only depends on the range of the values (about 1000 bins
+    for 1us to 1000s with the default alpha). Beyond MAX_BINS, the lowest
+    bins are collapsed, which only affects the accuracy of the lowest
+    percentiles. Sketches with the same alpha can be merged.
+    """
+
+    ALPHA = 0.01
+
+    MAX_BINS = 2048
+
+    def __init__(self, alpha: float = ALPHA):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def index(self, value: float) -> int:
+        return int(math.ceil(math.log(value) / self.log_gamma))
+
+    def value(self, index: int) -> float:
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self, value: float, count: int = 1):
+        self.count += count
+        if value <= 0:
+            self.zero_count += count
+            return
+        i = self.index(value)
+        self.bins[i] = self.bins.get(i, 0) + count
+        if len(self.bins) > self.MAX_BINS:
+            self.collapse()
+
+    def update(self, values: Iterable[float]):
+        """Add many values at once."""
+        values = np.asarray(values, dtype=np.float64)
+        positive = values[values > 0]
+        self.zero_count += values.size - positive.size
+        self.count += values.size
+        indexes = np.ceil(np.log(positive) / self.log_gamma).astype(np.int64)
+        for i, count in zip(*np.unique(indexes, return_counts=True)):
+            self.bins[int(i)] = self.bins.get(int(i), 0) + int(count)
+        if len(self.bins) > self.MAX_BINS:
+            self.collapse()
+
+    def collapse(self):
+        indexes = sorted(self.bins)
+        excess = indexes[:len(indexes) - self.MAX_BINS + 1]
+        self.bins[excess[-1]] += sum(self.bins.pop(i) for i in excess[:-1])
+
+    def merge(self, other: 'QuantileSketch'):
+        if other.alpha != self.alpha:
+            raise ValueError('Cannot merge sketches with different accuracy')
+        self.count += other.count
+        self.zero_count += other.zero_count
+        for i, count in other.bins.items():
+            self.bins[i] = self.bins.get(i, 0) + count
+        if len(self.bins) > self.MAX_BINS:
+            self.collapse()
+
+    def percentiles(self, qs: Iterable[float]) -> List[float]:
+        """Return the given percentiles, from 0 to 100."""
+        if not self.count:
+            raise ValueError('Empty sketch')
+        indexes = np.array(sorted(self.bins), dtype=np.int64)
+        cumulative = self.zero_count + np.cumsum(
+            [self.bins[i] for i in indexes.tolist()], dtype=np.int64)
+
+        estimates = []
+        for q in qs:
+            rank = math.floor(q / 100 * (self.count - 1))
+            if rank < self.zero_count:
+                estimates.append(0.0)
+                continue
+            i = int(np.searchsorted(cumulative, rank, side='right'))
+            estimates.append(self.value(int(indexes[min(i, indexes.size - 1)])))
+        return estimates
+
+    def percentile(self, q: float) -> float:
+        return self.percentiles([q])[0]
+
+    def to_dict(self) -> dict:
+        return {
+            'alpha': self.alpha,
+            'zero_count': self.zero_count,
+            'bins': {str(i): count for i, count in self.bins.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'QuantileSketch':
+        sketch = cls(data['alpha'])
+        sketch.zero_count = data['zero_count']
+        sketch.bins = {int(i): count for i, count in data['bins'].items()}
+        sketch.count = sketch.zero_count + sum(sketch.bins.values())
+        return sketch
+
+
+class SketchStore:
+
+    """Keep the quantile sketches of latency series in run-local files.
+
+    Every (db, metric) series has its own sketch file under ROOT/<db>/. The
+    sketches are written at most every DUMP_INTERVAL seconds and on dump().
+    A series must be updated by a single process, possibly from many threads,
+    which overwrites any file left from a previous run.
+    """
+
+    ROOT = 'sketches'
+
+    DUMP_INTERVAL = 5  # Seconds
+
+    def __init__(self, root: str = ROOT):
+        self.root = root
+        self.lock = Lock()
+        self.sketches = {}
+        self.dirty = set()
+        self.last_dump = time.time()
+
+    def path(self, db: str, metric: str) -> str:
+        return os.path.join(self.root, db, quote(metric, safe='') + '.json')
+
+    def update(self, db: str, data: dict):
+        with self.lock:
+            for metric, value in data.items():
+                key = db, metric
+                if key not in self.sketches:
+                    self.sketches[key] = QuantileSketch()
+                self.sketches[key].add(float(value))
+                self.dirty.add(key)
+
+            if time.time() - self.last_dump >= self.DUMP_INTERVAL:
+                self._dump()
+
+    def extend(self, db: str, metric: str, values: Iterable[float]):
+        """Add many values of the same series at once."""
+        with self.lock:
+            key = db, metric
+            if key not in self.sketches:
+                self.sketches[key] = QuantileSketch()
+            self.sketches[key].update(values)
+            self.dirty.add(key)
+
+    def dump(self):
+        with self.lock:
+            self._dump()
+
+    def _dump(self):
+        for db, metric in self.dirty:
+            path = self.path(db, metric)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'w') as fh:
+                json.dump(self.sketches[db, metric].to_dict(), fh)
+            os.replace(path + '.tmp', path)
+        self.dirty = set()
+        self.last_dump = time.time()
+
+    def load(self, db: str, metric: str) -> Optional[QuantileSketch]:
+        path = self.path(db, metric)
+        if not os.path.exists(path):
+            return None
+        with open(path) as fh:
+            return QuantileSketch.from_dict(json.load(fh))
+
+    def merged(self, dbs: Iterable[str], metric: str) -> Optional[QuantileSketch]:
+        """Merge the sketches of a metric across dbs, None if there is none."""
+        merged = None
+        for db in dbs:
+            sketch = self.sketches.get((db, metric)) or self.load(db, metric)
+            if sketch is None:
+                continue
+            if merged is None:
+                merged = QuantileSketch(sketch.alpha)
+            merged.merge(sketch)
+        return merged
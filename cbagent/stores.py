@@ -1,16 +1,198 @@
+import asyncio
 import json
-from typing import Dict, List
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import BoundedSemaphore, Lock, RLock
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import quote
 
+import numpy as np
 from requests import Session
 
 
+class SeriesCache:
+
+    """Keep a run-local columnar copy of the time series.
+
+    Every series is an append-only file of (timestamp, value) float64 pairs
+    under ROOT/<db>/. Each sample is appended with a single unbuffered write,
+    so collector processes can share the cache and nothing is lost when they
+    are terminated. Series are read back through memory maps.
+    """
+
+    ROOT = 'timeseries'
+
+    RECORD = np.dtype([('ts', '<f8'), ('value', '<f8')])
+
+    def __init__(self, root: str = ROOT):
+        self.root = root
+        self.dirs = set()
+
+    def path(self, db: str, metric: str) -> str:
+        return os.path.join(self.root, db, quote(metric, safe=''))
+
+    def append(self, db: str, data: dict, timestamp=None):
+        if db not in self.dirs:
+            os.makedirs(os.path.join(self.root, db), exist_ok=True)
+            self.dirs.add(db)
+
+        if timestamp is None:  # Stamped by the server otherwise
+            timestamp = time.time() * 1000
+        for metric, value in data.items():
+            try:
+                record = struct.pack('<dd', float(timestamp), float(value))
+            except (TypeError, ValueError):
+                continue
+            with open(self.path(db, metric), 'ab', buffering=0) as fh:
+                fh.write(record)
+
+    def extend(self, db: str, metric: str, timestamps: np.ndarray, values: np.ndarray):
+        """Append many samples of the same series with a single write."""
+        if db not in self.dirs:
+            os.makedirs(os.path.join(self.root, db), exist_ok=True)
+            self.dirs.add(db)
+
+        records = np.empty(len(values), dtype=self.RECORD)
+        records['ts'] = timestamps
+        records['value'] = values
+        with open(self.path(db, metric), 'ab', buffering=0) as fh:
+            fh.write(records.tobytes())
+
+    def load(self, db: str, metric: str) -> Optional[np.ndarray]:
+        """Return the values of the series in time order, None if it is unknown."""
+        series = self.load_series(db, metric)
+        if series is not None:
+            return series[1]
+
+    def load_series(self, db: str, metric: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Return the timestamps and values of the series in time order."""
+        path = self.path(db, metric)
+        if not os.path.exists(path):
+            return None
+        size = os.path.getsize(path) // self.RECORD.itemsize
+        if not size:
+            return np.empty(0), np.empty(0)
+
+        records = np.memmap(path, dtype=self.RECORD, mode='r', shape=(size,))
+        timestamps = records['ts']
+        if np.all(timestamps[1:] >= timestamps[:-1]):
+            return timestamps, records['value']
+        order = np.argsort(timestamps, kind='mergesort')
+        return timestamps[order], records['value'][order]
+
+
+def time_weighted(timestamps: np.ndarray, values: np.ndarray,
+                  max_points: int = 10 ** 6) -> np.ndarray:
+    """Resample a step series so that every value counts as long as it lasted.
+
+    Every value holds until the next timestamp, so it is repeated once per
+    shortest gap between two samples. A series sampled at a fixed interval
+    is returned as is, while the runs that ChangeFilter collapsed are
+    expanded back.
+    """
+    gaps = np.diff(timestamps)
+    gaps = np.maximum(gaps, 0)
+    if not np.any(gaps):
+        return values
+    step = max(gaps[gaps > 0].min(), (timestamps[-1] - timestamps[0]) / max_points)
+    repeats = np.maximum(np.rint(gaps / step), 1).astype(np.int64)
+    return np.repeat(values, np.append(repeats, 1))
+
+
+class ChangeFilter:
+
+    """Drop the samples that repeat the previous value of a series.
+
+    A run of equal values is written as its first and last samples, plus one
+    sample every max interval, so that the series can be reconstructed as a
+    step function. Since the last sample of a run is only known when the
+    value changes, all samples are written with explicit timestamps.
+
+    The min and max intervals can be set per metric. When a value moves by
+    more than THRESHOLD (relative), the collector is asked to sample at the
+    min interval of that metric until its values settle.
+    """
+
+    THRESHOLD = 0.05
+
+    def __init__(self, min_interval: float, max_interval: float,
+                 threshold: float = THRESHOLD):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.threshold = threshold
+        self.intervals = {}  # (collector, metric) -> (min, max)
+        self.series = {}  # (db, metric) -> [value, last seen, last written]
+        self.requests = {}  # (cluster, collector) -> requested interval
+        self.lock = Lock()
+        self.written = 0
+        self.suppressed = 0
+
+    def set_intervals(self, collector: str, intervals: Dict[str, Tuple[float, float]]):
+        with self.lock:
+            for metric, (min_interval, max_interval) in intervals.items():
+                self.intervals[collector, metric] = min_interval, max_interval
+
+    def moved(self, last, value) -> bool:
+        try:
+            return abs(value - last) > self.threshold * abs(last)
+        except TypeError:
+            return False
+
+    def filter(self, db: str, data: dict, cluster: str, collector: str,
+               now: float) -> List[Tuple[int, dict]]:
+        """Return the (timestamp, data) pairs to write for a new sample."""
+        run_ends = {}
+        changes = {}
+        with self.lock:
+            for metric, value in data.items():
+                min_interval, max_interval = self.intervals.get(
+                    (collector, metric), (self.min_interval, self.max_interval))
+                state = self.series.get((db, metric))
+                if state is not None:
+                    last, seen, written = state
+                    if value == last and now - written < max_interval:
+                        state[1] = now
+                        self.suppressed += 1
+                        continue
+                    if value != last:
+                        if seen > written:
+                            run_ends.setdefault(seen, {})[metric] = last
+                        if self.moved(last, value):
+                            key = cluster, collector
+                            self.requests[key] = min(
+                                self.requests.get(key, min_interval), min_interval)
+                self.series[db, metric] = [value, now, now]
+                changes[metric] = value
+
+            points = sorted(run_ends.items())
+            if changes:
+                points.append((now, changes))
+            self.written += sum(len(data) for _, data in points)
+        return [(int(ts * 1000), data) for ts, data in points]
+
+    def pop_interval(self, cluster: str, collector: str) -> Optional[float]:
+        """Return the interval requested since the last call, if any."""
+        with self.lock:
+            return self.requests.pop((cluster, collector), None)
+
+    def summary(self) -> str:
+        return 'Change filter: {} values written, {} suppressed'\
+            .format(self.written, self.suppressed)
+
+
 class PerfStore:
 
-    def __init__(self, host: str):
+    def __init__(self, host: str, cache: SeriesCache = None,
+                 changes: ChangeFilter = None):
         self.session = Session()
         self.async_session = None
         self.base_url = 'http://{}:8080'.format(host)
         self.dbs = set()
+        self.cache = cache
+        self.changes = changes
+        self.arrays = {}  # type: Dict[tuple, np.ndarray]
 
     @staticmethod
     def build_dbname(cluster: str,
@@ -41,6 +223,52 @@ class PerfStore:
         data = self.session.get(url).json()
         return [d[1] for d in data]
 
+    def get_series(self, db: str, metric: str) -> Tuple[np.ndarray, np.ndarray]:
+        url = '{}/{}/{}'.format(self.base_url, db, metric)
+        data = self.session.get(url).json()
+        timestamps = np.array([d[0] for d in data], dtype=np.float64)
+        values = np.array([d[1] for d in data], dtype=np.float64)
+        order = np.argsort(timestamps, kind='mergesort')
+        return timestamps[order], values[order]
+
+    def get_array(self, db: str, metric: str) -> np.ndarray:
+        """Return the values of the series, fetching every series only once.
+
+        Series are read from the local cache when it has them.
+        """
+        key = db, metric
+        if key not in self.arrays:
+            values = None
+            if self.cache is not None:
+                values = self.cache.load(db, metric)
+            if values is None:
+                values = np.array(self.get_values(db, metric), dtype=np.float64)
+            self.arrays[key] = values
+        return self.arrays[key]
+
+    def get_weighted_array(self, db: str, metric: str) -> np.ndarray:
+        """Return the values of a gauge series weighted by their duration.
+
+        Use it for the KPIs of the series that may go through ChangeFilter,
+        which keeps fewer samples of the values that do not change.
+        """
+        key = db, metric, 'weighted'
+        if key not in self.arrays:
+            series = None
+            if self.cache is not None:
+                series = self.cache.load_series(db, metric)
+            if series is None:
+                series = self.get_series(db, metric)
+            self.arrays[key] = time_weighted(*series)
+        return self.arrays[key]
+
+    def get_percentiles(self, dbs: Iterable[str], metric: str,
+                        percentiles: Iterable[float], weighted: bool = False) -> List[float]:
+        """Compute several percentiles of the series of all dbs at once."""
+        get_array = self.get_weighted_array if weighted else self.get_array
+        values = np.concatenate([get_array(db, metric) for db in dbs])
+        return np.percentile(values, list(percentiles)).tolist()
+
     def get_summary(self, db: str, metric: str) -> Dict[str, float]:
         url = '{}/{}/{}/summary'.format(self.base_url, db, metric)
         return self.session.get(url).json()
@@ -58,12 +286,161 @@ class PerfStore:
                 urls.append(url)
         return urls
 
+    def prepare(self, db: str, data: dict, cluster: str, collector: str,
+                timestamp) -> List[tuple]:
+        """Cache a sample and return the (timestamp, data) pairs to write.
+
+        Only live samples (without timestamp) go through the change filter.
+        """
+        if self.cache is not None:
+            self.cache.append(db, data, timestamp)
+        if self.changes is None or timestamp is not None:
+            return [(timestamp, data)]
+        return self.changes.filter(db, data, cluster, collector, time.time())
+
+    def append(self, data, cluster=None, server=None, bucket=None, index=None,
+               collector=None, timestamp=None):
+        db = self.build_dbname(cluster, server, bucket, index, collector)
+        for timestamp, data in self.prepare(db, data, cluster, collector, timestamp):
+            self.push(db, data, timestamp)
+
+    async def append_async(self, data, cluster=None, server=None, bucket=None,
+                           index=None, collector=None, timestamp=None):
+        db = self.build_dbname(cluster, server, bucket, index, collector)
+        for timestamp, data in self.prepare(db, data, cluster, collector, timestamp):
+            await self.async_push(db, data, timestamp)
+
+    def flush(self):
+        pass
+
+    async def flush_async(self):
+        pass
+
+
+class BufferedPerfStore(PerfStore):
+
+    """Group timestamped samples per db and post them in bulk requests.
+
+    A batch is sent as soon as it has MAX_BATCH samples or its oldest sample
+    is MAX_AGE seconds old. At most MAX_IN_FLIGHT requests are outstanding,
+    appending blocks (or awaits) until one of them completes. Samples without
+    an explicit timestamp are stamped by the server on arrival, so they are
+    still posted one by one.
+    """
+
+    MAX_BATCH = 1000
+
+    MAX_AGE = 5  # Seconds
+
+    MAX_IN_FLIGHT = 8
+
+    def __init__(self, host: str, cache: SeriesCache = None,
+                 changes: ChangeFilter = None):
+        super().__init__(host, cache, changes)
+        self.batches = {}  # type: dict
+        self.created = {}  # type: dict
+        # The SIGTERM handler flushes the store and may interrupt add()
+        self.lock = RLock()
+
+        self.executor = ThreadPoolExecutor(max_workers=self.MAX_IN_FLIGHT)
+        self.slots = BoundedSemaphore(self.MAX_IN_FLIGHT)
+        self.futures = set()
+
+        self.semaphore = None
+        self.tasks = set()
+
+    def bulk_push(self, db: str, batch: List[dict]):
+        url = '{}/{}'.format(self.base_url, db)
+        try:
+            self.session.post(url=url, data=json.dumps(batch))
+        finally:
+            self.slots.release()
+
+    async def async_bulk_push(self, db: str, batch: List[dict]):
+        url = '{}/{}'.format(self.base_url, db)
+        try:
+            async with self.async_session.post(url=url, json=batch) as response:
+                return await response.json()
+        finally:
+            self.semaphore.release()
+
+    def add(self, db: str, data: dict, timestamp) -> List[dict]:
+        """Buffer a sample and return the batch of the db if it is due."""
+        now = time.time()
+        with self.lock:
+            batch = self.batches.setdefault(db, [])
+            if not batch:
+                self.created[db] = now
+            batch.append({'ts': timestamp, 'data': data})
+            if len(batch) >= self.MAX_BATCH or \
+                    now - self.created[db] >= self.MAX_AGE:
+                return self.batches.pop(db)
+        return []
+
+    def pop_all(self) -> Dict[str, List[dict]]:
+        with self.lock:
+            batches, self.batches = self.batches, {}
+        return batches
+
+    def submit(self, db: str, batch: List[dict]):
+        self.slots.acquire()
+        future = self.executor.submit(self.bulk_push, db, batch)
+        self.futures.add(future)
+        future.add_done_callback(self.futures.discard)
+
+    async def submit_async(self, db: str, batch: List[dict]):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.MAX_IN_FLIGHT)
+        await self.semaphore.acquire()
+        task = asyncio.ensure_future(self.async_bulk_push(db, batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
     def append(self, data, cluster=None, server=None, bucket=None, index=None,
                collector=None, timestamp=None):
+        if timestamp is None and self.changes is None:
+            return super().append(data, cluster, server, bucket, index,
+                                  collector, timestamp)
         db = self.build_dbname(cluster, server, bucket, index, collector)
-        self.push(db, data, timestamp)
+        for timestamp, data in self.prepare(db, data, cluster, collector, timestamp):
+            batch = self.add(db, data, timestamp)
+            if batch:
+                self.submit(db, batch)
 
     async def append_async(self, data, cluster=None, server=None, bucket=None,
                            index=None, collector=None, timestamp=None):
+        if timestamp is None and self.changes is None:
+            return await super().append_async(data, cluster, server, bucket,
+                                              index, collector, timestamp)
         db = self.build_dbname(cluster, server, bucket, index, collector)
-        return await self.async_push(db, data, timestamp)
+        for timestamp, data in self.prepare(db, data, cluster, collector, timestamp):
+            batch = self.add(db, data, timestamp)
+            if batch:
+                await self.submit_async(db, batch)
+
+    async def extend_async(self, db: str, metric: str, timestamps: np.ndarray,
+                           values: np.ndarray):
+        """Post the timestamped values of a series in MAX_BATCH bulk requests."""
+        if self.cache is not None:
+            self.cache.extend(db, metric, timestamps, values)
+        timestamps, values = timestamps.tolist(), values.tolist()
+        for i in range(0, len(values), self.MAX_BATCH):
+            batch = [{'ts': timestamp, 'data': {metric: value}}
+                     for timestamp, value in zip(timestamps[i:i + self.MAX_BATCH],
+                                                 values[i:i + self.MAX_BATCH])]
+            await self.submit_async(db, batch)
+
+    def flush(self):
+        """Send all buffered samples and wait for the pending requests."""
+        for db, batch in self.pop_all().items():
+            self.submit(db, batch)
+        for future in wait(list(self.futures)).done:
+            future.result()
+
+    async def flush_async(self):
+        """Send all buffered samples and await the pending requests."""
+        for db, batch in self.pop_all().items():
+            await self.submit_async(db, batch)
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
+        self.semaphore = None  # Bound to the current event loop
@@ -1,3 +1,4 @@
+import shutil
 import time
 from collections import OrderedDict
 from copy import copy
@@ -47,7 +48,10 @@ from cbagent.collectors import (
     XdcrStats,
 )
 from cbagent.metadata_client import MetadataClient
-from cbagent.stores import PerfStore
+from cbagent.responses import ResponseCache
+from cbagent.scheduler import CollectorScheduler
+from cbagent.sketches import SketchStore
+from cbagent.stores import PerfStore, SeriesCache
 from logger import logger
 from perfrunner.helpers.misc import pretty_dict, uhex
 from perfrunner.settings import CBMONITOR_HOST
@@ -93,6 +97,16 @@ def new_cbagent_settings(test: PerfTest):
         'client_processes': test.test_config.stats_settings.client_processes,
         'server_processes': test.test_config.stats_settings.server_processes,
         'traced_processes': test.test_config.stats_settings.traced_processes,
+        'buffered_store': test.test_config.stats_settings.buffered_store,
+        'async_sampling': test.test_config.stats_settings.async_sampling,
+        'stats_agent': test.test_config.stats_settings.stats_agent,
+        'shared_runtime': test.test_config.stats_settings.shared_runtime,
+        'local_cache': test.test_config.stats_settings.local_cache,
+        'sketches': test.test_config.stats_settings.sketches,
+        'response_cache': test.test_config.stats_settings.response_cache,
+        'adaptive_sampling': test.test_config.stats_settings.adaptive_sampling,
+        'observe_rate': test.test_config.stats_settings.observe_rate,
+        'observe_probes': test.test_config.stats_settings.observe_probes,
         'bucket_password': test.test_config.bucket.password,
         'workers': test.cluster_spec.workers,
         'cloud': {"enabled": False}
@@ -125,6 +139,7 @@ class CbAgent:
         self.test = test
         self.settings = new_cbagent_settings(test=test)
         if self.test.test_config.stats_settings.enabled:
+            self.clear_local_data()
             self.init_clusters(phase=phase)
             self.add_collectors(**test.COLLECTORS)
             self.update_metadata()
@@ -140,6 +155,12 @@ class CbAgent:
             # self.find_time_series()
             self.add_snapshots()
 
+    @staticmethod
+    def clear_local_data():
+        """Remove the run-local series, sketches and metadata of the previous phases."""
+        for root in SeriesCache.ROOT, SketchStore.ROOT, MetadataClient.ROOT:
+            shutil.rmtree(root, ignore_errors=True)
+
     def init_clusters(self, phase: str):
         self.cluster_map = OrderedDict()
 
@@ -323,7 +344,20 @@ class CbAgent:
 
     def start(self):
         logger.info('Starting stats collectors')
-        self.processes = [Process(target=c.collect) for c in self.collectors]
+        collectors = self.collectors
+        self.processes = []
+        if self.settings.response_cache:
+            # Every collector process gets its own copy of the cache
+            responses = ResponseCache()
+            for collector in collectors:
+                collector.responses = responses
+        if self.settings.shared_runtime:
+            scheduled = [c for c in collectors if CollectorScheduler.can_schedule(c)]
+            collectors = [c for c in collectors if c not in scheduled]
+            if scheduled:
+                scheduler = CollectorScheduler(scheduled)
+                self.processes.append(Process(target=scheduler.run))
+        self.processes += [Process(target=c.collect) for c in collectors]
         for p in self.processes:
             p.start()
 
@@ -337,6 +371,7 @@ class CbAgent:
         for collector in self.collectors:
             if hasattr(collector, 'reconstruct'):
                 collector.reconstruct()
+                collector.store.flush()
 
     def trigger_report(self, snapshot: str):
         url = 'http://{}/reports/html/?snapshot={}'.format(
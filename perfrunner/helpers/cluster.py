@@ -1,7 +1,9 @@
 import re
+from functools import partial
 from typing import List
 
 from logger import logger
+from perfrunner.helpers.concurrency import TaskGraph
 from perfrunner.helpers.memcached import MemcachedHelper
 from perfrunner.helpers.misc import maybe_atoi, pretty_dict
 from perfrunner.helpers.monitor import Monitor
@@ -201,27 +203,39 @@ class ClusterManager:
     def add_nodes(self):
         if self.dynamic_infra:
             return
+        graph = TaskGraph()
         for (_, servers), initial_nodes \
                 in zip(self.cluster_spec.clusters, self.initial_nodes):
 
                 if initial_nodes < 2:  # Single-node cluster
                     continue
 
+                # Nodes join one at a time, clusters are independent
                 master = servers[0]
+                after = ()
                 for node in servers[1:initial_nodes]:
                     roles = self.cluster_spec.roles[node]
-                    self.rest.add_node(master, node, roles)
+                    after = [graph.add(('add_node', node),
+                                       partial(self.rest.add_node, master, node, roles),
+                                       after=after)]
+        graph.run()
 
     def rebalance(self):
         if self.dynamic_infra:
             return
+        graph = TaskGraph()
         for (_, servers), initial_nodes \
                 in zip(self.cluster_spec.clusters, self.initial_nodes):
             master = servers[0]
             known_nodes = servers[:initial_nodes]
             ejected_nodes = []
-            self.rest.rebalance(master, known_nodes, ejected_nodes)
-            self.monitor.monitor_rebalance(master)
+            start = graph.add(('rebalance', master),
+                              partial(self.rest.rebalance, master, known_nodes,
+                                      ejected_nodes))
+            graph.add(('monitor', master),
+                      partial(self.monitor.monitor_rebalance, master),
+                      after=[start])
+        graph.run()
         self.wait_until_healthy()
 
     def increase_bucket_limit(self, num_buckets: int):
@@ -258,9 +272,12 @@ class ClusterManager:
         else:
             if self.test_config.bucket.backend_storage == 'magma':
                 self.enable_developer_preview()
+            graph = TaskGraph()
             for master in self.cluster_spec.masters:
+                after = ()
                 for bucket_name in self.test_config.buckets:
-                    self.rest.create_bucket(
+                    after = [graph.add(('create_bucket', master, bucket_name), partial(
+                        self.rest.create_bucket,
                         host=master,
                         name=bucket_name,
                         ram_quota=per_bucket_quota,
@@ -272,41 +289,61 @@ class ClusterManager:
                         backend_storage=self.test_config.bucket.backend_storage,
                         conflict_resolution_type=self.test_config.bucket.conflict_resolution_type,
                         compression_mode=self.test_config.bucket.compression_mode,
-                    )
+                    ), after=after)]
+            graph.run()
 
     def create_collections(self):
         if self.dynamic_infra:
             return
         collection_map = self.test_config.collection.collection_map
+        if collection_map is None:
+            return
+        graph = TaskGraph()
         for master in self.cluster_spec.masters:
-            if collection_map is not None:
-                if self.test_config.collection.use_bulk_api:
-                    for bucket in collection_map.keys():
-                        create_scopes = []
-                        for scope in collection_map[bucket]:
-                            scope_collections = []
-                            for collection in collection_map[bucket][scope]:
-                                scope_collections.append({"name": collection})
-                            create_scopes.append({"name": scope, "collections": scope_collections})
-                        self.rest.set_collection_map(master, bucket, {"scopes": create_scopes})
-                else:
-                    for bucket in collection_map.keys():
-                        delete_default = True
-                        for scope in collection_map[bucket]:
-                            if scope == '_default':
-                                for collection in collection_map[bucket][scope]:
-                                    if collection == "_default":
-                                        delete_default = False
-                        if delete_default:
-                            self.rest.delete_collection(master, bucket, '_default', '_default')
-
-                    for bucket in collection_map.keys():
-                        for scope in collection_map[bucket]:
-                            if scope != '_default':
-                                self.rest.create_scope(master, bucket, scope)
+            if self.test_config.collection.use_bulk_api:
+                for bucket in collection_map.keys():
+                    create_scopes = []
+                    for scope in collection_map[bucket]:
+                        scope_collections = []
+                        for collection in collection_map[bucket][scope]:
+                            scope_collections.append({"name": collection})
+                        create_scopes.append({"name": scope, "collections": scope_collections})
+                    graph.add(('set_collection_map', master, bucket),
+                              partial(self.rest.set_collection_map, master, bucket,
+                                      {"scopes": create_scopes}))
+            else:
+                cleanup = {}
+                for bucket in collection_map.keys():
+                    cleanup[bucket] = ()
+                    delete_default = True
+                    for scope in collection_map[bucket]:
+                        if scope == '_default':
                             for collection in collection_map[bucket][scope]:
-                                if collection != '_default':
-                                    self.rest.create_collection(master, bucket, scope, collection)
+                                if collection == "_default":
+                                    delete_default = False
+                    if delete_default:
+                        cleanup[bucket] = [graph.add(
+                            ('delete_collection', master, bucket),
+                            partial(self.rest.delete_collection, master, bucket,
+                                    '_default', '_default'))]
+
+                # Every bucket is independent, collections follow their scope
+                for bucket in collection_map.keys():
+                    for scope in collection_map[bucket]:
+                        after = cleanup[bucket]
+                        if scope != '_default':
+                            after = [graph.add(('create_scope', master, bucket, scope),
+                                               partial(self.rest.create_scope,
+                                                       master, bucket, scope),
+                                               after=after)]
+                        for collection in collection_map[bucket][scope]:
+                            if collection != '_default':
+                                graph.add(('create_collection', master, bucket, scope,
+                                           collection),
+                                          partial(self.rest.create_collection,
+                                                  master, bucket, scope, collection),
+                                          after=after)
+        graph.run()
 
     def create_eventing_buckets(self):
         if not self.test_config.cluster.eventing_bucket_mem_quota:
@@ -404,10 +441,7 @@ class ClusterManager:
     def tweak_memory(self):
         if self.dynamic_infra:
             return
-        self.remote.reset_swap()
-        self.remote.drop_caches()
-        self.remote.set_swappiness()
-        self.remote.disable_thp()
+        self.remote.tweak_memory()
 
     def enable_n2n_encryption(self):
         if self.dynamic_infra:
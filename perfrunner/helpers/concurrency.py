@@ -0,0 +1,68 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Hashable, Iterable
+
+
+class TaskGraph:
+
+    """Run independent operations concurrently, in dependency order.
+
+    Every task starts in a bounded thread pool as soon as the tasks it
+    depends on are complete. Dependencies must be added first, so the graph
+    cannot have cycles. When a task fails, the tasks that have not started
+    are dropped and the first error is raised once the running tasks are
+    complete. This includes SystemExit from logger.interrupt.
+    """
+
+    MAX_WORKERS = 8
+
+    def __init__(self, max_workers: int = MAX_WORKERS):
+        self.max_workers = max_workers
+        self.tasks = {}
+
+    def add(self, key: Hashable, task: Callable[[], Any],
+            after: Iterable[Hashable] = ()) -> Hashable:
+        after = tuple(after)
+        for dependency in after:
+            if dependency not in self.tasks:
+                raise ValueError('Unknown dependency: {}'.format(dependency))
+        if key in self.tasks:
+            raise ValueError('Duplicate task: {}'.format(key))
+        self.tasks[key] = task, after
+        return key
+
+    def run(self) -> Dict[Hashable, Any]:
+        """Run all tasks and return their results."""
+        pending = dict(self.tasks)
+        self.tasks = {}
+        results = {}
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while running or pending and error is None:
+                if error is None:
+                    ready = [key for key, (_, after) in pending.items()
+                             if all(dependency in results for dependency in after)]
+                    for key in ready:
+                        task, _ = pending.pop(key)
+                        running[executor.submit(task)] = key
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key = running.pop(future)
+                    try:
+                        results[key] = future.result()
+                    except BaseException as e:
+                        if error is None:
+                            error = e
+        if error is not None:
+            raise error
+        return results
+
+
+def run_concurrently(tasks: Iterable[Callable[[], Any]],
+                     max_workers: int = TaskGraph.MAX_WORKERS) -> list:
+    """Run independent tasks and return their results in order."""
+    graph = TaskGraph(max_workers)
+    keys = [graph.add(i, task) for i, task in enumerate(tasks)]
+    results = graph.run()
+    return [results[key] for key in keys]
@@ -0,0 +1,153 @@
+import time
+from collections import OrderedDict, namedtuple
+from itertools import groupby
+from typing import Dict, List, Optional
+
+from logger import logger
+
+DEFAULT = '_default'
+
+READY = 'Ready'
+
+CREATED = 'Created'  # Deferred indexes that have not been built yet
+
+IndexDefinition = namedtuple('IndexDefinition', ('bucket', 'scope', 'collection',
+                                                 'name', 'fields', 'where'))
+
+
+def index_definitions(indexes: dict, bucket: str = None) -> List[IndexDefinition]:
+    """Flatten the index settings.
+
+    The settings either map the index names to their definitions for a single
+    bucket, or are nested by bucket, scope and collection. A definition is a
+    list of fields optionally followed by a WHERE clause, e.g. "a,b:a > 1".
+    """
+    if bucket is not None:
+        indexes = {bucket: {DEFAULT: {DEFAULT: indexes}}}
+
+    definitions = []
+    for bucket_name, scope_map in indexes.items():
+        for scope_name, collection_map in scope_map.items():
+            for collection_name, index_map in collection_map.items():
+                for index_name, index_def in index_map.items():
+                    fields, _, where = index_def.partition(':')
+                    definitions.append(IndexDefinition(bucket_name, scope_name,
+                                                       collection_name, index_name,
+                                                       fields.split(','), where or None))
+    return definitions
+
+
+def index_key(definition) -> tuple:
+    return definition.bucket, definition.scope, definition.collection, definition.name
+
+
+def keyspace(definition: IndexDefinition) -> str:
+    if definition.scope == DEFAULT and definition.collection == DEFAULT:
+        return definition.bucket
+    return '{}:{}:{}'.format(definition.bucket, definition.scope, definition.collection)
+
+
+def index_states(status: dict) -> Dict[tuple, str]:
+    """Map every index in the getIndexStatus response to its status.
+
+    An index with several entries (e.g., replicas) is only ready when all of
+    them are.
+    """
+    states = {}
+    for entry in status.get('status', []):
+        key = (entry.get('bucket'), entry.get('scope', DEFAULT),
+               entry.get('collection', DEFAULT), entry.get('name'))
+        if states.get(key, READY) == READY:
+            states[key] = entry.get('status')
+    return states
+
+
+def build_groups(definitions: List[IndexDefinition]) -> List[List[IndexDefinition]]:
+    """Group the indexes by keyspace.
+
+    The indexes of a keyspace that are built in a single request share one
+    DCP stream.
+    """
+    definitions = sorted(definitions, key=keyspace)
+    return [list(group) for _, group in groupby(definitions, key=keyspace)]
+
+
+class IndexProvisioningError(Exception):
+    pass
+
+
+class IndexProvisioner:
+
+    """Create and build deferred secondary indexes, resuming after failures.
+
+    The indexer rejects concurrent DDL statements on the same bucket, so the
+    statements of each bucket are sent as one sequential batch and the
+    buckets are processed concurrently. Every attempt starts with a single
+    getIndexStatus request and skips the indexes that already exist or are
+    already built, so a failed attempt resumes where it stopped.
+    """
+
+    MAX_ATTEMPTS = 3
+
+    RETRY_DELAY = 10  # Seconds before the second attempt, doubled after that
+
+    def __init__(self, remote, monitor, index_node: str, storage: Optional[str],
+                 batch_process: bool = True):
+        self.remote = remote
+        self.monitor = monitor
+        self.index_node = index_node
+        self.storage = storage
+        self.batch_process = batch_process
+
+    @staticmethod
+    def by_bucket(definitions: List[IndexDefinition]) -> Dict[str, List[IndexDefinition]]:
+        buckets = OrderedDict()
+        for definition in definitions:
+            buckets.setdefault(definition.bucket, []).append(definition)
+        return buckets
+
+    def pending(self, definitions: List[IndexDefinition]) -> List[IndexDefinition]:
+        """Return the indexes that do not exist yet."""
+        states = self.monitor.get_index_states(self.index_node)
+        return [d for d in definitions if index_key(d) not in states]
+
+    def deferred(self, definitions: List[IndexDefinition]) -> List[IndexDefinition]:
+        """Return the indexes that have not been built yet."""
+        states = self.monitor.get_index_states(self.index_node)
+        return [d for d in definitions if states.get(index_key(d), CREATED) == CREATED]
+
+    def attempt(self, select, step, definitions: List[IndexDefinition]):
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            remaining = select(definitions)
+            if not remaining:
+                return
+            try:
+                step(remaining)
+                return
+            except IndexProvisioningError as e:
+                logger.warn('Attempt {} of {} failed: {}'.format(attempt,
+                                                                 self.MAX_ATTEMPTS, e))
+                if attempt < self.MAX_ATTEMPTS:
+                    time.sleep(self.RETRY_DELAY * 2 ** (attempt - 1))
+        logger.interrupt('Failed to provision indexes after {} attempts'
+                         .format(self.MAX_ATTEMPTS))
+
+    def create_indexes(self, definitions: List[IndexDefinition]):
+        logger.info('Creating {} indexes'.format(len(definitions)))
+        self.remote.create_indexes(self.index_node, self.by_bucket(definitions),
+                                   self.storage, self.batch_process)
+
+    def build_indexes(self, definitions: List[IndexDefinition]):
+        buckets = OrderedDict(
+            (bucket, build_groups(bucket_definitions))
+            for bucket, bucket_definitions in self.by_bucket(definitions).items()
+        )
+        logger.info('Building {} indexes in {} groups'.format(
+            len(definitions), sum(len(groups) for groups in buckets.values())))
+        self.remote.build_indexes(self.index_node, buckets)
+
+    def create(self, definitions: List[IndexDefinition]):
+        self.attempt(self.pending, self.create_indexes, definitions)
+
+    def build(self, definitions: List[IndexDefinition]):
+        self.attempt(self.deferred, self.build_indexes, definitions)
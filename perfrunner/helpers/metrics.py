@@ -1,11 +1,14 @@
 import glob
 import os
-from typing import Dict, List, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 import numpy as np
 
-from cbagent.stores import PerfStore
+from cbagent.collectors.latency import KVLatency, QueryLatency
+from cbagent.sketches import SketchStore
+from cbagent.stores import PerfStore, SeriesCache
 from logger import logger
+from perfrunner.helpers.monitor import ProgressTrace
 from perfrunner.settings import CBMONITOR_HOST
 from perfrunner.workloads.bigfun.query_gen import Query
 
@@ -44,7 +47,68 @@ class MetricHelper:
         if self.test.dynamic_infra:
             self.store = None
         else:
-            self.store = PerfStore(CBMONITOR_HOST)
+            cache = None
+            if self.test_config.stats_settings.local_cache:
+                cache = SeriesCache()
+            self.store = PerfStore(CBMONITOR_HOST, cache)
+
+        self.sketches = None
+        if self.test_config.stats_settings.sketches:
+            self.sketches = SketchStore()
+
+        # Adaptive sampling keeps fewer samples of the values that do not
+        # change, so the gauge KPIs weight every value by the time it lasted
+        self.weighted = bool(self.test_config.stats_settings.adaptive_sampling)
+
+    def _bucket_dbs(self, collector: str) -> List[str]:
+        return [
+            self.store.build_dbname(cluster=self.test.cbmonitor_clusters[0],
+                                    collector=collector,
+                                    bucket=bucket)
+            for bucket in self.test_config.buckets
+        ]
+
+    def _latency_percentile(self, dbs: List[str], metric: str, percentile: Number,
+                            sketches: SketchStore = None) -> float:
+        """Read the percentile from the merged sketches when they exist.
+
+        The relative error of the estimate is at most QuantileSketch.ALPHA.
+        """
+        if sketches is None:
+            sketches = self.sketches
+        if sketches is not None:
+            sketch = sketches.merged(dbs, metric)
+            if sketch is not None:
+                logger.info('Number of samples are {}'.format(sketch.count))
+                return sketch.percentile(percentile)
+        return self.store.get_percentiles(dbs, metric, [percentile])[0]
+
+    def _observer_sketches(self) -> SketchStore:
+        """Return the sketches of the observers, recorded whatever the option."""
+        if self.sketches is not None:
+            return self.sketches
+        return SketchStore()
+
+    @staticmethod
+    def _histogram_percentile(collector: str, metric: str,
+                              percentile: Number) -> Optional[float]:
+        """Read the percentile from the merged latency histograms of the workers.
+
+        The histograms hold every measurement, unlike the samples that are
+        posted to cbmonitor.
+        """
+        for latency_collector in KVLatency, QueryLatency:
+            if latency_collector.COLLECTOR == collector:
+                histogram = latency_collector.merged_histogram()
+                break
+        else:
+            return None
+
+        operation = metric.replace('latency_', '', 1)
+        if histogram is None or operation not in histogram.totals:
+            return None
+        logger.info('Number of samples are {}'.format(histogram.count(operation)))
+        return histogram.percentiles(operation, [percentile])[0] * 1000  # s -> ms
 
     @property
     def _title(self) -> str:
@@ -168,14 +232,9 @@ class MetricHelper:
             lat = round(lat)
         return lat, self._snapshots, metric_info
 
-    def _jts_metric(self, collector, metric):
-        timings = []
-        for bucket in self.test_config.buckets:
-            db = self.store.build_dbname(cluster=self.test.cbmonitor_clusters[0],
-                                         collector=collector,
-                                         bucket=bucket)
-            timings += self.store.get_values(db, metric=metric)
-        return timings
+    def _jts_metric(self, collector, metric) -> np.ndarray:
+        return np.concatenate([self.store.get_array(db, metric)
+                               for db in self._bucket_dbs(collector)])
 
     def avg_ops(self) -> Metric:
         metric_info = self._metric_info(chirality=1)
@@ -183,13 +242,14 @@ class MetricHelper:
 
         return throughput, self._snapshots, metric_info
 
+    def _gauge_array(self, db: str, metric: str) -> np.ndarray:
+        if self.weighted:
+            return self.store.get_weighted_array(db, metric)
+        return self.store.get_array(db, metric)
+
     def _avg_ops(self) -> int:
-        values = []
-        for bucket in self.test_config.buckets:
-            db = self.store.build_dbname(cluster=self.test.cbmonitor_clusters[0],
-                                         collector='ns_server',
-                                         bucket=bucket)
-            values += self.store.get_values(db, metric='ops')
+        values = np.concatenate([self._gauge_array(db, 'ops')
+                                 for db in self._bucket_dbs('ns_server')])
 
         return int(np.average(values))
 
@@ -200,35 +260,25 @@ class MetricHelper:
         return throughput, self._snapshots, metric_info
 
     def _max_ops(self) -> int:
-        values = []
-        for bucket in self.test_config.buckets:
-            db = self.store.build_dbname(cluster=self.test.cbmonitor_clusters[0],
-                                         collector='ns_server',
-                                         bucket=bucket)
-            values += self.store.get_values(db, metric='ops')
+        dbs = self._bucket_dbs('ns_server')
 
-        return int(np.percentile(values, 90))
+        return int(self.store.get_percentiles(dbs, 'ops', [90], weighted=self.weighted)[0])
 
     def get_percentile_value_of_node_metric(self, collector, metric, server, percentile):
-        values = []
         db = self.store.build_dbname(cluster=self.test.cbmonitor_clusters[0],
                                      collector=collector,
                                      server=server)
-        values += self.store.get_values(db, metric=metric)
-        return int(np.percentile(values, percentile))
+        return int(self.store.get_percentiles([db], metric, [percentile],
+                                              weighted=self.weighted)[0])
 
-    def get_collector_values(self, collector):
-        values = []
-        for bucket in self.test_config.buckets:
-            db = self.store.build_dbname(cluster=self.test.cbmonitor_clusters[0],
-                                         collector=collector,
-                                         bucket=bucket)
-            values += self.store.get_values(db, metric=collector)
-        return values
+    def get_collector_values(self, collector) -> np.ndarray:
+        return np.concatenate([self.store.get_array(db, collector)
+                               for db in self._bucket_dbs(collector)])
 
     def count_overthreshold_value_of_collector(self, collector, threshold):
-        values = self.get_collector_values(collector)
-        return sum(v >= threshold for v in values)
+        values = np.concatenate([self._gauge_array(db, collector)
+                                 for db in self._bucket_dbs(collector)])
+        return int(np.count_nonzero(values >= threshold))
 
     def get_percentile_value_of_collector(self, collector, percentile):
         values = self.get_collector_values(collector)
@@ -347,14 +397,12 @@ class MetricHelper:
         return latency, self._snapshots, metric_info
 
     def _query_latency(self, percentile: Number) -> float:
-        values = []
-        for bucket in self.test_config.buckets:
-            db = self.store.build_dbname(cluster=self.test.cbmonitor_clusters[0],
-                                         collector='spring_query_latency',
-                                         bucket=bucket)
-            values += self.store.get_values(db, metric='latency_query')
+        dbs = self._bucket_dbs('spring_query_latency')
 
-        query_latency = np.percentile(values, percentile)
+        query_latency = self._histogram_percentile('spring_query_latency',
+                                                   'latency_query', percentile)
+        if query_latency is None:
+            query_latency = self._latency_percentile(dbs, 'latency_query', percentile)
         if query_latency < 100:
             return round(query_latency, 1)
         return int(query_latency)
@@ -377,10 +425,7 @@ class MetricHelper:
                 break
         db = self.store.build_dbname(cluster=cluster,
                                      collector='secondaryscan_latency')
-        timings = self.store.get_values(db, metric='Nth-latency')
-        timings = list(map(int, timings))
-        logger.info("Number of samples are {}".format(len(timings)))
-        scan_latency = np.percentile(timings, percentile) / 1e6
+        scan_latency = self._latency_percentile([db], 'Nth-latency', percentile) / 1e6
         scan_latency = round(scan_latency, 2)
 
         return scan_latency, self._snapshots, metric_info
@@ -419,15 +464,15 @@ class MetricHelper:
                     operation: str,
                     percentile: Number,
                     collector: str) -> float:
-        timings = []
         metric = 'latency_{}'.format(operation)
-        for bucket in self.test_config.buckets:
-            db = self.store.build_dbname(cluster=self.test.cbmonitor_clusters[0],
-                                         collector=collector,
-                                         bucket=bucket)
-            timings += self.store.get_values(db, metric=metric)
-
-        latency = np.percentile(timings, percentile)
+        dbs = self._bucket_dbs(collector)
+
+        latency = self._histogram_percentile(collector, metric, percentile)
+        if latency is None:
+            sketches = None
+            if collector == 'durability':
+                sketches = self._observer_sketches()
+            latency = self._latency_percentile(dbs, metric, percentile, sketches)
         if latency > 100:
             return round(latency)
         return round(latency, 2)
@@ -437,14 +482,10 @@ class MetricHelper:
         title = '{}th percentile {}'.format(percentile, self._title)
         metric_info = self._metric_info(metric_id, title, chirality=-1)
 
-        timings = []
-        for bucket in self.test_config.buckets:
-            db = self.store.build_dbname(cluster=self.test.cbmonitor_clusters[0],
-                                         collector='observe',
-                                         bucket=bucket)
-            timings += self.store.get_values(db, metric='latency_observe')
-
-        latency = round(np.percentile(timings, percentile), 2)
+        dbs = self._bucket_dbs('observe')
+        latency = self._latency_percentile(dbs, 'latency_observe', percentile,
+                                           self._observer_sketches())
+        latency = round(latency, 2)
 
         return latency, self._snapshots, metric_info
 
@@ -1051,6 +1092,20 @@ class MetricHelper:
         metric[-1]['orderBy'] = self.rebalance_order_by + self._order_by
         return metric
 
+    def rebalance_rate(self, traces: List[ProgressTrace]) -> Metric:
+        """Return the average rebalance rate in % per minute.
+
+        Concurrent rebalances are limited by the slowest cluster.
+        """
+        rate = min(trace.rate() for trace in traces if trace.task_type == 'rebalance')
+
+        title = 'Avg. rebalance rate (%/min), {}'.format(self._title)
+        metric_id = '{}_rate'.format(self.test_config.name)
+        metric_info = self._metric_info(metric_id=metric_id, title=title,
+                                        order_by=self.rebalance_order_by, chirality=1)
+
+        return round(rate * 60, 1), self._snapshots, metric_info
+
     def failover_time(self, delta: float) -> Metric:
         metric_info = self._metric_info(chirality=-1)
 
@@ -1,12 +1,132 @@
 import time
+from typing import Dict, List, Optional, Tuple
+
+from requests.exceptions import RequestException
 
 from logger import logger
 from perfrunner.helpers import misc
+from perfrunner.helpers.indexes import (
+    READY,
+    IndexDefinition,
+    index_definitions,
+    index_key,
+    index_states,
+)
 from perfrunner.helpers.remote import RemoteHelper
 from perfrunner.helpers.rest import DefaultRestHelper, KubernetesRestHelper
 from perfrunner.settings import ClusterSpec, TestConfig
 
 
+class ProgressTrace:
+
+    """Progress of a single ns_server task over time."""
+
+    def __init__(self, host: str, task_type: str):
+        self.host = host
+        self.task_type = task_type
+        self.points = []  # type: List[Tuple[float, float]]
+        self.start_time = time.time()
+        self.end_time = None  # type: Optional[float]
+
+    def add(self, timestamp: float, progress: Optional[float]):
+        if progress is not None:
+            self.points.append((timestamp, progress))
+
+    @property
+    def progress(self) -> float:
+        return self.points[-1][1] if self.points else 0
+
+    @property
+    def duration(self) -> float:
+        return (self.end_time or time.time()) - self.start_time
+
+    def rate(self, window: float = None) -> float:
+        """Return the progress rate in % per second, optionally over the last window."""
+        points = self.points
+        if window is not None:
+            points = [(t, p) for t, p in points if t >= points[-1][0] - window]
+        if len(points) < 2 or points[-1][0] == points[0][0]:
+            return 0
+        return (points[-1][1] - points[0][1]) / (points[-1][0] - points[0][0])
+
+
+class TaskWatcher:
+
+    """Follow an ns_server task with long-polling and adaptive polling.
+
+    Between two reads of /pools/default/tasks the watcher blocks on
+    /pools/default with the waitChange and etag parameters. ns_server replies
+    as soon as the cluster state changes, e.g. when a rebalance completes, or
+    when the wait expires. Servers that do not support long-polling get plain
+    sleeps. The wait shrinks from MAX_INTERVAL down to MIN_INTERVAL as the
+    estimated time to completion decreases, so the completion time is
+    accurate to MIN_INTERVAL either way.
+    """
+
+    MIN_INTERVAL = 0.1
+
+    MAX_INTERVAL = 2
+
+    RATE_WINDOW = 30  # Seconds of progress used to estimate the remaining time
+
+    def __init__(self, rest: DefaultRestHelper, base_url: str, task_type: str,
+                 host: str = None):
+        self.rest = rest
+        self.base_url = base_url
+        self.task_type = task_type
+        self.trace = ProgressTrace(host or base_url, task_type)
+        self.etag = None
+        self.long_polling = True
+
+    def get_tasks(self) -> List[dict]:
+        r = self.rest.get(url=self.base_url + '/pools/default/tasks')
+        return [task for task in r.json() if task.get('type') == self.task_type]
+
+    def poll(self) -> Tuple[List[dict], bool]:
+        """Return the current tasks and whether any of them is running."""
+        tasks = self.get_tasks()
+        is_running = any(task.get('status') == 'running' or task.get('statusIsStale')
+                         for task in tasks)
+        progress = [task['progress'] for task in tasks if 'progress' in task]
+        now = time.time()
+        if progress:
+            self.trace.add(now, min(progress))
+        if not is_running and self.trace.end_time is None:
+            self.trace.end_time = now
+        return tasks, is_running
+
+    def interval(self) -> float:
+        rate = self.trace.rate(self.RATE_WINDOW)
+        if rate <= 0:
+            return self.MAX_INTERVAL
+        remaining = (100 - self.trace.progress) / rate
+        return min(max(remaining / 10, self.MIN_INTERVAL), self.MAX_INTERVAL)
+
+    def wait_change(self, timeout: float):
+        params = {}
+        if self.etag is not None:
+            params = {'etag': self.etag, 'waitChange': int(timeout * 1000)}
+        r = self.rest.get(url=self.base_url + '/pools/default', params=params,
+                          timeout=timeout + 10)
+        self.etag = r.json().get('etag')
+        if self.etag is None:
+            raise ValueError('No etag in the response')
+
+    def wait(self):
+        timeout = self.interval()
+        t0 = time.time()
+        if self.long_polling:
+            try:
+                self.wait_change(timeout)
+            except (RequestException, ValueError) as e:
+                logger.info('Long-polling is not available on {}, falling back to '
+                            'polling: {}'.format(self.trace.host, e))
+                self.long_polling = False
+        # Frequent unrelated changes must not turn long-polling into busy polling
+        time.sleep(max(t0 + (self.MIN_INTERVAL if self.long_polling else timeout) -
+                       time.time(), 0))
+
+
 class Monitor:
 
     def __new__(cls,
@@ -60,33 +180,42 @@ class DefaultMonitor(DefaultRestHelper):
         self.test_config = test_config
         self.remote = RemoteHelper(cluster_spec, verbose)
         self.master_node = next(cluster_spec.masters)
+        self.traces = []  # type: List[ProgressTrace]
         self.build = self.get_version(self.master_node)
         version, build_number = self.build.split('-')
         self.build_version_number = tuple(map(int, version.split('.'))) + (int(build_number),)
 
-    def monitor_rebalance(self, host):
-        logger.info('Monitoring rebalance status')
+    def task_watcher(self, host: str, task_type: str) -> TaskWatcher:
+        return TaskWatcher(self, 'http://{}:8091'.format(host), task_type, host)
+
+    def monitor_rebalance(self, host) -> ProgressTrace:
+        logger.info('Monitoring rebalance status on {}'.format(host))
 
+        watcher = self.task_watcher(host, task_type='rebalance')
         is_running = True
         last_progress = 0
-        last_progress_time = time.time()
+        last_progress_time = last_log_time = time.time()
         while is_running:
-            time.sleep(self.POLLING_INTERVAL)
+            watcher.wait()
 
-            is_running, progress = self.get_task_status(host,
-                                                        task_type='rebalance')
+            tasks, is_running = watcher.poll()
+            progress = tasks[0].get('progress') if tasks else None
             if progress == last_progress:
                 if time.time() - last_progress_time > self.REBALANCE_TIMEOUT:
-                    logger.error('Rebalance hung')
+                    logger.error('Rebalance hung on {}'.format(host))
                     break
             else:
                 last_progress = progress
                 last_progress_time = time.time()
 
-            if progress is not None:
-                logger.info('Rebalance progress: {} %'.format(progress))
+            if progress is not None and time.time() - last_log_time >= self.POLLING_INTERVAL:
+                logger.info('Rebalance progress on {}: {} %'.format(host, progress))
+                last_log_time = time.time()
 
-        logger.info('Rebalance completed')
+        trace = watcher.trace
+        self.traces.append(trace)
+        logger.info('Rebalance completed on {} in {:.1f} s'.format(host, trace.duration))
+        return trace
 
     def _wait_for_empty_queues(self, host, bucket, queues, stats_function):
         metrics = list(queues)
@@ -350,15 +479,15 @@ class DefaultMonitor(DefaultRestHelper):
             time.sleep(self.POLLING_INTERVAL)
         return t1-t0
 
-    def monitor_task(self, host, task_type):
+    def monitor_task(self, host, task_type) -> ProgressTrace:
         logger.info('Monitoring task: {}'.format(task_type))
         time.sleep(self.MONITORING_DELAY * 2)
 
+        watcher = self.task_watcher(host, task_type)
         while True:
-            time.sleep(self.POLLING_INTERVAL)
+            watcher.wait()
 
-            tasks = [task for task in self.get_tasks(host)
-                     if task.get('type') == task_type]
+            tasks, _ = watcher.poll()
             if tasks:
                 for task in tasks:
                     logger.info('{}: {}%, bucket: {}, ddoc: {}'.format(
@@ -367,7 +496,9 @@ class DefaultMonitor(DefaultRestHelper):
                     ))
             else:
                 break
+        self.traces.append(watcher.trace)
         logger.info('Task {} successfully completed'.format(task_type))
+        return watcher.trace
 
     def monitor_warmup(self, memcached, host, bucket):
         logger.info('Monitoring warmup status: {}@{}'.format(bucket,
@@ -460,32 +591,31 @@ class DefaultMonitor(DefaultRestHelper):
 
         logger.info('Indexing completed')
 
-    def wait_for_secindex_init_build(self, host, indexes):
-        # POLL until initial index build is complete
-        logger.info(
-            "Waiting for the following indexes to be ready: {}".format(indexes))
-
-        indexes_ready = [0 for _ in indexes]
+    def get_index_states(self, host: str) -> Dict[tuple, str]:
+        return index_states(self.get_index_status(host))
 
-        def get_index_status(json2i, index):
-            """Return the index status."""
-            for d in json2i["status"]:
-                if d["name"] == index:
-                    return d["status"]
-            return None
+    def wait_for_indexes_ready(self, host: str, definitions: List[IndexDefinition],
+                               polling_interval: float):
+        """Poll until all indexes are ready, with one status request per poll."""
+        keys = {index_key(definition) for definition in definitions}
 
         @misc.retry(catch=(KeyError,), iterations=10, wait=30)
-        def update_indexes_ready():
-            json2i = self.get_index_status(host)
-            for i, index in enumerate(indexes):
-                status = get_index_status(json2i, index)
-                if status == 'Ready':
-                    indexes_ready[i] = 1
+        def get_pending():
+            states = self.get_index_states(host)
+            return {key for key in keys if states.get(key) != READY}
+
+        while keys:
+            time.sleep(polling_interval)
+            keys = get_pending()
+
+    def wait_for_secindex_init_build(self, host, bucket, indexes):
+        # POLL until initial index build is complete
+        logger.info(
+            "Waiting for the following indexes to be ready: {}".format(list(indexes)))
 
         init_ts = time.time()
-        while sum(indexes_ready) != len(indexes):
-            time.sleep(self.POLLING_INTERVAL_INDEXING)
-            update_indexes_ready()
+        self.wait_for_indexes_ready(host, index_definitions(indexes, bucket),
+                                    self.POLLING_INTERVAL_INDEXING)
         finish_ts = time.time()
         logger.info('secondary index build time: {}'.format(finish_ts - init_ts))
         time_elapsed = round(finish_ts - init_ts)
@@ -493,37 +623,13 @@ class DefaultMonitor(DefaultRestHelper):
 
     def wait_for_secindex_init_build_collections(self, host, indexes):
         # POLL until initial index build is complete
-        index_list = []
-        for bucket_name, scope_map in indexes.items():
-            for scope_name, collection_map in scope_map.items():
-                for collection_name, index_map in collection_map.items():
-                    for index_name in index_map.keys():
-                        index_list.append(index_name)
-        indexes = index_list
+        definitions = index_definitions(indexes)
+        index_list = [definition.name for definition in definitions]
         logger.info(
-            "Waiting for the following indexes to be ready: {}".format(indexes))
-
-        indexes_ready = [0 for _ in indexes]
-
-        def get_index_status(json2i, index):
-            """Return the index status."""
-            for d in json2i["status"]:
-                if d["name"] == index:
-                    return d["status"]
-            return None
+            "Waiting for the following indexes to be ready: {}".format(index_list))
 
-        @misc.retry(catch=(KeyError,), iterations=10, wait=30)
-        def update_indexes_ready():
-            json2i = self.get_index_status(host)
-            for i, index in enumerate(indexes):
-                status = get_index_status(json2i, index)
-                if status == 'Ready':
-                    indexes_ready[i] = 1
-
-        while sum(indexes_ready) != len(indexes):
-            time.sleep(self.POLLING_INTERVAL_INDEXING * 10)
-            update_indexes_ready()
-        logger.info('secondary index build complete: {}'.format(indexes))
+        self.wait_for_indexes_ready(host, definitions, self.POLLING_INTERVAL_INDEXING * 10)
+        logger.info('secondary index build complete: {}'.format(index_list))
 
     def wait_for_secindex_incr_build(self, index_nodes, bucket, indexes, numitems):
         # POLL until incremenal index build is complete
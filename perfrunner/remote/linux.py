@@ -1,13 +1,22 @@
 import os
+import shlex
 import time
 from collections import defaultdict
-from typing import Dict, List
+from functools import partial
+from typing import Dict, List, Optional
 from urllib.parse import urlparse
 
 from fabric.api import cd, get, put, quiet, run, settings
 from fabric.exceptions import CommandTimeout, NetworkError
 
 from logger import logger
+from perfrunner.helpers.concurrency import run_concurrently
+from perfrunner.helpers.indexes import (
+    DEFAULT,
+    IndexDefinition,
+    IndexProvisioningError,
+    keyspace,
+)
 from perfrunner.helpers.misc import uhex
 from perfrunner.remote import Remote
 from perfrunner.remote.context import (
@@ -17,6 +26,8 @@ from perfrunner.remote.context import (
     master_server,
     servers_by_role,
 )
+from perfrunner.remote.logs import LogFollower
+from perfrunner.remote.ssh import SSHPool
 from perfrunner.settings import ClusterSpec
 
 
@@ -34,6 +45,28 @@ class RemoteLinux(Remote):
 
     LINUX_PERF_DELAY = 30
 
+    THP_PATHS = (
+        '/sys/kernel/mm/transparent_hugepage/enabled',
+        '/sys/kernel/mm/redhat_transparent_hugepage/enabled',
+        '/sys/kernel/mm/transparent_hugepage/defrag',
+    )
+
+    def __init__(self, cluster_spec: ClusterSpec, os: str):
+        super().__init__(cluster_spec, os)
+        self.log_followers = {}  # type: Dict[str, LogFollower]
+        self.ssh = SSHPool(*cluster_spec.ssh_credentials)
+
+    def run_on_servers(self, *commands: str, quiet: bool = False):
+        """Run a batch of commands on all servers in one round trip per server."""
+        results = self.ssh.run_batch(self.cluster_spec.servers, commands)
+        if quiet:
+            return
+        for host, host_results in results.items():
+            for result in host_results:
+                if result.failed:
+                    logger.interrupt('Command "{}" failed on {}: {}'.format(
+                        result.command, host, result))
+
     @property
     def package(self):
         if self.os.upper() in ('UBUNTU', 'DEBIAN'):
@@ -55,182 +88,118 @@ class RemoteLinux(Remote):
     def detect_ubuntu_release(self):
         return run('lsb_release -sr').strip()
 
-    def run_cbindex_command(self, options):
-        cmd = "/opt/couchbase/bin/cbindex {options}".format(options=options)
-        logger.info('Running: {}'.format(cmd))
-        run(cmd, shell_escape=False, pty=False)
-
-    def build_index(self, index_node, indexes):
-        options = \
-            "-auth=Administrator:password " \
-            "-server {index_node}:8091 " \
-            "-type build " \
-            "-indexes {all_indexes}".format(index_node=index_node,
-                                            all_indexes=",".join(indexes))
-
-        self.run_cbindex_command(options)
-
-    def create_index(self, index_nodes, bucket, indexes, storage):
-        # Remember what bucket:index was created
-        bucket_indexes = []
-
-        for index, index_def in indexes.items():
-            where = None
-            if ':' in index_def:
-                fields, where = index_def.split(":")
+    CBINDEX = '/opt/couchbase/bin/cbindex'
+
+    def cbindex_command(self, index_node: str, options: str) -> str:
+        return '{} -auth={}:{} -server {}:8091 {}'.format(
+            self.CBINDEX, *self.cluster_spec.rest_credentials, index_node, options)
+
+    @staticmethod
+    def cbindex_create_options(definition: IndexDefinition, storage: Optional[str],
+                               shell: bool = True) -> str:
+        """Return the create options for the command line or for a batch file."""
+        quote = shlex.quote if shell else str
+        options = '-type create -bucket {}'.format(definition.bucket)
+        if (definition.scope, definition.collection) != (DEFAULT, DEFAULT):
+            options += ' -scope {} -collection {}'.format(definition.scope,
+                                                          definition.collection)
+        options += ' -fields {}'.format(
+            quote(','.join('`{}`'.format(field) for field in definition.fields)))
+        if definition.where is not None:
+            options += ' -where {}'.format(
+                quote(definition.where) if shell else '"{}"'.format(definition.where))
+        if storage in ('memdb', 'plasma'):
+            options += ' -using {}'.format(storage)
+        options += ' -index {} -with {}'.format(definition.name,
+                                                quote('{"defer_build":true}'))
+        return options
+
+    def run_cbindex_batches(self, batches: Dict[str, List[str]]):
+        """Run the batches of commands concurrently on the master server.
+
+        The commands of a batch run one after another in a single round trip.
+        """
+        session = self.ssh.session(self.cluster_spec.servers[0])
+        for commands in batches.values():
+            for command in commands:
+                logger.info('Running: {}'.format(command))
+        results = run_concurrently(partial(session.run_batch, commands)
+                                   for commands in batches.values())
+        failed = [result for batch in results for result in batch if result.failed]
+        if failed:
+            raise IndexProvisioningError('; '.join(
+                '{}: {}'.format(result.command, result) for result in failed))
+
+    def create_indexes(self, index_node: str,
+                       definitions: Dict[str, List[IndexDefinition]],
+                       storage: Optional[str], batch_process: bool = True):
+        """Create deferred indexes, the buckets are processed concurrently.
+
+        With batch_process, cbindex creates all indexes of a bucket in one
+        process from a batch file, otherwise every index needs its own cbindex
+        process.
+        """
+        batches = {}
+        for bucket, bucket_definitions in definitions.items():
+            if batch_process:
+                batch_file = '/tmp/batch_{}.txt'.format(bucket)
+                lines = [self.cbindex_create_options(d, storage, shell=False)
+                         for d in bucket_definitions]
+                batches[bucket] = [
+                    "cat > {} <<'EOF'\n{}\nEOF".format(batch_file, '\n'.join(lines)),
+                    self.cbindex_command(index_node,
+                                         '-type batch_process -input {} '
+                                         '-refresh_settings=true'.format(batch_file)),
+                ]
             else:
-                fields = index_def
-            fields_list = fields.split(",")
-
-            options = \
-                "-auth=Administrator:password " \
-                "-server {index_node}:8091 " \
-                "-type create " \
-                "-bucket {bucket} ".format(index_node=index_nodes[0], bucket=bucket)
-            options += "-fields "
-            for field in fields_list:
-                options += "\\\\\\`{}\\\\\\`,".format(field)
-
-            options = options.rstrip(",")
-            options = options + " "
-
-            if where is not None:
-                options = '{options} -where \\\"{where_clause}\\\"'\
-                    .format(options=options, where_clause=where)
-
-            if storage == 'memdb' or storage == 'plasma':
-                options = '{options} -using {db}'.format(options=options,
-                                                         db=storage)
-
-            options = "{options} -index {index} " \
-                .format(options=options, index=index)
-
-            options = options + '-with {\\\\\\"defer_build\\\\\\":true}'
-
-            bucket_indexes.append("{}:{}".format(bucket, index))
-            self.run_cbindex_command(options)
-
-        return bucket_indexes
-
-    def batch_create_index_collection(self, index_nodes, indexes, storage):
-        batch_options = \
-            "-auth=Administrator:password " \
-            "-server {index_node}:8091 " \
-            "-type batch_process " \
-            "-input /tmp/batch.txt " \
-            "-refresh_settings=true".format(index_node=index_nodes[0])
-        with open("/tmp/batch.txt", "w+") as bf:
-            for bucket_name, scope_map in indexes.items():
-                for scope_name, collection_map in scope_map.items():
-                    for collection_name, index_map in collection_map.items():
-                        for index, index_def in index_map.items():
-                            where = None
-                            if ':' in index_def:
-                                fields, where = index_def.split(":")
-                            else:
-                                fields = index_def
-                            fields_list = fields.split(",")
-
-                            options = "-type create " \
-                                "-bucket {bucket} " \
-                                "-scope {scope} " \
-                                "-collection {collection} ".format(
-                                    bucket=bucket_name,
-                                    scope=scope_name,
-                                    collection=collection_name)
-
-                            options += "-fields "
-                            for field in fields_list:
-                                options += "`{}`,".format(field)
-
-                            options = options.rstrip(",")
-                            options = options + " "
-
-                            if where is not None:
-                                options = '{options} -where "{where_clause}"' \
-                                    .format(options=options, where_clause=where)
-
-                            if storage == 'memdb' or storage == 'plasma':
-                                options = '{options} -using {db}'.format(options=options,
-                                                                         db=storage)
-
-                            options = "{options} -index {index} " \
-                                .format(options=options, index=index)
-
-                            options = options + '-with {"defer_build":true} \n'
-                            bf.write(options)
-
-        put("/tmp/batch.txt", "/tmp/batch.txt")
-        self.run_cbindex_command(batch_options)
-
-    def batch_build_index_collection(self, index_nodes, indexes):
-        batch_options = \
-            "-auth=Administrator:password " \
-            "-server {index_node}:8091 " \
-            "-type batch_build " \
-            "-input /tmp/batch.txt " \
-            "-refresh_settings=true".format(index_node=index_nodes[0])
-
-        with open("/tmp/batch.txt", "w+") as bf:
-            for bucket_name, scope_map in indexes.items():
-                for scope_name, collection_map in scope_map.items():
-                    for collection_name, index_map in collection_map.items():
-                        build_indexes = ",".join(["{}:{}:{}:{}".format(
-                            bucket_name,
-                            scope_name,
-                            collection_name,
-                            index_name)
-                            for index_name in index_map.keys()])
-                        options = "-type build " \
-                                  "-indexes {build_indexes} \n"\
-                            .format(build_indexes=build_indexes)
-                        bf.write(options)
-        put("/tmp/batch.txt", "/tmp/batch.txt")
-        self.run_cbindex_command(batch_options)
-
-    @master_server
-    def build_secondary_index(self, index_nodes, bucket, indexes, storage):
-        logger.info('building secondary indexes')
-
-        # Create index but do not build
-        bucket_indexes = self.create_index(index_nodes, bucket, indexes, storage)
-
-        # build indexes
-        self.build_index(index_nodes[0], bucket_indexes)
+                batches[bucket] = [
+                    self.cbindex_command(index_node, self.cbindex_create_options(d, storage))
+                    for d in bucket_definitions
+                ]
+        self.run_cbindex_batches(batches)
+
+    def build_indexes(self, index_node: str,
+                      groups: Dict[str, List[List[IndexDefinition]]]):
+        """Build the deferred indexes, one request per keyspace and the buckets concurrently."""
+        batches = {}
+        for bucket, bucket_groups in groups.items():
+            batches[bucket] = [
+                self.cbindex_command(index_node, '-type build -indexes {}'.format(
+                    ','.join('{}:{}'.format(keyspace(d), d.name) for d in group)))
+                for group in bucket_groups
+            ]
+        self.run_cbindex_batches(batches)
+
+    RESET_SWAP = 'swapoff --all && swapon --all'
+
+    DROP_CACHES = 'sync && echo 3 > /proc/sys/vm/drop_caches'
+
+    SET_SWAPPINESS = 'sysctl vm.swappiness=0'
 
-    @master_server
-    def create_secondary_index_collections(self, index_nodes, indexes, storage):
-        logger.info('creating secondary indexes')
-        self.batch_create_index_collection(index_nodes, indexes, storage)
-
-    @master_server
-    def build_secondary_index_collections(self, index_nodes, indexes):
-        logger.info('building secondary indexes')
-        self.batch_build_index_collection(index_nodes, indexes)
-
-    @all_servers
     def reset_swap(self):
         logger.info('Resetting swap')
-        run('swapoff --all && swapon --all')
+        self.run_on_servers(self.RESET_SWAP)
 
-    @all_servers
     def drop_caches(self):
         logger.info('Dropping memory cache')
-        run('sync && echo 3 > /proc/sys/vm/drop_caches')
+        self.run_on_servers(self.DROP_CACHES)
 
-    @all_servers
     def set_swappiness(self):
         logger.info('Changing swappiness to 0')
-        run('sysctl vm.swappiness=0')
+        self.run_on_servers(self.SET_SWAPPINESS)
+
+    def disable_thp_commands(self) -> List[str]:
+        return ['echo never > {} 2>/dev/null || true'.format(path)
+                for path in self.THP_PATHS]
 
-    @all_servers
     def disable_thp(self):
-        for path in (
-            '/sys/kernel/mm/transparent_hugepage/enabled',
-            '/sys/kernel/mm/redhat_transparent_hugepage/enabled',
-            '/sys/kernel/mm/transparent_hugepage/defrag',
-        ):
-            run('echo never > {}'.format(path), quiet=True)
+        self.run_on_servers(*self.disable_thp_commands(), quiet=True)
+
+    def tweak_memory(self):
+        logger.info('Resetting swap, dropping memory cache, changing swappiness '
+                    'to 0 and disabling THP')
+        self.run_on_servers(self.RESET_SWAP, self.DROP_CACHES, self.SET_SWAPPINESS,
+                            *self.disable_thp_commands())
 
     @all_servers
     def flush_iptables(self):
@@ -390,11 +359,10 @@ class RemoteLinux(Remote):
         else:
             return []
 
-    @all_servers
     def tune_log_rotation(self):
         logger.info('Tune log rotation so that it happens less frequently')
-        run('sed -i "s/num_files, [0-9]*/num_files, 50/" '
-            '/opt/couchbase/etc/couchbase/static_config')
+        self.run_on_servers('sed -i "s/num_files, [0-9]*/num_files, 50/" '
+                            '/opt/couchbase/etc/couchbase/static_config')
 
     @master_server
     def restore_data(self, archive_path: str, repo_path: str, map_data: str=None):
@@ -478,33 +446,28 @@ class RemoteLinux(Remote):
         put(config, remote_path)
         return run('fio --minimal {}'.format(remote_path))
 
+    def log_follower(self, host: str) -> LogFollower:
+        if host not in self.log_followers:
+            self.log_followers[host] = LogFollower(self.ssh.session(host))
+        return self.log_followers[host]
+
+    def log_events(self, host: str) -> LogFollower:
+        """Read the new lines of info.log and return the follower with all events."""
+        follower = self.log_follower(host)
+        follower.poll()
+        return follower
+
     def detect_auto_failover(self, host):
-        with settings(host_string=host):
-            r = run('grep "Starting failing over" '
-                    '/opt/couchbase/var/lib/couchbase/logs/info.log', quiet=True)
-            if not r.return_code:
-                return r.strip().split(',')[1]
+        return self.log_events(host).first('auto_failover')
 
     def detect_hard_failover_start(self, host):
-        with settings(host_string=host):
-            r = run('grep "Starting failing" '
-                    '/opt/couchbase/var/lib/couchbase/logs/info.log', quiet=True)
-            if not r.return_code:
-                return r.strip().split(',')[1]
+        return self.log_events(host).first('hard_failover_start')
 
     def detect_graceful_failover_start(self, host):
-        with settings(host_string=host):
-            r = run('grep "Starting vbucket moves" '
-                    '/opt/couchbase/var/lib/couchbase/logs/info.log', quiet=True)
-            if not r.return_code:
-                return r.strip().split(',')[1]
+        return self.log_events(host).first('graceful_failover_start')
 
     def detect_failover_end(self, host):
-        with settings(host_string=host):
-            r = run('grep "Failed over .*: ok" '
-                    '/opt/couchbase/var/lib/couchbase/logs/info.log', quiet=True)
-            if not r.return_code:
-                return r.strip().split(',')[1]
+        return self.log_events(host).first('failover_end')
 
     @property
     def num_vcpu(self):
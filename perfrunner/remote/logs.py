@@ -0,0 +1,130 @@
+import re
+import shlex
+from collections import defaultdict, namedtuple
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Tuple
+
+from logger import logger
+from perfrunner.remote.ssh import SSHSession
+
+INFO_LOG = '/opt/couchbase/var/lib/couchbase/logs/info.log'
+
+# Reads the complete lines appended since the given offset and prints the new
+# offset followed by the lines that match the pattern, the file is read from
+# the start after rotation
+READER = '''
+import os, re, sys
+path, offset, pattern = sys.argv[1], int(sys.argv[2]), re.compile(sys.argv[3])
+if os.path.getsize(path) < offset:
+    offset = 0
+lines = []
+with open(path, 'rb') as fh:
+    fh.seek(offset)
+    for line in fh:
+        if not line.endswith(b'\\n'):
+            break
+        offset += len(line)
+        line = line.decode('utf-8', 'replace').rstrip()
+        if pattern.search(line):
+            lines.append(line)
+print('\\n'.join([str(offset)] + lines))
+'''
+
+# The same output with coreutils and grep for hosts without Python, a line
+# that is being written may be cut
+FALLBACK = '''
+size=$(stat -c %s {path}) || exit 1
+offset={offset}
+[ "$size" -lt "$offset" ] && offset=0
+echo "$size"
+tail -c +$((offset + 1)) {path} | head -c $((size - offset)) | grep -E {pattern}
+true
+'''
+
+READ_COMMAND = '''
+if PYTHON=$(command -v python3 || command -v python); then
+    "$PYTHON" -c {reader} {path} {offset} {pattern}
+else
+    {fallback}
+fi
+'''
+
+LogEvent = namedtuple('LogEvent', ('name', 'timestamp', 'line'))
+
+# Event name and pattern, one line may produce several events
+FAILOVER_EVENTS = (
+    ('auto_failover', 'Starting failing over'),
+    ('hard_failover_start', 'Starting failing'),
+    ('graceful_failover_start', 'Starting vbucket moves'),
+    ('failover_end', 'Failed over .*: ok'),
+    ('rebalance_start', 'Starting rebalance'),
+    ('rebalance_end', 'Rebalance completed successfully'),
+)
+
+
+class LogFollower:
+
+    """Follow a log file and turn the matching lines into events.
+
+    Every poll reads only the lines appended since the previous poll, and
+    matches all patterns in one pass on the host. The events are kept so that
+    they can be queried any number of times, and subscribers are called when
+    new events arrive. Polls are serialized, so that the follow thread and
+    the test never read the same lines twice.
+    """
+
+    def __init__(self, session: SSHSession, path: str = INFO_LOG,
+                 patterns: Tuple[Tuple[str, str], ...] = FAILOVER_EVENTS):
+        self.session = session
+        self.path = path
+        self.patterns = [(name, re.compile(pattern)) for name, pattern in patterns]
+        self.pattern = '|'.join('({})'.format(pattern) for _, pattern in patterns)
+        self.lock = Lock()
+        self.offset = 0
+        self.events = defaultdict(list)  # type: Dict[str, List[LogEvent]]
+        self.subscribers = defaultdict(list)  # type: Dict[str, List[Callable]]
+
+    def command(self) -> str:
+        path, pattern = shlex.quote(self.path), shlex.quote(self.pattern)
+        fallback = FALLBACK.format(path=path, offset=self.offset, pattern=pattern)
+        return READ_COMMAND.format(reader=shlex.quote(READER), path=path,
+                                   offset=self.offset, pattern=pattern,
+                                   fallback=fallback)
+
+    def read(self) -> Dict:
+        result = self.session.run(self.command())
+        if result.failed:
+            logger.error('Cannot read {} on {}: {}'.format(
+                self.path, self.session.host, result))
+            return {'offset': self.offset, 'lines': []}
+        offset, *lines = result.splitlines()
+        return {'offset': int(offset), 'lines': lines}
+
+    @staticmethod
+    def timestamp(line: str) -> str:
+        """Extract the timestamp, e.g. [ns_server:info,2020-01-01T00:00:00.000Z,...]."""
+        return line.split(',')[1]
+
+    def subscribe(self, name: str, callback: Callable[[LogEvent], None]):
+        self.subscribers[name].append(callback)
+
+    def poll(self) -> List[LogEvent]:
+        """Read the new lines and return the new events."""
+        with self.lock:
+            response = self.read()
+            self.offset = response['offset']
+            events = []
+            for line in response['lines']:
+                for name, pattern in self.patterns:
+                    if pattern.search(line):
+                        events.append(LogEvent(name, self.timestamp(line), line))
+            for event in events:
+                self.events[event.name].append(event)
+                for callback in self.subscribers[event.name]:
+                    callback(event)
+            return events
+
+    def first(self, name: str) -> Optional[str]:
+        """Return the timestamp of the first event with the given name."""
+        if self.events[name]:
+            return self.events[name][0].timestamp
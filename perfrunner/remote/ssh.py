@@ -0,0 +1,145 @@
+import shlex
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, Dict, List, Sequence
+
+import paramiko
+from fabric.api import env
+from fabric.exceptions import CommandTimeout
+
+from perfrunner.helpers.misc import uhex
+
+
+class CommandResult(str):
+
+    """The output of a command, with the attributes of the fabric results."""
+
+    def __new__(cls, stdout: str, command: str, return_code: int):
+        result = super().__new__(cls, stdout)
+        result.command = command
+        result.return_code = return_code
+        return result
+
+    @property
+    def succeeded(self) -> bool:
+        return self.return_code == 0
+
+    @property
+    def failed(self) -> bool:
+        return not self.succeeded
+
+
+class SSHSession:
+
+    """A persistent SSH connection to a single host.
+
+    Every command runs in a new channel of the same transport, so concurrent
+    commands share one connection and no command pays for a new handshake.
+    A batch of commands is sent as one script and completes in one round
+    trip.
+    """
+
+    def __init__(self, host: str, user: str, password: str):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.lock = Lock()
+        self.client = None  # type: paramiko.SSHClient
+
+    def connect(self) -> paramiko.SSHClient:
+        with self.lock:
+            transport = self.client and self.client.get_transport()
+            if transport is None or not transport.is_active():
+                self.client = paramiko.SSHClient()
+                self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                self.client.connect(hostname=self.host, username=self.user,
+                                    password=self.password)
+                self.client.get_transport().set_keepalive(env.keepalive or 60)
+            return self.client
+
+    def close(self):
+        with self.lock:
+            if self.client is not None:
+                self.client.close()
+                self.client = None
+
+    def execute(self, script: str, timeout: float = None) -> str:
+        command = '{} {}'.format(env.shell, shlex.quote(script))
+        try:
+            _, stdout, _ = self.connect().exec_command(command, timeout=timeout)
+        except paramiko.SSHException:  # The connection was lost, reconnect once
+            self.close()
+            _, stdout, _ = self.connect().exec_command(command, timeout=timeout)
+        try:
+            return stdout.read().decode('utf-8', 'replace')
+        except socket.timeout:
+            raise CommandTimeout(timeout)
+
+    def run_batch(self, commands: Sequence[str], timeout: float = None) -> List[CommandResult]:
+        """Run the commands one after another in a single round trip."""
+        marker = '__batch_{}__'.format(uhex())
+        script = '\n'.join(
+            ['echo "{} start"'.format(marker)] +
+            ['{{ {}\n}} 2>&1; rc=$?; echo; echo "{} $rc"'.format(command, marker)
+             for command in commands]
+        )
+        results = []
+        output = []
+        lines = self.execute(script, timeout).splitlines(keepends=True)
+        for i, line in enumerate(lines):  # Skip the output of the login scripts
+            if line.startswith(marker):
+                lines = lines[i + 1:]
+                break
+        for line in lines:
+            if line.startswith(marker):
+                stdout = ''.join(output)[:-1].rstrip('\r\n')
+                command = commands[len(results)]
+                results.append(CommandResult(stdout, command, int(line.split()[1])))
+                output = []
+            else:
+                output.append(line)
+        for command in commands[len(results):]:  # The script was interrupted
+            results.append(CommandResult(''.join(output).rstrip(), command, -1))
+            output = []
+        return results
+
+    def run(self, command: str, timeout: float = None) -> CommandResult:
+        return self.run_batch([command], timeout)[0]
+
+
+class SSHPool:
+
+    """Persistent SSH sessions, one per host, shared by all threads."""
+
+    MAX_WORKERS = 32
+
+    def __init__(self, user: str, password: str):
+        self.user = user
+        self.password = password
+        self.lock = Lock()
+        self.sessions = {}  # type: Dict[str, SSHSession]
+        self.executor = ThreadPoolExecutor(max_workers=self.MAX_WORKERS)
+
+    def session(self, host: str) -> SSHSession:
+        with self.lock:
+            if host not in self.sessions:
+                self.sessions[host] = SSHSession(host, self.user, self.password)
+            return self.sessions[host]
+
+    def run(self, host: str, command: str, timeout: float = None) -> CommandResult:
+        return self.session(host).run(command, timeout)
+
+    def map(self, hosts: Sequence[str], task: Callable[[str], object]) -> dict:
+        """Call the task with every host concurrently and collect the results by host."""
+        futures = {host: self.executor.submit(task, host) for host in hosts}
+        return {host: future.result() for host, future in futures.items()}
+
+    def run_batch(self, hosts: Sequence[str], commands: Sequence[str],
+                  timeout: float = None) -> Dict[str, List[CommandResult]]:
+        """Run the same batch of commands on every host concurrently."""
+        return self.map(hosts, lambda host: self.session(host).run_batch(commands, timeout))
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
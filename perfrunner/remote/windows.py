@@ -7,6 +7,9 @@ from logger import logger
 from perfrunner.helpers.misc import uhex
 from perfrunner.remote import Remote
 from perfrunner.remote.context import all_servers, master_server
+from perfrunner.remote.logs import LogFollower
+from perfrunner.remote.ssh import SSHPool
+from perfrunner.settings import ClusterSpec
 
 
 class RemoteWindows(Remote):
@@ -15,6 +18,8 @@ class RemoteWindows(Remote):
 
     VERSION_FILE = '/cygdrive/c/Program Files/Couchbase/Server/VERSION.txt'
 
+    INFO_LOG = '/cygdrive/c/Program Files/Couchbase/Server/var/lib/couchbase/logs/info.log'
+
     MAX_RETRIES = 5
 
     TIMEOUT = 300
@@ -23,6 +28,11 @@ class RemoteWindows(Remote):
 
     PROCESSES = ('erl*', 'epmd*')
 
+    def __init__(self, cluster_spec: ClusterSpec, os: str):
+        super().__init__(cluster_spec, os)
+        self.log_followers = {}
+        self.ssh = SSHPool(*cluster_spec.ssh_credentials)
+
     @staticmethod
     def exists(fname):
         r = run('test -f "{}"'.format(fname), warn_only=True, quiet=True)
@@ -44,6 +54,9 @@ class RemoteWindows(Remote):
     def disable_thp(self):
         pass
 
+    def tweak_memory(self):
+        pass
+
     def flush_iptables(self):
         pass
 
@@ -203,6 +216,18 @@ class RemoteWindows(Remote):
     def tune_log_rotation(self):
         pass
 
+    def log_follower(self, host: str) -> LogFollower:
+        if host not in self.log_followers:
+            self.log_followers[host] = LogFollower(self.ssh.session(host),
+                                                   path=self.INFO_LOG)
+        return self.log_followers[host]
+
+    def log_events(self, host: str) -> LogFollower:
+        """Read the new lines of info.log and return the follower with all events."""
+        follower = self.log_follower(host)
+        follower.poll()
+        return follower
+
     @all_servers
     def stop_server(self):
         logger.info('Stopping Couchbase Server')
@@ -348,6 +348,26 @@ class StatsSettings:
                         'memcached']
     TRACED_PROCESSES = []
 
+    BUFFERED_STORE = 0
+
+    ASYNC_SAMPLING = 0
+
+    STATS_AGENT = 0
+
+    SHARED_RUNTIME = 0
+
+    LOCAL_CACHE = 0
+
+    SKETCHES = 0
+
+    RESPONSE_CACHE = 0
+
+    ADAPTIVE_SAMPLING = 0
+
+    OBSERVE_RATE = 10  # Index latency probes per second, all buckets together
+
+    OBSERVE_PROBES = 10  # Concurrent index latency probes
+
     def __init__(self, options: dict):
         self.enabled = int(options.get('enabled', self.ENABLED))
         self.post_to_sf = int(options.get('post_to_sf', self.POST_TO_SF))
@@ -365,6 +385,23 @@ class StatsSettings:
         self.traced_processes = self.TRACED_PROCESSES + \
             options.get('traced_processes', '').split()
 
+        self.buffered_store = int(options.get('buffered_store',
+                                              self.BUFFERED_STORE))
+        self.async_sampling = int(options.get('async_sampling',
+                                              self.ASYNC_SAMPLING))
+        self.stats_agent = int(options.get('stats_agent', self.STATS_AGENT))
+        self.shared_runtime = int(options.get('shared_runtime',
+                                              self.SHARED_RUNTIME))
+        self.local_cache = int(options.get('local_cache', self.LOCAL_CACHE))
+        self.sketches = int(options.get('sketches', self.SKETCHES))
+        self.response_cache = int(options.get('response_cache',
+                                              self.RESPONSE_CACHE))
+        self.adaptive_sampling = int(options.get('adaptive_sampling',
+                                                 self.ADAPTIVE_SAMPLING))
+        self.observe_rate = float(options.get('observe_rate', self.OBSERVE_RATE))
+        self.observe_probes = int(options.get('observe_probes',
+                                              self.OBSERVE_PROBES))
+
 
 class ProfilingSettings:
 
@@ -561,7 +598,19 @@ class PhaseSettings:
 
     ASYNC = False
 
+    AIO = False
+    AIO_CONCURRENCY = 256
+
+    MULTI_OPS = False
+
+    ENCODED_DOCS = False
+
     KEY_FMTR = 'decimal'
+    KEY_CACHE_SIZE = 0
+
+    LATENCY_RECORDER = 'reservoir'
+
+    ARRIVAL_PROCESS = 'closed'
 
     ITEMS = 0
     SIZE = 2048
@@ -726,7 +775,14 @@ class PhaseSettings:
                                                        self.WORKING_SET_MOVE_DOCS))
         self.workers = int(options.get('workers', self.WORKERS))
         self.async = bool(int(options.get('async', self.ASYNC)))
+        self.aio = bool(int(options.get('aio', self.AIO)))
+        self.aio_concurrency = int(options.get('aio_concurrency', self.AIO_CONCURRENCY))
+        self.multi_ops = bool(int(options.get('multi_ops', self.MULTI_OPS)))
+        self.encoded_docs = bool(int(options.get('encoded_docs', self.ENCODED_DOCS)))
         self.key_fmtr = options.get('key_fmtr', self.KEY_FMTR)
+        self.key_cache_size = int(options.get('key_cache_size', self.KEY_CACHE_SIZE))
+        self.latency_recorder = options.get('latency_recorder', self.LATENCY_RECORDER)
+        self.arrival_process = options.get('arrival_process', self.ARRIVAL_PROCESS)
 
         self.hot_reads = self.HOT_READS
         self.seq_upserts = self.SEQ_UPSERTS
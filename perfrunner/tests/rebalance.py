@@ -1,9 +1,12 @@
 import time
+from functools import partial
+from threading import Event, Thread
 
 import dateutil.parser
 
 from logger import logger
 from perfrunner.helpers.cbmonitor import timeit, with_stats
+from perfrunner.helpers.concurrency import TaskGraph
 from perfrunner.helpers.profiler import with_profiles
 from perfrunner.tests import PerfTest
 from perfrunner.tests.fts import FTSTest
@@ -51,6 +54,10 @@ class RebalanceTest(PerfTest):
         self.reporter.post(
             *self.metrics.rebalance_time(self.rebalance_time)
         )
+        if any(trace.task_type == 'rebalance' for trace in self.monitor.traces):
+            self.reporter.post(
+                *self.metrics.rebalance_rate(self.monitor.traces)
+            )
 
     @timeit
     def _rebalance(self, services):
@@ -59,6 +66,11 @@ class RebalanceTest(PerfTest):
         nodes_after = self.rebalance_settings.nodes_after
         swap = self.rebalance_settings.swap
 
+        # Nodes are added concurrently across clusters, the rebalance starts
+        # once every cluster is ready so that all clusters rebalance together
+        graph = TaskGraph()
+        added = []
+        rebalances = []
         for (_, servers), initial_nodes, nodes_after in zip(clusters,
                                                             initial_nodes,
                                                             nodes_after):
@@ -80,11 +92,23 @@ class RebalanceTest(PerfTest):
             else:
                 continue
 
+            after = []
             for node in new_nodes:
-                self.rest.add_node(master, node, services=services)
-
-            self.rest.rebalance(master, known_nodes, ejected_nodes)
-            self.monitor_progress(master)
+                after = [graph.add(('add_node', node),
+                                   partial(self.rest.add_node, master, node,
+                                           services=services),
+                                   after=after)]
+            added += after
+            rebalances.append((master, known_nodes, ejected_nodes))
+
+        for master, known_nodes, ejected_nodes in rebalances:
+            start = graph.add(('rebalance', master),
+                              partial(self.rest.rebalance, master, known_nodes,
+                                      ejected_nodes),
+                              after=added)
+            graph.add(('monitor', master), partial(self.monitor_progress, master),
+                      after=[start])
+        graph.run()
 
     def pre_rebalance(self):
         """Execute additional steps before rebalance."""
@@ -234,13 +258,17 @@ class RecoveryTest(RebalanceTest):
         clusters = self.cluster_spec.clusters
         initial_nodes = self.test_config.cluster.initial_nodes
 
+        graph = TaskGraph()
         for (_, servers), initial_nodes in zip(clusters, initial_nodes):
             master = servers[0]
 
-            self.rest.rebalance(master,
-                                known_nodes=servers[:initial_nodes],
-                                ejected_nodes=[])
-            self.monitor_progress(master)
+            start = graph.add(('rebalance', master),
+                              partial(self.rest.rebalance, master,
+                                      known_nodes=servers[:initial_nodes],
+                                      ejected_nodes=[]))
+            graph.add(('monitor', master), partial(self.monitor_progress, master),
+                      after=[start])
+        graph.run()
 
     def run(self):
         self.load()
@@ -265,13 +293,52 @@ class FailoverTest(RebalanceTest):
         t = dateutil.parser.parse(time_str, ignoretz=True)
         return float(t.strftime('%s.%f'))
 
+    FAILOVER_START = 'hard_failover_start'
+
+    LOG_POLLING_INTERVAL = 5
+
     def _failover(self):
         pass
 
+    def log_event(self, event):
+        logger.info('Detected {} at {}'.format(event.name, event.timestamp))
+
+    def follow_logs(self, follower, stopped: Event):
+        while not stopped.wait(self.LOG_POLLING_INTERVAL):
+            try:
+                follower.poll()
+            except Exception as e:
+                logger.warn('Failed to read the logs: {}'.format(e))
+
     def failover(self):
-        self.pre_rebalance()
-        self._failover()
-        self.post_rebalance()
+        follower = self.remote.log_follower(self.master_node)
+        for name in self.FAILOVER_START, 'failover_end':
+            follower.subscribe(name, self.log_event)
+
+        # The events are logged as they happen
+        stopped = Event()
+        thread = Thread(target=self.follow_logs, args=(follower, stopped))
+        thread.start()
+        try:
+            self.pre_rebalance()
+            self._failover()
+            self.post_rebalance()
+        finally:
+            stopped.set()
+            thread.join()
+
+    def _report_kpi(self, *args):
+        events = self.remote.log_events(self.master_node)
+        t_start = events.first(self.FAILOVER_START)
+        t_end = events.first('failover_end')
+
+        if t_end and t_start:
+            t_start = self.convert_time(t_start)
+            t_end = self.convert_time(t_end)
+            delta = int(1000 * (t_end - t_start))  # s -> ms
+            self.reporter.post(
+                *self.metrics.failover_time(delta)
+            )
 
     def run(self):
         self.load()
@@ -288,18 +355,6 @@ class FailoverTest(RebalanceTest):
 
 class HardFailoverTest(FailoverTest):
 
-    def _report_kpi(self, *args):
-        t_start = self.remote.detect_hard_failover_start(self.master_node)
-        t_end = self.remote.detect_failover_end(self.master_node)
-
-        if t_end and t_start:
-            t_start = self.convert_time(t_start)
-            t_end = self.convert_time(t_end)
-            delta = int(1000 * (t_end - t_start))  # s -> ms
-            self.reporter.post(
-                *self.metrics.failover_time(delta)
-            )
-
     def _failover(self, *args):
         clusters = self.cluster_spec.clusters
         initial_nodes = self.test_config.cluster.initial_nodes
@@ -317,17 +372,7 @@ class HardFailoverTest(FailoverTest):
 
 class GracefulFailoverTest(FailoverTest):
 
-    def _report_kpi(self, *args):
-        t_start = self.remote.detect_graceful_failover_start(self.master_node)
-        t_end = self.remote.detect_failover_end(self.master_node)
-
-        if t_end and t_start:
-            t_start = self.convert_time(t_start)
-            t_end = self.convert_time(t_end)
-            delta = int(1000 * (t_end - t_start))  # s -> ms
-            self.reporter.post(
-                *self.metrics.failover_time(delta)
-            )
+    FAILOVER_START = 'graceful_failover_start'
 
     def _failover(self, *args):
         clusters = self.cluster_spec.clusters
@@ -347,18 +392,6 @@ class GracefulFailoverTest(FailoverTest):
 
 class AutoFailoverTest(FailoverTest):
 
-    def _report_kpi(self, *args):
-        t_start = self.remote.detect_hard_failover_start(self.master_node)
-        t_end = self.remote.detect_failover_end(self.master_node)
-
-        if t_end and t_start:
-            t_start = self.convert_time(t_start)
-            t_end = self.convert_time(t_end)
-            delta = int(1000 * (t_end - t_start))  # s -> ms
-            self.reporter.post(
-                *self.metrics.failover_time(delta)
-            )
-
     def _failover(self, *args):
         clusters = self.cluster_spec.clusters
         initial_nodes = self.test_config.cluster.initial_nodes
@@ -374,8 +407,10 @@ class AutoFailoverTest(FailoverTest):
 
 class FailureDetectionTest(FailoverTest):
 
+    FAILOVER_START = 'auto_failover'
+
     def _report_kpi(self, *args):
-        t_failover = self.remote.detect_auto_failover(self.master_node)
+        t_failover = self.remote.log_events(self.master_node).first('auto_failover')
 
         if t_failover:
             t_failover = self.convert_time(t_failover)
@@ -8,6 +8,7 @@ import numpy
 
 from logger import logger
 from perfrunner.helpers.cbmonitor import timeit, with_stats
+from perfrunner.helpers.indexes import IndexProvisioner, index_definitions
 from perfrunner.helpers.local import (
     extract_cb_deb,
     get_indexer_heap_profile,
@@ -89,34 +90,33 @@ class SecondaryIndexTest(PerfTest):
         return self._build_secondaryindex()
 
     def _build_secondaryindex(self):
-        """Call cbindex create command."""
+        """Create deferred indexes with cbindex and build them."""
         logger.info('building secondary index..')
         if self.test_config.collection.collection_map:
-            self.remote.create_secondary_index_collections(
-                self.index_nodes,
-                self.indexes,
-                self.storage)
+            definitions = index_definitions(self.indexes)
+            provisioner = IndexProvisioner(self.remote, self.monitor, self.index_nodes[0],
+                                           self.storage)
+            provisioner.create(definitions)
 
             build_start = time.time()
 
-            self.remote.build_secondary_index_collections(
-                self.index_nodes,
-                self.indexes)
+            provisioner.build(definitions)
             self.monitor.wait_for_secindex_init_build_collections(
                 self.index_nodes[0],
                 self.indexes)
 
             time_elapsed = time.time() - build_start
         else:
-            self.remote.build_secondary_index(
-                self.index_nodes,
-                self.bucket,
-                self.indexes,
-                self.storage)
+            definitions = index_definitions(self.indexes, self.bucket)
+            provisioner = IndexProvisioner(self.remote, self.monitor, self.index_nodes[0],
+                                           self.storage, batch_process=False)
+            provisioner.create(definitions)
+            provisioner.build(definitions)
 
             time_elapsed = self.monitor.wait_for_secindex_init_build(
                 self.index_nodes[0],
-                list(self.indexes.keys()))
+                self.bucket,
+                self.indexes)
         return time_elapsed
 
     @staticmethod
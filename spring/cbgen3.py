@@ -1,6 +1,9 @@
 from datetime import timedelta
+from typing import List
 from urllib import parse
 
+from acouchbase.cluster import Cluster as AIOCluster
+from acouchbase.cluster import get_event_loop
 from couchbase.cluster import (
     Cluster,
     ClusterOptions,
@@ -9,17 +12,29 @@ from couchbase.cluster import (
 )
 from couchbase.management.collections import CollectionSpec
 from couchbase.management.users import User
+from couchbase.transcoder import RawJSONTranscoder
 from couchbase_core.cluster import PasswordAuthenticator
 from couchbase_core.views.params import ViewQuery
 from txcouchbase.cluster import TxCluster
 
 from spring.cbgen_helpers import backoff, quiet, timeit
 
+RAW_JSON = RawJSONTranscoder()
+
+
+def transcoder_options(doc) -> dict:
+    """Store documents that are already encoded as JSON bytes as they are."""
+    if isinstance(doc, bytes):
+        return {'transcoder': RAW_JSON}
+    return {}
+
 
 class CBAsyncGen3:
 
     TIMEOUT = 120  # seconds
 
+    CLUSTER = TxCluster
+
     def __init__(self, **kwargs):
         connection_string = 'couchbase://{host}?password={password}'
         connection_string = connection_string.format(host=kwargs['host'],
@@ -28,7 +43,7 @@ class CBAsyncGen3:
         pass_auth = PasswordAuthenticator(kwargs['username'], kwargs['password'])
         timeout = ClusterTimeoutOptions(kv_timeout=timedelta(seconds=self.TIMEOUT))
         options = ClusterOptions(authenticator=pass_auth, timeout_options=timeout)
-        self.cluster = TxCluster(connection_string=connection_string, options=options)
+        self.cluster = self.CLUSTER(connection_string=connection_string, options=options)
         self.bucket_name = kwargs['bucket']
         self.collections = dict()
         self.collection = None
@@ -53,7 +68,8 @@ class CBAsyncGen3:
         return self.collection.upsert(key, doc,
                                       persist_to=persist_to,
                                       replicate_to=replicate_to,
-                                      ttl=ttl)
+                                      ttl=ttl,
+                                      **transcoder_options(doc))
 
     def create_durable(self, *args, **kwargs):
         self.collection = self.collections[args[0]]
@@ -62,7 +78,8 @@ class CBAsyncGen3:
     def do_create_durable(self, key: str, doc: dict, durability: int = None, ttl: int = 0):
         return self.collection.upsert(key, doc,
                                       durability_level=durability,
-                                      ttl=ttl)
+                                      ttl=ttl,
+                                      **transcoder_options(doc))
 
     def read(self, *args, **kwargs):
         self.collection = self.collections[args[0]]
@@ -81,7 +98,8 @@ class CBAsyncGen3:
                                       doc,
                                       persist_to=persist_to,
                                       replicate_to=replicate_to,
-                                      ttl=ttl)
+                                      ttl=ttl,
+                                      **transcoder_options(doc))
 
     def update_durable(self, *args, **kwargs):
         self.collection = self.collections[args[0]]
@@ -90,7 +108,8 @@ class CBAsyncGen3:
     def do_update_durable(self, key: str, doc: dict, durability: int = None, ttl: int = 0):
         return self.collection.upsert(key, doc,
                                       durability_level=durability,
-                                      ttl=ttl)
+                                      ttl=ttl,
+                                      **transcoder_options(doc))
 
     def delete(self, *args, **kwargs):
         self.collection = self.collections[args[0]]
@@ -99,6 +118,60 @@ class CBAsyncGen3:
     def do_delete(self, key: str):
         return self.collection.remove(key)
 
+    def read_multi(self, *args, **kwargs):
+        self.collection = self.collections[args[0]]
+        return self.do_read_multi(*args[1:], **kwargs)
+
+    def do_read_multi(self, keys: List[str]):
+        return self.collection.get_multi(keys)
+
+    def update_multi(self, *args, **kwargs):
+        self.collection = self.collections[args[0]]
+        return self.do_update_multi(*args[1:], **kwargs)
+
+    def do_update_multi(self, docs: dict, persist_to: int = 0,
+                        replicate_to: int = 0, ttl: int = 0):
+        return self.collection.upsert_multi(docs,
+                                            persist_to=persist_to,
+                                            replicate_to=replicate_to,
+                                            ttl=ttl,
+                                            **transcoder_options(
+                                                next(iter(docs.values()), None)))
+
+    def update_durable_multi(self, *args, **kwargs):
+        self.collection = self.collections[args[0]]
+        return self.do_update_durable_multi(*args[1:], **kwargs)
+
+    def do_update_durable_multi(self, docs: dict, durability: int = None,
+                                ttl: int = 0):
+        return self.collection.upsert_multi(docs,
+                                            durability_level=durability,
+                                            ttl=ttl,
+                                            **transcoder_options(
+                                                next(iter(docs.values()), None)))
+
+    def delete_multi(self, *args, **kwargs):
+        self.collection = self.collections[args[0]]
+        return self.do_delete_multi(*args[1:], **kwargs)
+
+    def do_delete_multi(self, keys: List[str]):
+        return self.collection.remove_multi(keys)
+
+
+class CBAIOGen3(CBAsyncGen3):
+
+    """Same KV methods as CBAsyncGen3, which return asyncio futures."""
+
+    CLUSTER = AIOCluster
+
+    def __init__(self, **kwargs):
+        self.loop = get_event_loop()
+        super().__init__(**kwargs)
+
+    async def connect(self, scope_collection_list):
+        self.connect_collections(scope_collection_list)
+        await self.bucket.on_connect()
+
 
 class CBGen3(CBAsyncGen3):
 
@@ -197,6 +270,28 @@ class CBGen3(CBAsyncGen3):
     def do_delete(self, *args, **kwargs):
         super().do_delete(*args, **kwargs)
 
+    @quiet
+    @backoff
+    @timeit
+    def do_read_multi(self, *args, **kwargs):
+        super().do_read_multi(*args, **kwargs)
+
+    @quiet
+    @backoff
+    @timeit
+    def do_update_multi(self, *args, **kwargs):
+        super().do_update_multi(*args, **kwargs)
+
+    @quiet
+    @backoff
+    @timeit
+    def do_update_durable_multi(self, *args, **kwargs):
+        super().do_update_durable_multi(*args, **kwargs)
+
+    @quiet
+    def do_delete_multi(self, *args, **kwargs):
+        super().do_delete_multi(*args, **kwargs)
+
     @timeit
     def view_query(self, ddoc: str, view: str, query: ViewQuery):
         tuple(self.cluster.view_query(ddoc, view, query=query))
@@ -1,3 +1,4 @@
+import asyncio
 import random
 from collections import defaultdict
 from threading import Timer
@@ -91,3 +92,20 @@ def timeit(method: Callable, *args, **kwargs) -> float:
     t0 = time()
     method(*args, **kwargs)
     return time() - t0
+
+
+async def timeit_async(method: Callable, *args, **kwargs) -> float:
+    """Await the method like the quiet, backoff and timeit decorators do."""
+    retry_delay = 0.1  # Start with 100 ms
+    while True:
+        try:
+            t0 = time()
+            await method(*args, **kwargs)
+            return time() - t0
+        except TemporaryFailError:
+            await asyncio.sleep(retry_delay)
+            # Increase exponentially with jitter
+            retry_delay *= 1 + 0.1 * random.random()
+        except CouchbaseError as e:
+            error_tracker.track(method.__name__, e)
+            return
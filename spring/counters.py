@@ -0,0 +1,59 @@
+from multiprocessing import Lock, RawArray
+from typing import Dict, Iterator, List, Tuple
+
+
+class ItemCounters:
+
+    """Keep the [curr_items, deleted_items] counters of the targets in shared memory.
+
+    The counters are inherited by the forked workers, so reading them or
+    reserving a range of keys does not require a round-trip to a manager
+    process. Targets are striped over at most NUM_LOCKS locks, which are only
+    held for a couple of memory accesses.
+    """
+
+    NUM_LOCKS = 64
+
+    def __init__(self, counters: Dict[str, List[int]]):
+        self.index = {target: i for i, target in enumerate(counters)}
+        self.values = RawArray('l', 2 * len(counters))
+        self.locks = [Lock() for _ in range(min(len(counters), self.NUM_LOCKS))]
+        for target, (curr_items, deleted_items) in counters.items():
+            self[target] = curr_items, deleted_items
+
+    def _offset_and_lock(self, target: str) -> Tuple[int, Lock]:
+        i = self.index[target]
+        return 2 * i, self.locks[i % len(self.locks)]
+
+    def __contains__(self, target: str) -> bool:
+        return target in self.index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.index)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __getitem__(self, target: str) -> List[int]:
+        offset, lock = self._offset_and_lock(target)
+        with lock:
+            return [self.values[offset], self.values[offset + 1]]
+
+    def __setitem__(self, target: str, value: Tuple[int, int]):
+        offset, lock = self._offset_and_lock(target)
+        with lock:
+            self.values[offset], self.values[offset + 1] = value
+
+    def reserve(self, target: str, creates: int, deletes: int) -> Tuple[int, int]:
+        """Claim the next creates and deletes of the target.
+
+        Return the counters before the reservation, i.e. the first key to
+        create and the first key to delete.
+        """
+        offset, lock = self._offset_and_lock(target)
+        with lock:
+            curr_items = self.values[offset]
+            deleted_items = self.values[offset + 1]
+            self.values[offset] = curr_items + creates
+            self.values[offset + 1] = deleted_items + deletes
+        return curr_items, deleted_items
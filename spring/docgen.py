@@ -1,8 +1,11 @@
+import json
 import math
 import random
 import time
+from collections import defaultdict
 from datetime import datetime
-from typing import Iterator, List, Tuple
+from functools import lru_cache
+from typing import Iterable, Iterator, List, Tuple
 
 import numpy as np
 import spooky
@@ -40,6 +43,15 @@ def hex_digest(key: str) -> str:
     return '%032x' % spooky.hash128(key)
 
 
+def encode_json(doc) -> bytes:
+    """Encode a document like the default JSON transcoder of the SDK."""
+    return json.dumps(doc, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def encode_array(values: Iterable[int]) -> str:
+    return '[%s]' % ','.join(map(str, values))
+
+
 def decimal_fmtr(key: int, prefix: str) -> str:
     key = '%012d' % key
     if prefix:
@@ -61,6 +73,71 @@ def hex_fmtr(key: int, prefix: str) -> str:
     return key
 
 
+def format_key(number: int, prefix: str, fmtr: str) -> str:
+    if fmtr == 'hash':
+        return hash_fmtr(number, prefix)
+    if fmtr == 'hex':
+        return hex_fmtr(number, prefix)
+    return decimal_fmtr(number, prefix)
+
+
+def format_keys(numbers: Iterable[int], prefix: str, fmtr: str) -> List[str]:
+    """Format a sequence of key numbers, same as calling format_key for each.
+
+    The formatter is resolved once for the entire sequence.
+    """
+    if fmtr == 'hex':
+        keys = ['%036x' % int(OFFSET + (number * PRIME) % MAX_PRIME) ** 4
+                for number in numbers]
+    else:
+        keys = ['%012d' % number for number in numbers]
+    if prefix:
+        keys = ['%s-%s' % (prefix, key) for key in keys]
+    if fmtr == 'hash':
+        keys = [('%032x' % spooky.hash128(key))[:HASH_LENGTH] for key in keys]
+    return keys
+
+
+_format_key = format_key
+
+
+def configure_key_cache(size: int):
+    """Enable or disable the process-wide cache of key strings.
+
+    The cache is shared by all key generators of the process and keeps up to
+    `size` most recently used strings. Zero disables caching.
+    """
+    global _format_key
+    if size:
+        _format_key = lru_cache(maxsize=size)(format_key)
+    else:
+        _format_key = format_key
+
+
+def key_cache_info():
+    """Return the (hits, misses, maxsize, currsize) tuple of the key cache."""
+    if _format_key is format_key:
+        return None
+    return _format_key.cache_info()
+
+
+def format_key_strings(keys: Iterable['Key']):
+    """Format the strings of many keys with format_keys.
+
+    With the key cache, the strings are left to the cache, which is cheaper
+    than formatting them again.
+    """
+    if _format_key is not format_key:
+        return
+    groups = defaultdict(list)
+    for key in keys:
+        groups[key.prefix, key.fmtr].append(key)
+    for (prefix, fmtr), group in groups.items():
+        strings = format_keys([key.number for key in group], prefix, fmtr)
+        for key, string in zip(group, strings):
+            key._string = string
+
+
 class Key:
 
     def __init__(self, number: int, prefix: str, fmtr: str, hit: bool = False):
@@ -68,14 +145,13 @@ class Key:
         self.prefix = prefix
         self.hit = hit
         self.fmtr = fmtr
+        self._string = None
 
     @property
     def string(self) -> str:
-        if self.fmtr == 'hash':
-            return hash_fmtr(self.number, self.prefix)
-        if self.fmtr == 'hex':
-            return hex_fmtr(self.number, self.prefix)
-        return decimal_fmtr(self.number, self.prefix)
+        if self._string is None:
+            self._string = _format_key(self.number, self.prefix, self.fmtr)
+        return self._string
 
 
 class NewOrderedKey:
@@ -310,7 +386,7 @@ class String:
 
     @staticmethod
     def build_alphabet(key: str) -> str:
-        return hex_digest(key) + hex_digest(key[::-1])
+        return '%032x%032x' % (spooky.hash128(key), spooky.hash128(key[::-1]))
 
     @staticmethod
     def build_string(alphabet: str, length: float) -> str:
@@ -319,11 +395,21 @@ class String:
         body = num_slices * alphabet
         return body[:length_int]
 
+    def build_alphabets(self, keys: List[Key]) -> List[str]:
+        build_alphabet = self.build_alphabet
+        return [build_alphabet(key.string) for key in keys]
+
     def next(self, key: Key) -> str:
         alphabet = self.build_alphabet(key.string)
 
         return self.build_string(alphabet, self.avg_size)
 
+    def next_batch(self, keys: List[Key]) -> list:
+        return [self.next(key) for key in keys]
+
+    def next_encoded_batch(self, keys: List[Key]) -> List[bytes]:
+        return [encode_json(doc) for doc in self.next_batch(keys)]
+
 
 class IncompressibleString(String):
 
@@ -344,10 +430,19 @@ class Document(String):
 
     OVERHEAD = 210  # Minimum size due to static fields, body size is variable
 
+    JSON_TEMPLATE = '{"name":"%s","email":"%s","alt_email":"%s","city":"%s",' \
+                    '"realm":"%s","coins":%r,"category":%d,"achievements":%s,' \
+                    '"body":"%s"}'
+
     @classmethod
     def _get_variation_coeff(cls) -> float:
         return np.random.uniform(1 - cls.SIZE_VARIATION, 1 + cls.SIZE_VARIATION)
 
+    @classmethod
+    def _get_variation_coeffs(cls, num_docs: int) -> np.ndarray:
+        return np.random.uniform(1 - cls.SIZE_VARIATION, 1 + cls.SIZE_VARIATION,
+                                 size=num_docs)
+
     @staticmethod
     def build_name(alphabet: str) -> str:
         return '%s %s' % (alphabet[:6], alphabet[6:12])  # % is faster than format()
@@ -418,10 +513,63 @@ class Document(String):
             return 0
         return self._get_variation_coeff() * (self.avg_size - self.OVERHEAD)
 
+    def _sizes(self, num_docs: int) -> Iterable[float]:
+        """Return the body sizes of the next `num_docs` documents.
+
+        A single array draw yields exactly the same coefficients as calling
+        `_size` `num_docs` times in a row.
+        """
+        if self.avg_size <= self.OVERHEAD:
+            return [0] * num_docs
+        return self._get_variation_coeffs(num_docs) * (self.avg_size - self.OVERHEAD)
+
     def next(self, key: Key) -> dict:
         alphabet = self.build_alphabet(key.string)
         size = self._size()
 
+        return self._build(key, alphabet, size)
+
+    def next_batch(self, keys: List[Key]) -> List[dict]:
+        """Generate one document per key, same as calling `next` repeatedly.
+
+        Alphabets and body sizes are computed for the entire batch upfront.
+        Generators that override `next` do not split the document body from
+        the alphabet and size, so they fall back to one document at a time.
+        """
+        if type(self).next is not Document.next:
+            return super().next_batch(keys)
+
+        alphabets = self.build_alphabets(keys)
+        sizes = self._sizes(len(keys))
+        build = self._build
+        return [build(key, alphabet, size)
+                for key, alphabet, size in zip(keys, alphabets, sizes)]
+
+    def _get_encoder(self):
+        """Return the _encode method that matches _build, if there is one."""
+        for cls in type(self).__mro__:
+            if '_build' in vars(cls):
+                if '_encode' in vars(cls):
+                    return self._encode
+                return
+
+    def next_encoded_batch(self, keys: List[Key]) -> List[bytes]:
+        """Return the same documents as `next_batch`, encoded as JSON.
+
+        Generators that implement `_encode` fill the values of every document
+        into a string template instead of building and serializing a dict.
+        The others fall back to `encode_json`.
+        """
+        encode = self._get_encoder()
+        if encode is None or type(self).next is not Document.next:
+            return super().next_encoded_batch(keys)
+
+        alphabets = self.build_alphabets(keys)
+        sizes = self._sizes(len(keys))
+        return [encode(key, alphabet, size)
+                for key, alphabet, size in zip(keys, alphabets, sizes)]
+
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
         return {
             'name': self.build_name(alphabet),
             'email': self.build_email(alphabet),
@@ -434,6 +582,19 @@ class Document(String):
             'body': self.build_string(alphabet, size),
         }
 
+    def _encode(self, key: Key, alphabet: str, size: float) -> bytes:
+        return (self.JSON_TEMPLATE % (
+            self.build_name(alphabet),
+            self.build_email(alphabet),
+            self.build_alt_email(alphabet),
+            self.build_city(alphabet),
+            self.build_realm(alphabet),
+            self.build_coins(alphabet),
+            self.build_category(alphabet),
+            encode_array(self.build_achievements(alphabet)),
+            self.build_string(alphabet, size),
+        )).encode()
+
 
 class GroupedDocument(Document):
 
@@ -441,10 +602,7 @@ class GroupedDocument(Document):
         super().__init__(avg_size)
         self.groups = groups
 
-    def next(self, key: Key) -> dict:
-        alphabet = self.build_alphabet(key.string)
-        size = self._size()
-
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
         return {
             'doc_group': key.number % self.groups,
             'name': self.build_name(alphabet),
@@ -475,10 +633,7 @@ class LargeItemGroupedDocument(GroupedDocument):
             return prefix + "-" + body[num:length] + body[0:num]
         return body[num:length] + body[0:num]
 
-    def next(self, key: Key) -> dict:
-        alphabet = self.build_alphabet(key.string)
-        size = self._size()
-
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
         return {
             'doc_group': key.number % self.groups,
             'name': self.build_name(alphabet),
@@ -529,10 +684,7 @@ class LargeItemGroupedDocumentKeySize(GroupedDocument):
 
 class EventingCounterDocument(Document):
 
-    def next(self, key: Key) -> dict:
-        alphabet = self.build_alphabet(key.string)
-        size = self._size()
-
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
         return {
             'name': self.build_name(alphabet),
             'email': self.build_email(alphabet),
@@ -550,6 +702,14 @@ class NestedDocument(Document):
 
     OVERHEAD = 450  # Minimum size due to static fields, body size is variable
 
+    JSON_TEMPLATE = '{"name":{"f":{"f":{"f":"%s"}}},"email":{"f":{"f":"%s"}},' \
+                    '"alt_email":{"f":{"f":"%s"}},"street":{"f":{"f":"%s"}},' \
+                    '"city":{"f":{"f":"%s"}},"county":{"f":{"f":"%s"}},' \
+                    '"state":{"f":"%s"},"full_state":{"f":"%s"},' \
+                    '"country":{"f":"%s"},"realm":{"f":"%s"},"coins":{"f":%r},' \
+                    '"category":%d,"achievements":%s,"gmtime":%s,"year":%d,' \
+                    '"body":"%s"}'
+
     def __init__(self, avg_size: int):
         super().__init__(avg_size)
         self.capped_field_value = {}  # type: dict
@@ -563,10 +723,13 @@ class NestedDocument(Document):
         else:  # Outliers - beta distribution, 2KB-2MB range
             return 2048 / np.random.beta(a=2.2, b=1.0)
 
-    def next(self, key: Key):
-        alphabet = self.build_alphabet(key.string)
-        size = self._size()
+    def _sizes(self, num_docs: int) -> Iterable[float]:
+        # Sizes depend on both random generators, which the field builders use
+        # as well. Drawing them lazily keeps the sequence of random numbers
+        # identical to the one of `next`.
+        return (self._size() for _ in range(num_docs))
 
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
         return {
             'name': {'f': {'f': {'f': self.build_name(alphabet)}}},
             'email': {'f': {'f': self.build_email(alphabet)}},
@@ -586,6 +749,26 @@ class NestedDocument(Document):
             'body': self.build_string(alphabet, size),
         }
 
+    def _encode(self, key: Key, alphabet: str, size: float) -> bytes:
+        return (self.JSON_TEMPLATE % (
+            self.build_name(alphabet),
+            self.build_email(alphabet),
+            self.build_alt_email(alphabet),
+            self.build_street(alphabet),
+            self.build_city(alphabet),
+            self.build_county(alphabet),
+            self.build_state(alphabet),
+            self.build_full_state(alphabet),
+            self.build_country(alphabet),
+            self.build_realm(alphabet),
+            self.build_coins(alphabet),
+            self.build_category(alphabet),
+            encode_array(self.build_achievements(alphabet)),
+            encode_array(self.build_gmtime(alphabet)),
+            self.build_year(alphabet),
+            self.build_string(alphabet, size),
+        )).encode()
+
 
 class LargeDocument(Document):
 
@@ -593,6 +776,12 @@ class LargeDocument(Document):
 
     TEXT_LENGTH = 128
 
+    JSON_TEMPLATE = '{"id":"%s","revered_id":"%s","code":"%s","name":"%s",' \
+                    '"email":"%s","city":"%s","county":"%s","state":"%s",' \
+                    '"full_state":"%s","country":"%s","realm":"%s","coins":%r,' \
+                    '"category":%d,"achievements":%s,"gmtime":%s,"year":%d,' \
+                    '"padding":"%s","notes":"%s","text":"%s","lorem":"%s"}'
+
     @staticmethod
     def build_string(alphabet: str, length: float) -> str:
         length_int = int(length)
@@ -602,9 +791,8 @@ class LargeDocument(Document):
             body += hex_digest(alphabet)
         return body[:length_int]
 
-    def next(self, key: Key) -> dict:
-        alphabet = self.build_alphabet(key.string)
-        size = self._size() / 3
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
+        size /= 3
         offset = (PRIME * key.number) % (len(LOREM) - self.TEXT_LENGTH)
 
         return {
@@ -630,6 +818,33 @@ class LargeDocument(Document):
             'lorem': LOREM[offset:offset + self.TEXT_LENGTH],
         }
 
+    def _encode(self, key: Key, alphabet: str, size: float) -> bytes:
+        size /= 3
+        offset = (PRIME * key.number) % (len(LOREM) - self.TEXT_LENGTH)
+
+        return (self.JSON_TEMPLATE % (
+            alphabet,
+            alphabet[::-1],
+            hex_digest(alphabet),
+            self.build_name(alphabet),
+            self.build_email(alphabet),
+            self.build_city(alphabet),
+            self.build_county(alphabet),
+            self.build_state(alphabet),
+            self.build_full_state(alphabet),
+            self.build_country(alphabet),
+            self.build_realm(alphabet),
+            self.build_coins(alphabet),
+            self.build_category(alphabet),
+            encode_array(self.build_achievements(alphabet)),
+            encode_array(self.build_gmtime(alphabet)),
+            self.build_year(alphabet),
+            self.build_string(alphabet, size),
+            self.build_string(alphabet[::-1], size),
+            self.build_string(alphabet[:16], size),
+            LOREM[offset:offset + self.TEXT_LENGTH],
+        )).encode()
+
 
 class ReverseLookupDocument(NestedDocument):
 
@@ -660,10 +875,7 @@ class ReverseLookupDocument(NestedDocument):
     def build_topics(self, seq_id: int) -> List[str]:
         return []
 
-    def next(self, key: Key) -> dict:
-        alphabet = self.build_alphabet(key.string)
-        size = self._size()
-
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
         return {
             'name': self.build_name(alphabet),
             'email': self.build_email(alphabet),
@@ -706,10 +918,7 @@ class ReverseRangeLookupDocument(ReverseLookupDocument):
         index = seq_id // num_unique
         return '%s_%d_%012d' % (self.prefix, num_unique, index)
 
-    def next(self, key: Key) -> dict:
-        alphabet = self.build_alphabet(key.string)
-        size = self._size()
-
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
         return {
             'name': self.build_name(alphabet),
             'email': self.build_email(alphabet),
@@ -739,9 +948,7 @@ class HashJoinDocument(ReverseRangeLookupDocument):
 
     OVERHEAD = 415
 
-    def next(self, key: Key) -> dict:
-        alphabet = self.build_alphabet(key.string)
-        size = self._size()
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
         capped_range = key.number + self.distance * 100
 
         return {
@@ -933,10 +1140,7 @@ class ArrayIndexingDocument(ReverseLookupDocument):
 
         return [int(offset + i) for i in range(self.ARRAY_SIZE)]
 
-    def next(self, key: Key) -> dict:
-        alphabet = self.build_alphabet(key.string)
-        size = self._size()
-
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
         return {
             'name': self.build_name(alphabet),
             'email': self.build_email(alphabet),
@@ -977,10 +1181,7 @@ class ArrayIndexingUniqueDocument(ReverseLookupDocument):
 
         return [int(offset + i) for i in range(self.array_size)]
 
-    def next(self, key: Key) -> dict:
-        alphabet = self.build_alphabet(key.string)
-        size = self._size()
-
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
         return {
             'name': self.build_name(alphabet),
             'email': self.build_email(alphabet),
@@ -1025,10 +1226,7 @@ class ArrayIndexingRangeScanDocument(ReverseLookupDocument):
 
         return [int(offset + i) for i in range(self.array_size)]
 
-    def next(self, key: Key) -> dict:
-        alphabet = self.build_alphabet(key.string)
-        size = self._size()
-
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
         return {
             'name': self.build_name(alphabet),
             'email': self.build_email(alphabet),
@@ -1078,9 +1276,7 @@ class ProfileDocument(ReverseLookupDocument):
 
         return '%d %s %s %s' % (num, capped_small, capped_large, suffix)
 
-    def next(self, key: Key) -> dict:
-        alphabet = self.build_alphabet(key.string)
-        size = self._size()
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
 
         category = self.build_category(alphabet) + 1
         capped_large = self.build_capped(alphabet, key.number, 1000 * category)
@@ -1117,9 +1313,7 @@ class ImportExportDocument(ReverseLookupDocument):
 
     OVERHEAD = 1022
 
-    def next(self, key: Key) -> dict:
-        alphabet = self.build_alphabet(key.string)
-        size = self._size()
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
         return {
             'name': self.build_name(alphabet) * random.randint(0, 5),
             'email': self.build_email(alphabet) * random.randint(0, 5),
@@ -1182,9 +1376,7 @@ class ImportExportDocumentArray(ImportExportDocument):
         result = [value[0 if i == 0 else scope[i - 1]:i + scope[i]] for i in range(num)]
         return result
 
-    def next(self, key: Key) -> dict:
-        alphabet = self.build_alphabet(key.string)
-        size = self._size()
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
 
         # 25 Fields of random size. Have an array with at least 10 items in five fields.
         return {
@@ -1243,10 +1435,7 @@ class ImportExportDocumentNested(ImportExportDocument):
     The documents contain 25 top-level fields (5 nested sub-documents).
     """
 
-    def next(self, key: Key) -> dict:
-        alphabet = self.build_alphabet(key.string)
-        size = self._size()
-
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
         return {
             'name': {'n': {'a': {'m': {'e': self.build_name(
                 alphabet) * random.randint(0, 3)}}}},
@@ -1299,10 +1488,7 @@ class ImportExportDocumentNested(ImportExportDocument):
 
 class GSIMultiIndexDocument(Document):
 
-    def next(self, key: Key) -> dict:
-        alphabet = self.build_alphabet(key.string)
-        size = self._size()
-
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
         return {
             'name': self.build_alt_email(alphabet),
             'email': self.build_email(alphabet),
@@ -1371,10 +1557,7 @@ class LargeItemPlasmaDocument(PlasmaDocument):
         super().__init__(avg_size)
         self.item_size = item_size
 
-    def next(self, key: Key) -> dict:
-        alphabet = self.build_alphabet(key.string)
-        size = self._size()
-
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
         return {
             'name': self.build_name(alphabet),
             'email': self.build_email(alphabet),
@@ -1396,9 +1579,7 @@ class VaryingItemSizePlasmaDocument(PlasmaDocument):
         self.size_variation_min = size_variation_min
         self.size_variation_max = size_variation_max
 
-    def next(self, key: Key) -> dict:
-        alphabet = self.build_alphabet(key.string)
-        size = self._size()
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
         length = random.randint(self.size_variation_min, self.size_variation_max)
 
         return {
@@ -1422,9 +1603,7 @@ class HundredIndexDocument(PlasmaDocument):
         self.size_variation_min = size_variation_min
         self.size_variation_max = size_variation_max
 
-    def next(self, key: Key) -> dict:
-        alphabet = self.build_alphabet(key.string)
-        size = self._size()
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
         length = random.randint(self.size_variation_min, self.size_variation_max)
 
         return {
@@ -1539,6 +1718,12 @@ class TpcDsDocument:
             'zip_codes': self.zip_codes,
         }
 
+    def next_batch(self, keys: List[Key]) -> List[dict]:
+        return [self.next() for _ in keys]
+
+    def next_encoded_batch(self, keys: List[Key]) -> List[bytes]:
+        return [encode_json(doc) for doc in self.next_batch(keys)]
+
 
 class PackageDocument(Document):
 
@@ -1605,6 +1790,12 @@ class BigFunDocument:
             'send_time_large': query_gen.bf08params(num_matches=1e6),
         }
 
+    def next_batch(self, keys: List[Key]) -> List[dict]:
+        return [self.next() for _ in keys]
+
+    def next_encoded_batch(self, keys: List[Key]) -> List[bytes]:
+        return [encode_json(doc) for doc in self.next_batch(keys)]
+
 
 class MultiBucketDocument(Document):
 
@@ -1647,9 +1838,8 @@ class AdvFilterDocument(Document):
             body += hex_digest(alphabet)
         return body[:length_int]
 
-    def next(self, key: Key) -> dict:
-        alphabet = self.build_alphabet(key.string)
-        size = self._size() / 3
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
+        size /= 3
         offset = (PRIME * key.number) % (len(LOREM) - self.TEXT_LENGTH)
         identifier = key.string.split("-")[1]
 
@@ -1682,9 +1872,8 @@ class AdvFilterDocument(Document):
 
 class AdvFilterXattrBody(AdvFilterDocument):
 
-    def next(self, key: Key) -> dict:
-        alphabet = self.build_alphabet(key.string)
-        size = self._size() / 3
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
+        size /= 3
         identifier = key.string.split("-")[1]
 
         return {
@@ -1700,9 +1889,8 @@ class LargeGroupedDocument(LargeDocument):
         super().__init__(avg_size)
         self.groups = groups
 
-    def next(self, key: Key) -> dict:
-        alphabet = self.build_alphabet(key.string)
-        size = self._size() / 3
+    def _build(self, key: Key, alphabet: str, size: float) -> dict:
+        size /= 3
         offset = (PRIME * key.number) % (len(LOREM) - self.TEXT_LENGTH)
 
         return {
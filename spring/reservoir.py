@@ -1,9 +1,53 @@
-import csv
+import json
+import os
 import random
+import struct
 import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
 
 from logger import logger
 
+PRECISION = 8  # Bits of the sub-bucket counter, 2 ** -7 ~ 0.8% relative error
+
+MAX_VALUE = 2 ** 36  # Microseconds, about 19 hours
+
+NUM_BUCKETS = ((MAX_VALUE - 1).bit_length() - PRECISION + 2) << (PRECISION - 1)
+
+UNIT = 10 ** 6  # Values are recorded in microseconds
+
+
+def bucket_index(value: float) -> int:
+    """Map a latency value in seconds to its log-linear bucket index.
+
+    Values below 2 ** PRECISION microseconds have their own buckets. Above that
+    every power of two is split into 2 ** (PRECISION - 1) equal buckets, like
+    in HDR Histogram.
+    """
+    value = max(min(int(value * UNIT), MAX_VALUE - 1), 0)
+    shift = max(value.bit_length() - PRECISION, 0)
+    return (shift << (PRECISION - 1)) + (value >> shift)
+
+
+def bucket_value(indexes: np.ndarray) -> np.ndarray:
+    """Return the midpoint (in seconds) of the given buckets."""
+    indexes = np.asarray(indexes, dtype=np.int64)
+    shift = np.maximum((indexes >> (PRECISION - 1)) - 1, 0)
+    lower = (indexes - (shift << (PRECISION - 1))) << shift
+    return (lower + ((1 << shift) - 1) / 2) / UNIT
+
+
+def percentiles(counts: np.ndarray, qs: Iterable[float]) -> List[float]:
+    """Return the given percentiles, from 0 to 100, of the bucket counts."""
+    cumulative = np.cumsum(counts)
+    total = cumulative[-1]
+    if not total:
+        return [0.0 for _ in qs]
+    ranks = np.ceil(np.asarray(qs, dtype=np.float64) / 100 * total)
+    indexes = np.searchsorted(cumulative, np.maximum(ranks, 1))
+    return bucket_value(indexes).tolist()
+
 
 class Reservoir:
 
@@ -14,6 +58,12 @@ class Reservoir:
 
     MAX_CAPACITY = 10 ** 5
 
+    SUFFIX = '.lat'
+
+    MAGIC = b'LAT1'
+
+    RECORD = np.dtype([('op', 'u1'), ('ts', '<i8'), ('latency', '<f4')])
+
     def __init__(self, num_workers: int = 1):
         self.capacity = self.MAX_CAPACITY // num_workers
         self.values = []
@@ -35,9 +85,230 @@ class Reservoir:
                 self.values[r] = (operation, timestamp, value)
 
     def dump(self, filename: str):
-        """Write all measurements to a local CSV file."""
+        """Write all measurements to a local binary file.
+
+        The file starts with MAGIC, the length of the header and the header,
+        which is the JSON list of operations. It is followed by fixed-size
+        RECORD entries: the index of the operation, the timestamp in
+        nanoseconds and the latency in seconds.
+        """
+        filename += self.SUFFIX
         logger.info('Writing measurements to {}'.format(filename))
-        with open(filename, 'w') as fh:
-            writer = csv.writer(fh)
-            for operation, timestamp, value in self.values:
-                writer.writerow([operation, timestamp, value])
+        operations = sorted({operation for operation, _, _ in self.values})
+        codes = {operation: code for code, operation in enumerate(operations)}
+
+        records = np.empty(len(self.values), dtype=self.RECORD)
+        if self.values:
+            ops, timestamps, values = zip(*self.values)
+            records['op'] = [codes[operation] for operation in ops]
+            records['ts'] = timestamps
+            records['latency'] = values
+
+        header = json.dumps(operations).encode()
+        with open(filename, 'wb') as fh:
+            fh.write(self.MAGIC + struct.pack('<I', len(header)) + header)
+            records.tofile(fh)
+
+    @classmethod
+    def load(cls, filename: str) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """Map a dump into memory and split it into per-operation arrays.
+
+        Return the timestamps and latencies of every operation.
+        """
+        with open(filename, 'rb') as fh:
+            if fh.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError('Unsupported latency file: {}'.format(filename))
+            size, = struct.unpack('<I', fh.read(4))
+            operations = json.loads(fh.read(size).decode())
+
+        offset = len(cls.MAGIC) + 4 + size
+        count = (os.path.getsize(filename) - offset) // cls.RECORD.itemsize
+        if not count:
+            return {}
+        records = np.memmap(filename, dtype=cls.RECORD, mode='r',
+                            offset=offset, shape=(count,))
+        stats = {}
+        for code, operation in enumerate(operations):
+            selected = records[records['op'] == code]
+            stats[operation] = selected['ts'], selected['latency']
+        return stats
+
+
+class LatencyHistogram:
+
+    """Record every measurement in log-linear histograms.
+
+    There is one histogram per operation for the entire run and one per
+    operation and time window. Percentiles are exact up to the bucket width
+    (see PRECISION), and the memory usage does not depend on the number of
+    measurements. Closed windows only keep their non-empty buckets, and the
+    windows are merged in pairs when there are more than MAX_WINDOWS of them,
+    so long runs only get a coarser time series.
+    """
+
+    SUFFIX = '.hdr'
+
+    WINDOW = 10 ** 9  # 1 second, in nanoseconds
+
+    MAX_WINDOWS = 3600
+
+    def __init__(self, num_workers: int = 1):  # Same signature as Reservoir
+        self.window = self.WINDOW
+        self.totals = {}  # type: dict
+        self.windows = {}  # type: dict
+        self.current = {}  # type: dict
+
+    def update(self, operation: str, value: float):
+        """Add a new measurement to the histogram of the current window."""
+        if not value:  # Ignore bad results
+            return
+
+        timestamp = int(time.time() * 10 ** 9)
+        start = timestamp - timestamp % self.window
+
+        current = self.current.get(operation)
+        if current is None or current[0] != start:
+            self._close_window(operation)
+            current = self.current[operation] = start, \
+                np.zeros(NUM_BUCKETS, dtype=np.uint32)
+
+        current[1][bucket_index(value)] += 1
+
+    def _close_window(self, operation: str):
+        if operation not in self.current:
+            return
+        start, counts = self.current.pop(operation)
+
+        if operation not in self.totals:
+            self.totals[operation] = np.zeros(NUM_BUCKETS, dtype=np.uint64)
+            self.windows[operation] = []
+        self.totals[operation] += counts
+
+        buckets = np.flatnonzero(counts)
+        start -= start % self.window  # The window may predate the last compaction
+        timestamps = np.full(buckets.size, start, dtype=np.int64)
+        self.windows[operation].append(
+            (timestamps, buckets.astype(np.uint16), counts[buckets])
+        )
+        if len(self.windows[operation]) > self.MAX_WINDOWS:
+            self._compact()
+
+    def _compact(self):
+        """Double the window length and merge the windows that fall together."""
+        self.window *= 2
+        for operation, windows in self.windows.items():
+            timestamps, buckets, counts = map(np.concatenate, zip(*windows))
+            timestamps -= timestamps % self.window
+            pairs, inverse = np.unique(
+                np.stack((timestamps, buckets.astype(np.int64)), axis=1),
+                axis=0, return_inverse=True)
+            counts = np.bincount(inverse, weights=counts).astype(np.uint32)
+            splits = np.flatnonzero(np.diff(pairs[:, 0])) + 1
+            self.windows[operation] = [
+                (window[:, 0], window[:, 1].astype(np.uint16), window_counts)
+                for window, window_counts in zip(np.split(pairs, splits),
+                                                 np.split(counts, splits))
+            ]
+
+    def close(self):
+        for operation in list(self.current):
+            self._close_window(operation)
+
+    def merge(self, other: 'LatencyHistogram'):
+        """Add all measurements of another histogram to this one."""
+        self.close()
+        other.close()
+        for operation, counts in other.totals.items():
+            if operation not in self.totals:
+                self.totals[operation] = np.zeros(NUM_BUCKETS, dtype=np.uint64)
+                self.windows[operation] = []
+            self.totals[operation] += counts
+            self.windows[operation] += other.windows[operation]
+
+    def count(self, operation: str) -> int:
+        self.close()
+        return int(self.totals[operation].sum())
+
+    def percentiles(self, operation: str, qs: Iterable[float]) -> List[float]:
+        self.close()
+        return percentiles(self.totals[operation], qs)
+
+    def series(self, operation: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return the timestamps, bucket indexes and counts of all windows."""
+        self.close()
+        timestamps, buckets, counts = zip(*self.windows[operation])
+        return np.concatenate(timestamps), np.concatenate(buckets), \
+            np.concatenate(counts)
+
+    def dump(self, filename: str):
+        """Write all windows to a local binary file in the NumPy NPZ format."""
+        filename += self.SUFFIX
+        logger.info('Writing measurements to {}'.format(filename))
+        operations = sorted(self.totals.keys() | self.current.keys())
+        arrays = {}
+        for operation in operations:
+            timestamps, buckets, counts = self.series(operation)
+            arrays['{}_timestamps'.format(operation)] = timestamps
+            arrays['{}_buckets'.format(operation)] = buckets
+            arrays['{}_counts'.format(operation)] = counts
+        with open(filename, 'wb') as fh:
+            np.savez_compressed(fh,
+                                operations=np.array(operations),
+                                precision=PRECISION,
+                                **arrays)
+
+    @classmethod
+    def load_all(cls, filenames: Iterable[str]) -> Optional['LatencyHistogram']:
+        """Merge the histogram dumps among the given files, if there are any."""
+        histogram = None
+        for filename in filenames:
+            if filename.endswith(cls.SUFFIX):
+                histogram = histogram or cls()
+                histogram.merge(cls.load(filename))
+        return histogram
+
+    @classmethod
+    def load(cls, filename: str) -> 'LatencyHistogram':
+        histogram = cls()
+        with np.load(filename) as data:
+            if int(data['precision']) != PRECISION:
+                raise ValueError('Unsupported histogram precision in {}'
+                                 .format(filename))
+            for operation in data['operations'].tolist():
+                timestamps = data['{}_timestamps'.format(operation)]
+                buckets = data['{}_buckets'.format(operation)]
+                counts = data['{}_counts'.format(operation)]
+
+                totals = np.zeros(NUM_BUCKETS, dtype=np.uint64)
+                np.add.at(totals, buckets, counts)
+                histogram.totals[operation] = totals
+                histogram.windows[operation] = [(timestamps, buckets, counts)]
+        return histogram
+
+    def samples(self, max_samples: int) -> Iterator[Tuple[str, int, float]]:
+        """Expand the windows into (operation, timestamp, value) samples."""
+        for operation, timestamps, values in self.sample_arrays(max_samples):
+            for timestamp, value in zip(timestamps.tolist(), values.tolist()):
+                yield operation, timestamp, value
+
+    def sample_arrays(self, max_samples: int) -> Iterator[tuple]:
+        """Expand the windows into the timestamps and values of every operation.
+
+        When there are more measurements than max_samples, every window and
+        bucket is thinned by the same ratio so that the shape of the
+        distribution and its evolution over time are preserved.
+        """
+        self.close()
+        total = sum(int(counts.sum()) for counts in self.totals.values())
+        ratio = min(1, max_samples / total) if total else 1
+
+        for operation in sorted(self.totals):
+            timestamps, buckets, counts = self.series(operation)
+            order = np.lexsort((buckets, timestamps))
+            timestamps, buckets, counts = \
+                timestamps[order], buckets[order], counts[order]
+
+            expanded = np.floor(np.cumsum(counts, dtype=np.float64) * ratio)
+            repeats = np.diff(np.concatenate(([0], expanded))).astype(np.int64)
+            values = bucket_value(buckets)
+            yield operation, np.repeat(timestamps, repeats), np.repeat(values, repeats)
@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+import numpy as np
+
+
+class ArrivalSchedule:
+
+    """Plan the start time of every operation of an open-loop worker.
+
+    Arrivals are either evenly spaced ("constant") or follow a Poisson process
+    ("poisson") with the given mean rate. They do not depend on how fast the
+    server responds: when an operation starts late, the next ones are not
+    delayed, and the lag is added to the measured latency to account for the
+    queueing delay (coordinated omission).
+    """
+
+    CHUNK = 10 ** 4  # Number of arrival times generated at once
+
+    PROCESSES = 'constant', 'poisson'
+
+    def __init__(self, rate: float, process: str = 'constant', seed: int = 0):
+        if process not in self.PROCESSES:
+            raise ValueError('Unknown arrival process: {}'.format(process))
+        self.interval = 1 / rate
+        self.process = process
+        self.rng = np.random.RandomState(seed)  # Keep the workload RNG intact
+
+        # Spread the first arrivals of the workers over one interval
+        self.start = time.time() + self.rng.random_sample() * self.interval
+        self.times = np.empty(0)
+        self.position = 0
+
+        self.ops = 0
+        self.late_ops = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+
+    def gaps(self, size: int) -> np.ndarray:
+        if self.process == 'poisson':
+            return self.rng.exponential(self.interval, size)
+        return np.full(size, self.interval)
+
+    def next_time(self) -> float:
+        if self.position == len(self.times):
+            self.times = self.start + np.cumsum(self.gaps(self.CHUNK))
+            self.start = self.times[-1]
+            self.position = 0
+        intended = self.times[self.position]
+        self.position += 1
+        return intended
+
+    def wait(self) -> float:
+        """Sleep until the planned start of the next operation.
+
+        Return how far behind schedule (in seconds) the operation starts.
+        """
+        lag = time.time() - self.next_time()
+        if lag < 0:
+            time.sleep(-lag)
+            lag = 0.0
+        self.record(lag)
+        return lag
+
+    async def wait_async(self) -> float:
+        """Wait like wait() does, without blocking the event loop."""
+        lag = time.time() - self.next_time()
+        if lag < 0:
+            await asyncio.sleep(-lag)
+            lag = 0.0
+        self.record(lag)
+        return lag
+
+    def record(self, lag: float):
+        self.ops += 1
+        if lag > 0:
+            self.late_ops += 1
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+
+    def summary(self) -> str:
+        late = 100 * self.late_ops / self.ops if self.ops else 0
+        mean_lag = self.total_lag / self.late_ops if self.late_ops else 0
+        return '{:.2f}% of {} ops behind schedule, mean lag {:.3f}s, max lag {:.3f}s'\
+            .format(late, self.ops, mean_lag, self.max_lag)
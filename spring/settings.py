@@ -22,6 +22,8 @@ class WorkloadSettings:
         self.working_set_moving_docs = 0
 
         self.async = options.async
+        self.aio = False
+        self.aio_concurrency = 256
 
         self.workers = options.workers
 
@@ -45,9 +47,18 @@ class WorkloadSettings:
 
         self.seq_upserts = False
 
+        self.multi_ops = False
+
+        self.encoded_docs = False
+
         self.working_set_move_time = 0
 
         self.key_fmtr = 'decimal'
+        self.key_cache_size = 0
+
+        self.latency_recorder = 'reservoir'
+
+        self.arrival_process = 'closed'
 
         self.power_alpha = 0
         self.zipf_alpha = 0
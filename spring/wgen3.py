@@ -1,10 +1,11 @@
+import asyncio
 import copy
 import os
 import signal
 import time
-from multiprocessing import Event, Lock, Manager, Process, Value
+from multiprocessing import Event, Lock, Process, Value
 from threading import Timer
-from typing import Callable, List, Tuple, Union
+from typing import Callable, Iterable, Iterator, List, Tuple, Union
 
 import twisted
 from decorator import decorator
@@ -14,7 +15,9 @@ from twisted.internet import reactor
 
 from logger import logger
 from perfrunner.helpers.sync import SyncHotWorkload
-from spring.cbgen3 import CBAsyncGen3, CBGen3
+from spring.cbgen3 import CBAIOGen3, CBAsyncGen3, CBGen3
+from spring.cbgen_helpers import timeit_async
+from spring.counters import ItemCounters
 from spring.docgen import (
     AdvFilterDocument,
     AdvFilterXattrBody,
@@ -36,6 +39,7 @@ from spring.docgen import (
     ImportExportDocumentNested,
     IncompressibleString,
     JoinedDocument,
+    Key,
     KeyForCASUpdate,
     KeyForRemoval,
     LargeDocument,
@@ -63,9 +67,13 @@ from spring.docgen import (
     VaryingItemSizePlasmaDocument,
     WorkingSetKey,
     ZipfKey,
+    configure_key_cache,
+    format_key_strings,
+    key_cache_info,
 )
 from spring.querygen3 import N1QLQueryGen3, ViewQueryGen3, ViewQueryGenByType3
-from spring.reservoir import Reservoir
+from spring.reservoir import LatencyHistogram, Reservoir
+from spring.schedule import ArrivalSchedule
 
 
 def err(*args, **kwargs):
@@ -108,6 +116,7 @@ class Worker:
         self.ts = target_settings
         self.shutdown_event = shutdown_event
         self.sid = 0
+        self.schedule = None
 
         self.next_report = 0.05  # report after every 5% of completion
         self.init_load_targets()
@@ -145,6 +154,8 @@ class Worker:
         ws = copy.deepcopy(self.ws)
         ws.items = ws.items // self.num_load_targets
 
+        configure_key_cache(ws.key_cache_size)
+
         self.new_keys = NewOrderedKey(prefix=self.ts.prefix,
                                       fmtr=ws.key_fmtr)
 
@@ -321,7 +332,35 @@ class Worker:
     def seed(self):
         random.seed(seed=self.sid * 9901)
 
+    def init_reservoir(self, num_workers: int):
+        if self.ws.latency_recorder == 'histogram':
+            self.reservoir = LatencyHistogram(num_workers=num_workers)
+        else:
+            self.reservoir = Reservoir(num_workers=num_workers)
+
+    def init_schedule(self, rate: float):
+        """Replace the batch throttling with an open-loop arrival schedule."""
+        if self.ws.arrival_process != 'closed' and rate < float('inf'):
+            self.schedule = ArrivalSchedule(rate=rate,
+                                            process=self.ws.arrival_process,
+                                            seed=self.sid)
+            self.target_time = None
+
+    def wait_for_schedule(self) -> float:
+        if self.schedule is None:
+            return 0.0
+        return self.schedule.wait()
+
     def dump_stats(self):
+        if self.schedule is not None:
+            logger.info('{}-{}: {}'.format(self.NAME, self.sid,
+                                           self.schedule.summary()))
+        cache_info = key_cache_info()
+        if cache_info is not None and cache_info.hits + cache_info.misses:
+            hit_rate = 100 * cache_info.hits / (cache_info.hits + cache_info.misses)
+            logger.info('{}-{}: key cache hit rate {:.1f}% ({} of {} keys cached)'
+                        .format(self.NAME, self.sid, hit_rate,
+                                cache_info.currsize, cache_info.maxsize))
         self.reservoir.dump(filename='{}-{}'.format(self.NAME, self.sid))
 
 
@@ -331,7 +370,7 @@ class KVWorker(Worker):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.reservoir = Reservoir(num_workers=self.ws.workers)
+        self.init_reservoir(num_workers=self.ws.workers)
         self.gen_duration = 0.0
         self.batch_duration = 0.0
         self.delta = 0.0
@@ -350,11 +389,8 @@ class KVWorker(Worker):
     def random_target(self) -> str:
         return random.choice(self.access_targets)
 
-    def create_args(self, cb: Client,
-                    curr_items: int,
+    def create_args(self, cb: Client, key: Key, doc: dict,
                     target: str) -> Sequence:
-        key = self.new_keys.next(curr_items)
-        doc = self.docs.next(key)
         if self.ws.durability:
             args = target, key.string, doc, self.ws.durability, self.ws.ttl
             return [('set', cb.update_durable, args)]
@@ -362,25 +398,13 @@ class KVWorker(Worker):
             args = target, key.string, doc, self.ws.persist_to, self.ws.replicate_to, self.ws.ttl
             return [('set', cb.update, args)]
 
-    def read_args(self, cb: Client,
-                  curr_items: int,
-                  deleted_items: int,
-                  target: str) -> Sequence:
-        key = self.existing_keys.next(curr_items, deleted_items)
+    def read_args(self, cb: Client, key: Key, target: str) -> Sequence:
         args = target, key.string
 
         return [('get', cb.read, args)]
 
-    def update_args(self,
-                    cb: Client,
-                    curr_items: int,
-                    deleted_items: int,
+    def update_args(self, cb: Client, key: Key, doc: dict,
                     target: str) -> Sequence:
-        key = self.existing_keys.next(curr_items,
-                                      deleted_items,
-                                      self.current_hot_load_start,
-                                      self.timer_elapse)
-        doc = self.docs.next(key)
         if self.ws.durability:
             args = target, key.string, doc, self.ws.durability, self.ws.ttl
             return [('set', cb.update_durable, args)]
@@ -388,63 +412,138 @@ class KVWorker(Worker):
             args = target, key.string, doc, self.ws.persist_to, self.ws.replicate_to, self.ws.ttl
             return [('set', cb.update, args)]
 
-    def delete_args(self, cb: Client,
-                    deleted_items: int,
-                    target: str) -> Sequence:
-        key = self.keys_for_removal.next(deleted_items)
+    def delete_args(self, cb: Client, key: Key, target: str) -> Sequence:
         args = target, key.string
 
         return [('delete', cb.delete, args)]
 
-    def modify_args(self, cb: Client,
-                    curr_items: int, deleted_items: int,
+    def modify_args(self, cb: Client, key: Key, doc: dict,
                     target: str) -> Sequence:
-        key = self.existing_keys.next(curr_items, deleted_items)
-        doc = self.docs.next(key)
         read_args = target, key.string,
         update_args = target, key.string, doc, self.ws.persist_to, self.ws.replicate_to, self.ws.ttl
 
         return [('get', cb.read, read_args), ('set', cb.update, update_args)]
 
-    def gen_cmd_sequence(self, cb: Client = None) -> Sequence:
-        if not cb:
-            cb = self.cb
+    def gen_keys(self, curr_items: int, deleted_items: int) -> List[Tuple[str, Key]]:
+        keys = []
+        for op in self.random_ops:
+            if op == 'c':
+                key = self.new_keys.next(curr_items)
+                curr_items += 1
+            elif op == 'r' or op == 'm':
+                key = self.existing_keys.next(curr_items, deleted_items)
+            elif op == 'u':
+                key = self.existing_keys.next(curr_items,
+                                              deleted_items,
+                                              self.current_hot_load_start,
+                                              self.timer_elapse)
+            elif op == 'd':
+                key = self.keys_for_removal.next(deleted_items)
+                deleted_items += 1
+            keys.append((op, key))
+        return keys
+
+    def gen_batch(self) -> Tuple[str, List[Tuple[str, Key]], Iterator[dict]]:
         target = self.random_target()
         curr_items = self.ws.items
         deleted_items = 0
         if self.ws.creates or self.ws.deletes:
             max_batch_deletes_buffer = self.ws.deletes * self.ws.workers
-            delete_buffer_diff = self.ws.deletes - max_batch_deletes_buffer
-            with self.gen_lock:
-                target_info = self.shared_dict[target]
-                curr_items = target_info[0]
-                deleted_items = target_info[1] + max_batch_deletes_buffer
-                self.shared_dict[target] = \
-                    [curr_items + self.ws.creates, deleted_items + delete_buffer_diff]
+            curr_items, deleted_items = self.shared_dict.reserve(
+                target, self.ws.creates, self.ws.deletes)
+            deleted_items += max_batch_deletes_buffer
+
+        keys = self.gen_keys(curr_items, deleted_items)
+        format_key_strings(key for _, key in keys)
+        doc_keys = [key for op, key in keys if op in 'cum']
+        if self.ws.encoded_docs:
+            docs = iter(self.docs.next_encoded_batch(doc_keys))
+        else:
+            docs = iter(self.docs.next_batch(doc_keys))
+        return target, keys, docs
+
+    def gen_cmd_sequence(self, cb: Client = None) -> Sequence:
+        if not cb:
+            cb = self.cb
+        target, keys, docs = self.gen_batch()
+
         cmds = []
-        for op in self.random_ops:
+        for op, key in keys:
             if op == 'c':
-                cmds += self.create_args(cb, curr_items, target)
-                curr_items += 1
+                cmds += self.create_args(cb, key, next(docs), target)
             elif op == 'r':
-                cmds += self.read_args(cb, curr_items, deleted_items, target)
+                cmds += self.read_args(cb, key, target)
             elif op == 'u':
-                cmds += self.update_args(cb, curr_items, deleted_items, target)
+                cmds += self.update_args(cb, key, next(docs), target)
             elif op == 'd':
-                cmds += self.delete_args(cb, deleted_items, target)
-                deleted_items += 1
+                cmds += self.delete_args(cb, key, target)
             elif op == 'm':
-                cmds += self.modify_args(cb, curr_items, deleted_items, target)
+                cmds += self.modify_args(cb, key, next(docs), target)
+        return cmds
+
+    def gen_multi_cmd_sequence(self) -> Sequence:
+        """Group the reads, upserts and removals of a batch into multi ops.
+
+        The upserts are keyed by document key, so repeated keys in a batch
+        result in a single upsert of the last document.
+        """
+        target, keys, docs = self.gen_batch()
+
+        reads, deletes = [], []
+        updates = {}
+        for op, key in keys:
+            if op in 'rm':
+                reads.append(key.string)
+            if op in 'cum':
+                updates[key.string] = next(docs)
+            elif op == 'd':
+                deletes.append(key.string)
+
+        cmds = []
+        if reads:
+            cmds.append(('get', self.cb.read_multi, (target, reads)))
+        if updates:
+            if self.ws.durability:
+                args = target, updates, self.ws.durability, self.ws.ttl
+                cmds.append(('set', self.cb.update_durable_multi, args))
+            else:
+                args = target, updates, self.ws.persist_to, self.ws.replicate_to, \
+                    self.ws.ttl
+                cmds.append(('set', self.cb.update_multi, args))
+        if deletes:
+            cmds.append(('delete', self.cb.delete_multi, (target, deletes)))
         return cmds
 
+    def record_multi(self, cmd: str, latency: float, num_keys: int):
+        """Record the latency of a multi call and its share for every key."""
+        self.reservoir.update(operation=cmd + '_batch', value=latency)
+        for _ in range(num_keys):
+            self.reservoir.update(operation=cmd, value=latency / num_keys)
+
+    def do_multi_batch(self):
+        t0 = time.time()
+        for cmd, func, args in self.gen_multi_cmd_sequence():
+            latency = func(*args)
+            if latency is not None:
+                self.record_multi(cmd, latency, len(args[1]))
+        if self.target_time is not None:
+            self.batch_duration = time.time() - t0
+            self.delta = self.target_time - self.batch_duration
+            if self.delta > 0:
+                time.sleep(self.CORRECTION_FACTOR * self.delta)
+
     def do_batch(self, *args, **kwargs):
+        if self.ws.multi_ops:
+            return self.do_multi_batch()
+
         op_count = 0
         if self.target_time is None:
             cmd_seq = self.gen_cmd_sequence()
             for cmd, func, args in cmd_seq:
+                lag = self.wait_for_schedule()
                 latency = func(*args)
                 if latency is not None:
-                    self.reservoir.update(operation=cmd, value=latency)
+                    self.reservoir.update(operation=cmd, value=latency + lag)
                 if not op_count % 5:
                     if self.time_to_stop():
                         return
@@ -472,16 +571,7 @@ class KVWorker(Worker):
     def run_condition(self, curr_ops):
         return curr_ops.value < self.ws.ops and not self.time_to_stop()
 
-    def run(self, sid, locks, curr_ops, shared_dict,
-            current_hot_load_start=None, timer_elapse=None):
-        self.sid = sid
-        self.locks = locks
-        self.gen_lock = locks[0]
-        self.batch_lock = locks[1]
-        self.shared_dict = shared_dict
-        self.current_hot_load_start = current_hot_load_start
-        self.timer_elapse = timer_elapse
-        self.cb.connect_collections(self.access_targets)
+    def init_ops(self):
         self.ops_list = \
             ['c'] * self.ws.creates + \
             ['r'] * self.ws.reads + \
@@ -498,6 +588,23 @@ class KVWorker(Worker):
                                self.ws.throughput
         else:
             self.target_time = None
+        num_cmds = self.batch_size + self.ops_list.count('m')  # Reads and updates
+        self.cmd_rate = self.ws.throughput / self.ws.workers * \
+            num_cmds / self.batch_size
+
+    def run(self, sid, locks, curr_ops, shared_dict,
+            current_hot_load_start=None, timer_elapse=None):
+        self.sid = sid
+        self.locks = locks
+        self.gen_lock = locks[0]
+        self.batch_lock = locks[1]
+        self.shared_dict = shared_dict
+        self.current_hot_load_start = current_hot_load_start
+        self.timer_elapse = timer_elapse
+        self.cb.connect_collections(self.access_targets)
+        self.init_ops()
+        if not self.ws.multi_ops:  # Multi ops are throttled per batch
+            self.init_schedule(rate=self.cmd_rate)
         self.seed()
         try:
             if self.target_time:
@@ -617,6 +724,96 @@ class AsyncKVWorker(KVWorker):
         reactor.run()
 
 
+class AIOKVWorker(KVWorker):
+
+    """Keep a window of concurrent KV operations in flight on an asyncio loop."""
+
+    NAME = 'aio-kv-worker'
+
+    def init_db(self):
+        params = {'bucket': self.ts.bucket, 'host': self.ts.node, 'port': 8091,
+                  'username': self.ts.bucket, 'password': self.ts.password}
+
+        self.cb = CBAIOGen3(**params)
+
+    def init_schedule(self, rate: float):
+        """Throttle with an arrival schedule, batch sleeps would stall the window."""
+        if rate < float('inf'):
+            process = self.ws.arrival_process
+            if process == 'closed':
+                process = 'constant'
+            self.schedule = ArrivalSchedule(rate=rate, process=process,
+                                            seed=self.sid)
+
+    async def do_op(self, cmd: str, func: Callable, args: Tuple,
+                    intended: float = None):
+        delay = 0.0
+        if intended is not None:  # Also count the time spent waiting for the window
+            delay = max(time.time() - intended, 0.0)
+        latency = await timeit_async(func, *args)
+        if latency is not None and cmd != 'delete':  # Same as the sync client
+            if self.ws.multi_ops:
+                self.record_multi(cmd, latency + delay, len(args[1]))
+            else:
+                self.reservoir.update(operation=cmd, value=latency + delay)
+
+    def check_ops(self, done: Iterable[asyncio.Future]):
+        """Log the errors that timeit_async does not handle."""
+        for task in done:
+            if not task.cancelled() and task.exception() is not None:
+                logger.error('{}-{}: {!r}'.format(self.NAME, self.sid, task.exception()))
+
+    async def run_ops(self, curr_ops):
+        in_flight = set()
+        while self.run_condition(curr_ops):
+            with self.batch_lock:
+                curr_ops.value += self.batch_size
+            if self.ws.multi_ops:
+                cmds = self.gen_multi_cmd_sequence()
+            else:
+                cmds = self.gen_cmd_sequence()
+            for cmd, func, args in cmds:
+                intended = None
+                if self.schedule is not None:
+                    lag = await self.schedule.wait_async()
+                    intended = time.time() - lag
+                if len(in_flight) >= self.ws.aio_concurrency:
+                    done, in_flight = await asyncio.wait(
+                        in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    self.check_ops(done)
+                in_flight.add(
+                    asyncio.ensure_future(self.do_op(cmd, func, args, intended))
+                )
+            self.report_progress(curr_ops.value)
+
+        if in_flight:
+            done, _ = await asyncio.wait(in_flight)
+            self.check_ops(done)
+
+    def run(self, sid, locks, curr_ops, shared_dict,
+            current_hot_load_start=None, timer_elapse=None):
+        self.sid = sid
+        self.locks = locks
+        self.batch_lock = locks[1]
+        self.shared_dict = shared_dict
+        self.current_hot_load_start = current_hot_load_start
+        self.timer_elapse = timer_elapse
+        self.init_ops()
+        self.init_schedule(rate=self.cmd_rate)
+        self.seed()
+
+        loop = self.cb.loop
+        try:
+            loop.run_until_complete(self.cb.connect(self.access_targets))
+            logger.info('Started: {}-{}'.format(self.NAME, self.sid))
+            loop.run_until_complete(self.run_ops(curr_ops))
+        except KeyboardInterrupt:
+            logger.info('Interrupted: {}-{}'.format(self.NAME, self.sid))
+        else:
+            logger.info('Finished: {}-{}'.format(self.NAME, self.sid))
+        self.dump_stats()
+
+
 class HotReadsWorker(Worker):
 
     def run(self, sid, *args):
@@ -637,7 +834,10 @@ class SeqUpsertsWorker(Worker):
         self.cb.connect_collections(self.load_targets)
         for target in self.load_targets:
             for key in SequentialKey(sid, ws, self.ts.prefix):
-                doc = self.docs.next(key)
+                if ws.encoded_docs:
+                    doc = self.docs.next_encoded_batch([key])[0]
+                else:
+                    doc = self.docs.next(key)
                 self.cb.update(target, key.string, doc)
 
 
@@ -884,7 +1084,7 @@ class N1QLWorker(Worker):
     def __init__(self, workload_settings, target_settings, shutdown_event=None):
         super().__init__(workload_settings, target_settings, shutdown_event)
         self.new_queries = N1QLQueryGen3(workload_settings.n1ql_queries)
-        self.reservoir = Reservoir(num_workers=self.ws.n1ql_workers)
+        self.init_reservoir(num_workers=self.ws.n1ql_workers)
         self.gen_duration = 0.0
         self.batch_duration = 0.0
         self.delta = 0.0
@@ -896,19 +1096,18 @@ class N1QLWorker(Worker):
             t0 = time.time()
             self.op_delay = self.op_delay + (self.delta / self.ws.n1ql_batch_size)
         target = self.next_target()
-        with self.lock:
-            target_info = self.shared_dict[target]
-            target_curr_items = target_info[0]
-            target_deleted_items = target_info[1]
-            updated_curr_items = target_curr_items + self.ws.n1ql_batch_size
-            self.shared_dict[target] = [updated_curr_items, target_deleted_items]
+        target_curr_items, _ = self.shared_dict.reserve(
+            target, self.ws.n1ql_batch_size, 0)
 
         for i in range(self.ws.n1ql_batch_size):
             target_curr_items += 1
             key = self.new_keys.next(curr_items=target_curr_items)
             doc = self.docs.next(key)
             query, options = self.new_queries.next(key.string, doc, self.replacement_targets)
+            lag = self.wait_for_schedule()
             latency = self.cb.n1ql_query(query, options)
+            if latency is not None:
+                latency += lag
             if not self.first:
                 self.reservoir.update(operation='query', value=latency)
             else:
@@ -940,7 +1139,10 @@ class N1QLWorker(Worker):
                                                 curr_items=target_curr_items)
             doc = self.docs.next(key)
             query, options = self.new_queries.next(key.string, doc, self.replacement_targets)
+            lag = self.wait_for_schedule()
             latency = self.cb.n1ql_query(query, options)
+            if latency is not None:
+                latency += lag
             if not self.first:
                 self.reservoir.update(operation='query', value=latency)
             else:
@@ -972,7 +1174,10 @@ class N1QLWorker(Worker):
                                           curr_deletes=0)
             doc = self.docs.next(key)
             query, options = self.new_queries.next(key.string, doc, self.replacement_targets)
+            lag = self.wait_for_schedule()
             latency = self.cb.n1ql_query(query, options)
+            if latency is not None:
+                latency += lag
             if not self.first:
                 self.reservoir.update(operation='query', value=latency)
             else:
@@ -1138,6 +1343,7 @@ class N1QLWorker(Worker):
                                float(self.ws.n1ql_throughput)
         else:
             self.target_time = None
+        self.init_schedule(rate=self.ws.n1ql_throughput / self.ws.n1ql_workers)
 
         try:
             if self.target_time:
@@ -1162,7 +1368,7 @@ class ViewWorker(Worker):
         self.delta = 0.0
         self.op_delay = 0.0
         self.batch_duration = 0.0
-        self.reservoir = Reservoir(num_workers=self.ws.query_workers)
+        self.init_reservoir(num_workers=self.ws.query_workers)
         if workload_settings.index_type is None:
             self.new_queries = ViewQueryGen3(workload_settings.ddocs,
                                              workload_settings.query_params)
@@ -1187,8 +1393,9 @@ class ViewWorker(Worker):
             key = self.existing_keys.next(curr_items_spot, deleted_spot)
             doc = self.docs.next(key)
             ddoc_name, view_name, query = self.new_queries.next(doc)
+            lag = self.wait_for_schedule()
             latency = self.cb.view_query(ddoc_name, view_name, query=query)
-            self.reservoir.update(operation='query', value=latency)
+            self.reservoir.update(operation='query', value=latency + lag)
             if self.op_delay > 0 and self.target_time:
                 time.sleep(self.op_delay * self.CORRECTION_FACTOR)
             if not i % 5:
@@ -1209,6 +1416,7 @@ class ViewWorker(Worker):
             self.target_time = None
 
         self.sid = sid
+        self.init_schedule(rate=self.ws.query_throughput / self.ws.query_workers)
         self.locks = locks
         self.lock = locks[0]
         self.shared_dict = shared_dict
@@ -1232,6 +1440,8 @@ class WorkerFactory:
         num_workers = settings.workers
         if getattr(settings, 'async', None):
             worker = AsyncKVWorker
+        elif getattr(settings, 'aio', None):
+            worker = AIOKVWorker
         elif getattr(settings, 'seq_upserts', None):
             worker = SeqUpsertsWorker
         elif getattr(settings, 'hot_reads', None):
@@ -1311,8 +1521,7 @@ class WorkloadGen:
     def start_all_workers(self):
         """Start all the workers groups."""
         logger.info('Starting all collections workers')
-        self.manager = Manager()
-        self.shared_dict = self.manager.dict()
+        counters = {}
         if self.ws.collections is not None:
             num_load = 0
             target_scope_collections = self.ws.collections[self.ts.bucket]
@@ -1326,13 +1535,14 @@ class WorkloadGen:
                 for collection in target_scope_collections[scope].keys():
                     target = scope+":"+collection
                     if target_scope_collections[scope][collection]['load'] == 1:
-                        self.shared_dict[target] = [curr_items, 0]
+                        counters[target] = [curr_items, 0]
                     else:
-                        self.shared_dict[target] = [0, 0]
+                        counters[target] = [0, 0]
         else:
             # version prior to 7.0.0
             target = "_default:_default"
-            self.shared_dict[target] = [self.ws.items, 0]
+            counters[target] = [self.ws.items, 0]
+        self.shared_dict = ItemCounters(counters)
 
         timer_elapse = Value('I', 0)
         current_hot_load_start = Value('L', 0)
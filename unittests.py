@@ -1,22 +1,102 @@
+import asyncio
 import glob
+import io
 import json
+import logging
+import os
+import random
+import re
+import signal
+import socket
+import subprocess
+import tempfile
+import time
+from collections import OrderedDict, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing import Process, Value
+from socketserver import ThreadingMixIn
+from threading import Barrier, Event, Lock, Thread
+from types import SimpleNamespace
+from typing import Callable, Iterator
+from unittest import TestCase, mock
+from urllib.parse import parse_qs
+
+import aiohttp
+import numpy as np
+import paramiko
 import pkg_resources
-from collections import defaultdict, namedtuple
-from multiprocessing import Value
-from unittest import TestCase
-
 import snappy
-
+from fabric.api import env
+from fabric.exceptions import CommandTimeout
+
+from cbagent.collectors.collector import Collector
+from cbagent.collectors.latency import KVLatency
+from cbagent.collectors.libstats.remotestats import RemoteStats, parallel_task
+from cbagent.collectors.libstats.statsagent import AgentChannel, StatsAgent
+from cbagent.collectors.observe import ObserveIndexLatency
+from cbagent.collectors.xdcr_lag import XdcrLag, vbucket
+from cbagent.metadata_client import MetadataClient
+from cbagent.responses import ResponseCache, Rule, parse_tail
+from cbagent.scheduler import CollectorScheduler
+from cbagent.sketches import QuantileSketch, SketchStore
+from cbagent.stores import (
+    BufferedPerfStore,
+    ChangeFilter,
+    PerfStore,
+    SeriesCache,
+    time_weighted,
+)
+from perfrunner.helpers.concurrency import TaskGraph, run_concurrently
+from perfrunner.helpers.indexes import (
+    IndexProvisioner,
+    IndexProvisioningError,
+    build_groups,
+    index_definitions,
+    index_states,
+    keyspace,
+)
+from perfrunner.helpers.monitor import TaskWatcher
+from perfrunner.helpers.rest import DefaultRestHelper
+from perfrunner.remote.linux import RemoteLinux
+from perfrunner.remote.logs import LogFollower
+from perfrunner.remote.ssh import SSHSession
+from perfrunner.remote.windows import RemoteWindows
 from perfrunner.settings import ClusterSpec, TestConfig
 from perfrunner.workloads.bigfun.query_gen import new_queries
 from perfrunner.workloads.tcmalloc import KeyValueIterator, LargeIterator
-from spring import docgen
+from spring import docgen, reservoir
+from spring.counters import ItemCounters
+from spring.schedule import ArrivalSchedule
 
 cb_version = pkg_resources.get_distribution("couchbase").version
 if cb_version[0] == '2':
     from spring.querygen import N1QLQueryGen
 elif cb_version[0] == '3':
     from spring.querygen3 import N1QLQueryGen3 as N1QLQueryGen
+    from spring.wgen3 import AIOKVWorker, KVWorker
+
+log_dir = None
+
+
+def setUpModule():  # noqa: N802
+    """Write the log of the test run to a temporary directory."""
+    global log_dir
+    log_dir = tempfile.TemporaryDirectory()
+    root = logging.getLogger()
+    for handler in root.handlers:
+        if isinstance(handler, logging.FileHandler):
+            handler.close()
+            handler.baseFilename = os.path.join(log_dir.name, 'perfrunner.log')
+
+
+def tearDownModule():  # noqa: N802
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.FileHandler):
+            handler.close()
+    log_dir.cleanup()
 
 
 class SettingsTest(TestCase):
@@ -498,6 +578,41 @@ class SpringTest(TestCase):
                 self.assertEqual(len(key.string), 16)
                 keys.add(key.string)
 
+    def test_format_keys(self):
+        numbers = list(range(0, 10 ** 5, 7))
+
+        for fmtr in 'decimal', 'hash', 'hex':
+            for prefix in '', 'test':
+                expected = [docgen.Key(number=i, prefix=prefix, fmtr=fmtr).string
+                            for i in numbers]
+                self.assertEqual(docgen.format_keys(numbers, prefix, fmtr),
+                                 expected)
+
+                keys = [docgen.Key(number=i, prefix=prefix, fmtr=fmtr) for i in numbers]
+                docgen.format_key_strings(keys)
+                self.assertEqual(expected, [key._string for key in keys])
+
+    def test_key_cache(self):
+        ws = WorkloadSettings(items=10 ** 4, workers=1, working_set=10,
+                              working_set_access=100, working_set_moving_docs=0,
+                              key_fmtr='hash')
+        key_gen = docgen.WorkingSetKey(ws=ws, prefix='test')
+
+        docgen.configure_key_cache(size=ws.items)
+        try:
+            for i in range(10 ** 4):
+                key = key_gen.next(curr_items=ws.items, curr_deletes=0)
+                self.assertEqual(key.string,
+                                 docgen.hash_fmtr(key.number, key.prefix))
+            hits, misses, _, currsize = docgen.key_cache_info()
+        finally:
+            docgen.configure_key_cache(size=0)
+
+        self.assertEqual(misses, currsize)
+        self.assertLessEqual(currsize, ws.items * ws.working_set / 100)
+        self.assertGreater(hits, misses)
+        self.assertIsNone(docgen.key_cache_info())
+
     def test_new_working_set_hits(self):
         ws = WorkloadSettings(items=10 ** 3, workers=40, working_set=20,
                               working_set_access=100, working_set_moving_docs=0,
@@ -600,6 +715,378 @@ class SpringTest(TestCase):
         doc = generator.next(key=docgen.Key(number=0, prefix='', fmtr=''))
         self.assertEqual(len(doc), size)
 
+    def test_latency_histogram(self):
+        values = np.random.lognormal(mean=-7, sigma=1.5, size=10 ** 5)
+
+        histogram = reservoir.LatencyHistogram()
+        for value in values:
+            histogram.update(operation='get', value=value)
+
+        qs = 50, 90, 99, 99.9, 99.99
+        relative_error = 2 ** -(reservoir.PRECISION - 1)
+        values.sort()
+        for q, actual in zip(qs, histogram.percentiles('get', qs)):
+            expected = values[int(np.ceil(q / 100 * values.size)) - 1]  # Nearest rank
+            self.assertAlmostEqual(actual, expected,
+                                   delta=expected * relative_error + 10 ** -6,
+                                   msg=q)
+
+        buckets = np.array([reservoir.bucket_index(value) for value in values])
+        self.assertTrue(np.all(buckets < reservoir.NUM_BUCKETS))
+        self.assertTrue(np.allclose(reservoir.bucket_value(buckets), values,
+                                    rtol=relative_error, atol=10 ** -6))
+
+    def test_item_counters(self):
+        counters = ItemCounters({'s:c1': [100, 0], 's:c2': [0, 0]})
+
+        def reserve():
+            for _ in range(1000):
+                counters.reserve('s:c1', creates=3, deletes=1)
+
+        workers = [Process(target=reserve) for _ in range(8)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual([100 + 8 * 3000, 8000], counters['s:c1'])
+        self.assertEqual([0, 0], counters['s:c2'])
+        self.assertEqual((24100, 8000), counters.reserve('s:c1', 10, 0))
+        self.assertEqual([24110, 8000], counters['s:c1'])
+
+    def test_arrival_schedule(self):
+        for process in ArrivalSchedule.PROCESSES:
+            schedule = ArrivalSchedule(rate=1000, process=process, seed=1)
+            times = [schedule.next_time() for _ in range(2 * schedule.CHUNK)]
+            gaps = np.diff(times)
+            self.assertTrue((gaps >= 0).all())
+            self.assertAlmostEqual(10 ** -3, gaps.mean(), delta=5 * 10 ** -5)
+
+        schedule = ArrivalSchedule(rate=10, seed=1)
+        schedule.start -= 10  # The worker is 10 seconds behind schedule
+        lags = [schedule.wait() for _ in range(10)]
+        self.assertTrue(all(8.5 < lag <= 10 for lag in lags))
+        self.assertEqual(10, schedule.late_ops)
+        self.assertGreater(lags[0], lags[-1])
+
+    def test_reservoir_dump(self):
+        res = reservoir.Reservoir(num_workers=10)
+        for i in range(res.capacity + 100):
+            res.update(operation=('get', 'set')[i % 2], value=0.001 * (i + 1))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'kv-worker-0')
+            res.dump(filename=filename)
+            filename += reservoir.Reservoir.SUFFIX
+            self.assertEqual(8 + len('["get", "set"]') +
+                             res.capacity * reservoir.Reservoir.RECORD.itemsize,
+                             os.path.getsize(filename))
+            stats = reservoir.Reservoir.load(filename)
+
+        self.assertEqual(['get', 'set'], sorted(stats))
+        samples = sorted((operation, timestamp, latency)
+                         for operation, (timestamps, latencies) in stats.items()
+                         for timestamp, latency in zip(timestamps.tolist(),
+                                                       latencies.tolist()))
+        for actual, expected in zip(samples, sorted(res.values)):
+            self.assertEqual(expected[:2], actual[:2])
+            self.assertAlmostEqual(expected[2], actual[2], delta=expected[2] * 10 ** -6)
+
+    def test_latency_histogram_merge(self):
+        histograms = []
+        merged = reservoir.LatencyHistogram()
+        with tempfile.TemporaryDirectory() as tmp:
+            for worker in range(4):
+                histogram = reservoir.LatencyHistogram()
+                for value in np.random.exponential(scale=0.001, size=10 ** 4):
+                    histogram.update(operation='set', value=value)
+                filename = os.path.join(tmp, 'kv-worker-{}'.format(worker))
+                histogram.dump(filename=filename)
+                histograms.append(histogram)
+
+                filename += reservoir.LatencyHistogram.SUFFIX
+                merged.merge(reservoir.LatencyHistogram.load(filename))
+
+        expected = sum(h.totals['set'] for h in histograms)
+        self.assertTrue(np.array_equal(merged.totals['set'], expected))
+
+        samples = list(merged.samples(max_samples=10 ** 4))
+        self.assertEqual(len(samples), 10 ** 4)
+        self.assertEqual({operation for operation, *_ in samples}, {'set'})
+
+    def test_latency_histogram_windows(self):
+        histogram = reservoir.LatencyHistogram()
+        histogram.MAX_WINDOWS = 10
+        now = [1000.0]
+        with mock.patch('time.time', lambda: now[0]):
+            for second in range(25):
+                for value in 0.001, 0.002, 0.002:
+                    histogram.update(operation='get', value=value)
+                now[0] += 1
+            histogram.close()
+
+        self.assertLessEqual(len(histogram.windows['get']), histogram.MAX_WINDOWS)
+        self.assertEqual(4 * histogram.WINDOW, histogram.window)
+        self.assertEqual(75, histogram.count('get'))
+
+        timestamps, buckets, counts = histogram.series('get')
+        self.assertEqual(75, counts.sum())
+        self.assertTrue(np.all(timestamps % histogram.window == 0))
+        self.assertEqual([0.001, 0.002, 0.002],
+                         [round(p, 3) for p in histogram.percentiles('get', (33, 34, 100))])
+
+    def test_latency_histogram_load_all(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filenames = []
+            for worker in range(3):
+                histogram = reservoir.LatencyHistogram()
+                for _ in range(100):
+                    histogram.update(operation='get', value=0.001 * (worker + 1))
+                filename = os.path.join(tmp, 'kv-worker-{}'.format(worker))
+                histogram.dump(filename=filename)
+                filenames.append(filename + reservoir.LatencyHistogram.SUFFIX)
+            filenames.append(os.path.join(tmp, 'kv-worker-0.lat'))
+
+            merged = reservoir.LatencyHistogram.load_all(filenames)
+
+        self.assertEqual(300, merged.count('get'))
+        self.assertAlmostEqual(0.003, merged.percentiles('get', [99])[0], delta=10 ** -4)
+        self.assertIsNone(reservoir.LatencyHistogram.load_all(filenames[-1:]))
+
+    def test_next_batch(self):
+        size = 1024
+        key_gen = docgen.NewOrderedKey(prefix='test', fmtr='hash')
+        keys = [key_gen.next(i) for i in range(10 ** 3)]
+
+        for dg in (
+            docgen.Document(avg_size=size),
+            docgen.GroupedDocument(avg_size=size, groups=10),
+            docgen.NestedDocument(avg_size=size),
+            docgen.LargeDocument(avg_size=size),
+            docgen.LargeItemGroupedDocumentKeySize(avg_size=size, groups=10,
+                                                   item_size=64),
+            *self.doc_generators(size=size),
+        ):
+            random.seed(1)
+            np.random.seed(1)
+            expected = [dg.next(key) for key in keys]
+
+            random.seed(1)
+            np.random.seed(1)
+            actual = dg.next_batch(keys)
+
+            self.assertEqual(json.dumps(actual), json.dumps(expected),
+                             msg=dg.__class__.__name__)
+
+    def test_next_encoded_batch(self):
+        key_gen = docgen.NewOrderedKey(prefix='test', fmtr='hash')
+        keys = [key_gen.next(i) for i in range(10 ** 3)]
+
+        for size in 0, 1024, 4096:
+            for dg in (
+                docgen.Document(avg_size=size),
+                docgen.GroupedDocument(avg_size=size, groups=10),
+                docgen.NestedDocument(avg_size=size),
+                docgen.LargeDocument(avg_size=size),
+                docgen.LargeGroupedDocument(avg_size=size, groups=10),
+                *self.doc_generators(size=size),
+            ):
+                random.seed(1)
+                np.random.seed(1)
+                expected = [docgen.encode_json(doc) for doc in dg.next_batch(keys)]
+
+                random.seed(1)
+                np.random.seed(1)
+                actual = dg.next_encoded_batch(keys)
+
+                self.assertEqual(expected, actual, msg=dg.__class__.__name__)
+
+
+class FakeAIOClient:
+
+    """Record the operations and the peak number of operations in flight."""
+
+    def __init__(self, latency: float = 0.001, error: Exception = None):
+        self.latency = latency
+        self.error = error
+        self.ops = defaultdict(int)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def op(self, name: str):
+        self.ops[name] += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+            if self.error is not None:
+                raise self.error
+        finally:
+            self.in_flight -= 1
+
+    def read(self, target: str, key: str):
+        return self.op('read')
+
+    def update(self, target: str, key: str, doc: dict, *args):
+        return self.op('update')
+
+    def delete(self, target: str, key: str):
+        return self.op('delete')
+
+    def read_multi(self, target: str, keys: list):
+        return self.op('read_multi')
+
+    def update_multi(self, target: str, docs: dict, *args):
+        return self.op('update_multi')
+
+    def delete_multi(self, target: str, keys: list):
+        return self.op('delete_multi')
+
+
+def stub_worker(worker_class, client, **options):
+    """Create a KV worker of the given class that sends its ops to a fake client."""
+    ws = SimpleNamespace(
+        items=10 ** 4, workers=1, creates=10, reads=50, updates=30, deletes=10,
+        reads_and_updates=0, ops=1000, throughput=float('inf'),
+        aio_concurrency=256, arrival_process='closed', multi_ops=False, collections=None,
+        working_set=100, working_set_access=100, working_set_moving_docs=0,
+        working_set_move_time=0, power_alpha=0, zipf_alpha=0, n1ql_workers=0,
+        key_fmtr='decimal', key_cache_size=0, doc_gen='basic', size=128,
+        encoded_docs=False, durability=None, persist_to=0, replicate_to=0, ttl=0,
+        latency_recorder='reservoir',
+    )
+    for option, value in options.items():
+        setattr(ws, option, value)
+    ts = SimpleNamespace(bucket='bucket-1', prefix='test', node='127.0.0.1:8091',
+                         password='password', cloud=None)
+    with mock.patch.object(worker_class, 'init_db'):
+        worker = worker_class(ws, ts)
+    worker.cb = client
+    worker.shared_dict = ItemCounters({'_default:_default': [ws.items, 0]})
+    worker.batch_lock = Lock()
+    worker.current_hot_load_start = worker.timer_elapse = None
+    worker.init_ops()
+    return worker
+
+
+class AIOKVWorkerTest(TestCase):
+
+    def worker(self, client: FakeAIOClient, concurrency: int) -> 'AIOKVWorker':
+        return stub_worker(AIOKVWorker, client, aio_concurrency=concurrency)
+
+    def run_ops(self, worker: 'AIOKVWorker'):
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(worker.run_ops(SimpleNamespace(value=0)))
+        finally:
+            loop.close()
+
+    def test_window(self):
+        for concurrency in 1, 16, 256:
+            client = FakeAIOClient()
+            worker = self.worker(client, concurrency)
+            self.run_ops(worker)
+
+            self.assertEqual(concurrency, client.max_in_flight)
+            self.assertEqual(0, client.in_flight)
+
+    def test_op_mix(self):
+        client = FakeAIOClient()
+        worker = self.worker(client, concurrency=64)
+        self.run_ops(worker)
+
+        # Creates and updates are both upserts
+        self.assertEqual({'read': 500, 'update': 400, 'delete': 100}, client.ops)
+        operations = [operation for operation, _, _ in worker.reservoir.values]
+        self.assertEqual(500, operations.count('get'))
+        self.assertEqual(400, operations.count('set'))
+        self.assertEqual(900, worker.reservoir.count)
+
+    def test_errors(self):
+        client = FakeAIOClient(error=ValueError('bad document'))
+        worker = self.worker(client, concurrency=8)
+        with self.assertLogs(level='ERROR') as logs:
+            self.run_ops(worker)
+
+        self.assertEqual(1000, sum(client.ops.values()))
+        self.assertEqual(1000, len(logs.output))
+        self.assertIn("ValueError('bad document'", logs.output[0])
+        self.assertEqual(0, worker.reservoir.count)
+
+    def test_multi_ops(self):
+        client = FakeAIOClient()
+        worker = stub_worker(AIOKVWorker, client, aio_concurrency=4, multi_ops=True)
+        self.run_ops(worker)
+
+        self.assertEqual({'read_multi': 10, 'update_multi': 10, 'delete_multi': 10},
+                         client.ops)
+        operations = [operation for operation, _, _ in worker.reservoir.values]
+        self.assertEqual(10, operations.count('get_batch'))
+        self.assertEqual(500, operations.count('get'))
+        self.assertEqual(10, operations.count('set_batch'))
+        self.assertNotIn('delete', operations)
+
+    def test_cancelled_ops(self):
+        client = FakeAIOClient(latency=1)
+        worker = self.worker(client, concurrency=8)
+        loop = asyncio.new_event_loop()
+        try:
+            task = loop.create_task(worker.do_op('get', client.read, ('target', 'key')))
+            loop.call_later(0.01, task.cancel)
+            loop.run_until_complete(asyncio.wait([task]))
+            worker.check_ops([task])
+        finally:
+            loop.close()
+        self.assertTrue(task.cancelled())
+
+
+class MultiOpsTest(TestCase):
+
+    LATENCY = 0.01
+
+    def client(self) -> mock.Mock:
+        client = mock.Mock()
+        for method in 'read_multi', 'update_multi', 'delete_multi':
+            getattr(client, method).return_value = self.LATENCY
+        client.delete_multi.return_value = None  # Removals are not timed
+        return client
+
+    def test_cmd_sequence(self):
+        worker = stub_worker(KVWorker, self.client(), multi_ops=True)
+        for _ in range(10):
+            (get, read_multi, read_args), (set_, update_multi, update_args), \
+                (delete, delete_multi, delete_args) = worker.gen_multi_cmd_sequence()
+
+            self.assertEqual(('get', 'set', 'delete'), (get, set_, delete))
+            self.assertEqual(50, len(read_args[1]))
+            self.assertEqual(10, len(delete_args[1]))
+
+            docs = update_args[1]
+            self.assertIsInstance(docs, dict)
+            self.assertTrue(0 < len(docs) <= 40)
+            self.assertTrue(all(len(key) == len('test-000000000001') for key in docs))
+
+    def test_batch_latency(self):
+        client = self.client()
+        worker = stub_worker(KVWorker, client, multi_ops=True)
+        for _ in range(10):
+            worker.do_batch()
+
+        self.assertEqual(10, client.read_multi.call_count)
+        self.assertEqual(10, client.update_multi.call_count)
+        self.assertEqual(10, client.delete_multi.call_count)
+
+        latencies = defaultdict(list)
+        for operation, _, latency in worker.reservoir.values:
+            latencies[operation].append(latency)
+        self.assertEqual([self.LATENCY] * 10, latencies['get_batch'])
+        self.assertEqual([self.LATENCY] * 10, latencies['set_batch'])
+        self.assertEqual([self.LATENCY / 50] * 500, latencies['get'])
+        expected = [self.LATENCY / len(call[0][1]) for call in client.update_multi.call_args_list
+                    for _ in call[0][1]]
+        self.assertEqual(expected, latencies['set'])
+        self.assertEqual({'get', 'set', 'get_batch', 'set_batch'}, set(latencies))
+
 
 class QueryTest(TestCase):
 
@@ -649,8 +1136,8 @@ class QueryTest(TestCase):
 class BigFunTest(TestCase):
 
     def test_unique_statements(self):
-        QUERIES = 'perfrunner/workloads/bigfun/queries_with_index.json'
-        for query in new_queries(QUERIES):
+        queries = 'perfrunner/workloads/bigfun/queries_with_index.json'
+        for query in new_queries(queries):
             statements = set()
             for i in range(10):
                 self.assertNotIn(query.statement, statements)
@@ -662,7 +1149,7 @@ class PipelineTest(TestCase):
     def test_stages(self):
         stages = {'Analytics', 'Eventing', 'FTS', 'GSI', 'GSI-DGM', 'KV', 'KV-DGM',
                   'N1QL', 'Rebalance', 'Rebalance-Large-Scale', 'Tools',
-                  'Views', 'XDCR', 'YCSB','N1QL-Windows', 'N1QL-Arke',
+                  'Views', 'XDCR', 'YCSB', 'N1QL-Windows', 'N1QL-Arke',
                   'KV-Windows', 'XDCR-Windows', 'KV-Athena', 'KV-Hercules'}
         for pipeline in ('tests/pipelines/weekly-watson.json',
                          'tests/pipelines/weekly-spock.json',
@@ -671,3 +1158,1102 @@ class PipelineTest(TestCase):
             with open(pipeline) as fh:
                 test_cases = json.load(fh)
                 self.assertEqual(stages, set(test_cases), pipeline)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+def reply(request: BaseHTTPRequestHandler, body=None, status: int = 200,
+          headers: dict = None):
+    """Send the JSON-encoded body, if any, from a fake REST server."""
+    data = b'' if body is None else json.dumps(body).encode()
+    request.send_response(status)
+    if body is not None:
+        request.send_header('Content-Type', 'application/json')
+    for name, value in (headers or {}).items():
+        request.send_header(name, value)
+    request.send_header('Content-Length', str(len(data)))
+    request.end_headers()
+    request.wfile.write(data)
+
+
+def read_body(request: BaseHTTPRequestHandler) -> bytes:
+    return request.rfile.read(int(request.headers['Content-Length']))
+
+
+@contextmanager
+def fake_rest_server(do_get: Callable = None, do_post: Callable = None,
+                     threading: bool = False) -> Iterator[HTTPServer]:
+    """Serve the GET and POST requests with the given callbacks on a local port."""
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):  # noqa: N802
+            do_get(self)
+
+        def do_POST(self):  # noqa: N802
+            do_post(self)
+
+        def log_message(self, *args):
+            pass
+
+    server_class = ThreadingHTTPServer if threading else HTTPServer
+    server = server_class(('127.0.0.1', 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def stub_settings(**options):
+    """Build the collector settings of a single-node test cluster."""
+    fields = OrderedDict([
+        ('cloud', {'enabled': False}), ('interval', 0.2), ('cluster', 'cluster'),
+        ('master_node', '127.0.0.1'), ('rest_username', 'user'),
+        ('rest_password', 'password'), ('buckets', None), ('indexes', {}),
+        ('collections', None), ('hostnames', None), ('workers', []),
+        ('cbmonitor_host', '127.0.0.1'),
+    ])
+    fields.update(options)
+    return namedtuple('Settings', fields)(**fields)
+
+
+def stub_collector(server: HTTPServer, base: type = Collector) -> type:
+    """Return a collector class that sends its REST requests to the fake server."""
+    server_port = server.server_port
+
+    class StubCollector(base):
+
+        COLLECTOR = 'stub'
+
+        def _get_http(self, path, server=None, port=8091, json=True):
+            return super()._get_http(path, server, server_port, json)
+
+        def _request(self, path, server, port, headers):
+            return super()._request(path, server, server_port, headers)
+
+        async def _request_async(self, path, server, port, headers):
+            return await super()._request_async(path, server, server_port, headers)
+
+        async def _get_http_async(self, path, server=None, port=8091, json=True):
+            return await super()._get_http_async(path, server, server_port, json)
+
+    return StubCollector
+
+
+class StoreTest(TestCase):
+
+    def test_buffered_store(self):
+        requests = []
+
+        def do_post(request):
+            requests.append((request.path, json.loads(read_body(request))))
+            reply(request)
+
+        with fake_rest_server(do_post=do_post) as server:
+            store = BufferedPerfStore('127.0.0.1')
+            store.base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+            store.MAX_BATCH = 10
+
+            for i in range(25):
+                store.append({'latency_get': i}, cluster='c', bucket='b',
+                             collector='latency', timestamp=i)
+            store.append({'latency_set': 0}, cluster='c', bucket='b',
+                         collector='other', timestamp=0)
+            with store.lock:  # SIGTERM while add() holds the lock
+                store.flush()
+
+        self.assertEqual(4, len(requests))
+        batches = [batch for path, batch in requests if path == '/latencycb']
+        self.assertEqual([5, 10, 10], sorted(len(batch) for batch in batches))
+        samples = sorted((s['ts'], s['data']['latency_get'])
+                         for batch in batches for s in batch)
+        self.assertEqual([(i, i) for i in range(25)], samples)
+
+    def test_latency_bulk_posts(self):
+        requests = []
+
+        def do_get(request):
+            reply(request, {'nodes': [{'hostname': '127.0.0.1:8091'}]})
+
+        def do_post(request):
+            requests.append((request.path, json.loads(read_body(request))))
+            reply(request, {})
+
+        res = reservoir.Reservoir()
+        for i in range(2500):
+            res.update(operation='get', value=0.001 * (i + 1))
+        for i in range(10):
+            res.update(operation='set', value=0.002)
+
+        with fake_rest_server(do_get, do_post) as server, \
+                tempfile.TemporaryDirectory() as tmp:
+            res.dump(filename=os.path.join(tmp, 'kv-worker-0'))
+            self.post_latency_results(server, tmp, stub_settings(buffered_store=True))
+
+        self.assertEqual({'/stubclusterbucket-1'}, {path for path, _ in requests})
+        self.assertEqual([10, 500, 1000, 1000], sorted(len(batch) for _, batch in requests))
+        samples = sorted((metric, round(value, 3))
+                         for _, batch in requests for sample in batch
+                         for metric, value in sample['data'].items())
+        self.assertEqual([('latency_get', i + 1) for i in range(2500)] +
+                         [('latency_set', 2)] * 10, samples)
+
+    def test_latency_sample_posts(self):
+        requests = []
+
+        def do_get(request):
+            reply(request, {'nodes': [{'hostname': '127.0.0.1:8091'}]})
+
+        def do_post(request):
+            requests.append((request.path, json.loads(read_body(request))))
+            reply(request, {})
+
+        res = reservoir.Reservoir()
+        for i in range(5):
+            res.update(operation='get', value=0.001 * (i + 1))
+
+        with fake_rest_server(do_get, do_post) as server, \
+                tempfile.TemporaryDirectory() as tmp:
+            res.dump(filename=os.path.join(tmp, 'kv-worker-0'))
+            self.post_latency_results(server, tmp, stub_settings())
+
+        self.assertEqual({'/stubclusterbucket-1'}, {path.split('?')[0] for path, _ in requests})
+        self.assertEqual([('latency_get', i + 1) for i in range(5)],
+                         sorted((metric, round(value, 3)) for _, data in requests
+                                for metric, value in data.items()))
+
+    @staticmethod
+    def post_latency_results(server: HTTPServer, root: str, settings):
+        collector = stub_collector(server, base=KVLatency)(settings)
+        collector.PATTERN = os.path.join(root, '*-worker-*')
+        collector.store.base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(collector.post_results('bucket-1'))
+        finally:
+            loop.close()
+            asyncio.set_event_loop(asyncio.new_event_loop())
+
+    def test_series_cache(self):
+        with tempfile.TemporaryDirectory() as root:
+            cache = SeriesCache(root)
+            store = PerfStore('127.0.0.1', cache)
+
+            values = np.random.RandomState(0).exponential(size=(2, 1000))
+            for bucket, series in zip(('bucket-1', 'bucket-2'), values):
+                db = store.build_dbname(cluster='c', bucket=bucket,
+                                        collector='latency')
+                for ts in reversed(range(len(series))):  # Out of order
+                    cache.append(db, {'latency_get': series[ts],
+                                      'latency/set': 1,
+                                      'state': 'running'}, timestamp=ts)
+
+            dbs = ['latencycbucket-1', 'latencycbucket-2']
+            np.testing.assert_array_equal(values[0],
+                                          store.get_array(dbs[0], 'latency_get'))
+            self.assertEqual(1000, len(store.get_array(dbs[1], 'latency/set')))
+            self.assertIsNone(cache.load(dbs[0], 'state'))
+
+            qs = [50, 90, 99, 99.9]
+            self.assertEqual(np.percentile(values, qs).tolist(),
+                             store.get_percentiles(dbs, 'latency_get', qs))
+            self.assertIs(store.get_array(dbs[0], 'latency_get'),
+                          store.get_array(dbs[0], 'latency_get'))
+
+    def test_change_filter(self):
+        changes = ChangeFilter(min_interval=1, max_interval=10)
+        changes.set_intervals('disk', {'size': (5, 30)})
+
+        def sample(t, data, collector='ns_server'):
+            return changes.filter('db', data, 'c', collector, t)
+
+        self.assertEqual([(0, {'ops': 100, 'items': 7})],
+                         sample(0, {'ops': 100, 'items': 7}))
+        self.assertEqual([], sample(2, {'ops': 100, 'items': 7}))
+        self.assertEqual([], sample(4, {'ops': 100, 'items': 7}))
+        self.assertIsNone(changes.pop_interval('c', 'ns_server'))
+
+        # The end of the run and the new value
+        self.assertEqual([(4000, {'ops': 100}), (6000, {'ops': 200})],
+                         sample(6, {'ops': 200, 'items': 7}))
+        self.assertEqual(1, changes.pop_interval('c', 'ns_server'))
+        self.assertIsNone(changes.pop_interval('c', 'ns_server'))
+
+        # Unchanged values are written again after max_interval
+        self.assertEqual([(10000, {'items': 7})], sample(10, {'ops': 200, 'items': 7}))
+        self.assertEqual([(10000, {'ops': 200}), (11000, {'ops': 201})],
+                         sample(11, {'ops': 201, 'items': 7}))
+        self.assertIsNone(changes.pop_interval('c', 'ns_server'))  # Within threshold
+
+        self.assertEqual([(0, {'size': 1})], sample(0, {'size': 1}, 'disk'))
+        self.assertEqual([], sample(20, {'size': 1}, 'disk'))
+        self.assertEqual([(20000, {'size': 1}), (25000, {'size': 2})],
+                         sample(25, {'size': 2}, 'disk'))
+        self.assertEqual(5, changes.pop_interval('c', 'disk'))
+        self.assertEqual((10, 8), (changes.written, changes.suppressed))
+
+    def test_time_weighted_kpis(self):
+        rng = np.random.RandomState(1)
+        # Plateaus with rare changes, sampled every 5 seconds for an hour
+        values = np.repeat(rng.randint(1000, 2000, size=24), 30).astype(np.float64)
+        values = np.append(values, 0)  # The last change also writes the end of the run
+        changes = ChangeFilter(min_interval=5, max_interval=60)
+
+        with tempfile.TemporaryDirectory() as root:
+            cache = SeriesCache(root)
+            store = PerfStore('127.0.0.1', cache)
+            for i, value in enumerate(values):
+                for ts, data in changes.filter('db', {'ops': value}, 'c', 'ns_server', 5 * i):
+                    cache.append('db', data, timestamp=ts)
+
+            self.assertLess(len(store.get_array('db', 'ops')), len(values) / 4)
+            weighted = store.get_weighted_array('db', 'ops')
+            self.assertEqual(len(values), len(weighted))
+            self.assertEqual(np.mean(values), np.mean(weighted))
+            self.assertEqual(np.percentile(values, [10, 90]).tolist(),
+                             store.get_percentiles(['db'], 'ops', [10, 90], weighted=True))
+
+        # Regular series are not changed
+        timestamps = np.arange(100) * 5000 + rng.randint(-250, 250, size=100)
+        np.testing.assert_array_equal(values[:100], time_weighted(timestamps, values[:100]))
+
+
+class SketchTest(TestCase):
+
+    QS = 0, 1, 10, 50, 80, 90, 95, 99, 99.9, 99.99, 100
+
+    def assert_accurate(self, sketch: QuantileSketch, values: np.ndarray):
+        for q, estimate in zip(self.QS, sketch.percentiles(self.QS)):
+            exact = np.percentile(values, q, interpolation='lower')
+            self.assertLessEqual(abs(estimate - exact),
+                                 sketch.alpha * exact * (1 + 1e-9), q)
+
+    def test_relative_accuracy(self):
+        rng = np.random.RandomState(0)
+        for values in (rng.exponential(scale=2, size=10 ** 5),
+                       rng.lognormal(mean=0, sigma=3, size=10 ** 5),
+                       np.concatenate([np.zeros(100), rng.pareto(1, 10 ** 4)])):
+            sketch = QuantileSketch()
+            sketch.update(values)
+            self.assertEqual(len(values), sketch.count)
+            self.assert_accurate(sketch, values)
+
+    def test_merge(self):
+        rng = np.random.RandomState(1)
+        workers = [rng.lognormal(mean=i, size=1000) for i in range(4)]
+
+        merged = QuantileSketch()
+        for values in workers:
+            sketch = QuantileSketch()
+            for value in values:
+                sketch.add(value)
+            merged.merge(sketch)
+
+        single = QuantileSketch()
+        single.update(np.concatenate(workers))
+        self.assertEqual(single.bins, merged.bins)
+        self.assert_accurate(merged, np.concatenate(workers))
+
+        with self.assertRaises(ValueError):
+            merged.merge(QuantileSketch(alpha=0.05))
+
+    def test_sketch_store(self):
+        rng = np.random.RandomState(2)
+        values = {'bucket-1': rng.exponential(size=500),
+                  'bucket-2': rng.exponential(size=700)}
+        with tempfile.TemporaryDirectory() as root:
+            store = SketchStore(root)
+            for db, series in values.items():
+                for value in series:
+                    store.update(db, {'latency_get': value})
+            store.dump()
+
+            merged = SketchStore(root).merged(['bucket-1', 'bucket-2', 'bucket-3'],
+                                              'latency_get')
+            self.assertEqual(1200, merged.count)
+            self.assert_accurate(merged, np.concatenate(list(values.values())))
+            self.assertIsNone(SketchStore(root).merged(['bucket-1'], 'latency_set'))
+
+            store = SketchStore(root)  # A new run overwrites the stale sketches
+            store.extend('bucket-1', 'latency_get', values['bucket-1'][:10])
+            store.dump()
+            self.assertEqual(10, SketchStore(root).merged(['bucket-1'], 'latency_get').count)
+
+
+class StatsAgentTest(TestCase):
+
+    def test_channel_updates(self):
+        channel = AgentChannel('localhost', None, None, command='', interval=1)
+        channel.update('{"t":1.0,"d":{"a":1,"b":2}}')
+        channel.update('{"t":2.0,"d":{"a":3}}')
+        self.assertEqual({'a': 3, 'b': 2}, channel.get_samples())
+        channel.update('{"t":3.0,"d":{},"r":["b"]}')
+        self.assertEqual({'a': 3}, channel.get_samples())
+
+        channel.last_update -= channel.MAX_AGE + 1
+        self.assertEqual({}, channel.get_samples())
+
+    def test_localhost_agent(self):
+        agent = StatsAgent(hosts=['localhost'], workers=['127.0.0.1'],
+                           user=None, password=None, interval=0.2,
+                           server_probes={'processes': ['python', 'no-such-process'],
+                                          'meminfo': True,
+                                          'vmstat': True},
+                           client_probes={'processes': ['python']})
+        try:
+            samples = {}
+            for _ in range(50):
+                samples = agent.get_server_samples()['localhost']
+                if 'python_cpu' in samples:
+                    break
+                time.sleep(0.1)
+            client_samples = agent.get_client_samples()
+        finally:
+            agent.stop()
+
+        self.assertGreater(samples['python_rss'], 0)
+        self.assertGreater(samples['python_vsize'], 0)
+        self.assertGreaterEqual(samples['python_cpu'], 0)
+        self.assertGreater(samples['MemTotal'], 0)
+        self.assertIn('allocstall', samples)
+        self.assertFalse([m for m in samples if m.startswith('no-such-process')])
+        self.assertEqual(['127.0.0.1'], list(client_samples))
+
+
+class SchedulerTest(TestCase):
+
+    def test_overrunning_sample(self):
+        samples = []
+
+        class SlowCollector(Collector):
+
+            def sample(self):
+                samples.append(time.time())
+                time.sleep(0.3)
+
+        collector = SlowCollector.__new__(SlowCollector)
+        collector.pending_sample = None
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            with self.assertRaises(asyncio.TimeoutError):
+                loop.run_until_complete(asyncio.wait_for(collector.sample_async(), 0.1))
+            with self.assertLogs(level='WARNING'):
+                loop.run_until_complete(collector.sample_async())
+            self.assertEqual(1, len(samples))
+
+            loop.run_until_complete(asyncio.sleep(0.3))
+            loop.run_until_complete(collector.sample_async())
+            self.assertEqual(2, len(samples))
+        finally:
+            loop.close()
+            asyncio.set_event_loop(asyncio.new_event_loop())
+
+    def test_shared_runtime(self):
+        requests = defaultdict(int)
+
+        def do_get(request):
+            requests[request.path] += 1
+            if request.path == '/pools/default':
+                reply(request, {'nodes': [{'hostname': '127.0.0.1:8091'}]})
+            else:
+                reply(request, [{'name': 'bucket-1', 'stats': {}}])
+
+        with fake_rest_server(do_get) as server:
+
+            class BucketCollector(stub_collector(server)):
+
+                def sample(self):
+                    self.buckets_seen = list(self.get_buckets())
+
+            class SlowCollector(stub_collector(server)):
+
+                def sample(self):
+                    time.sleep(0.5)
+
+            settings = stub_settings()
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                collectors = [BucketCollector(settings), BucketCollector(settings),
+                              SlowCollector(settings)]
+                requests.clear()
+
+                scheduler = CollectorScheduler(collectors)
+                with self.assertRaises(asyncio.TimeoutError):
+                    loop.run_until_complete(asyncio.wait_for(scheduler.schedule(), 1.1))
+                loop.run_until_complete(asyncio.gather(*scheduler.tasks.values()))
+            finally:
+                loop.close()
+                asyncio.set_event_loop(asyncio.new_event_loop())
+
+        for collector in collectors[:2]:
+            self.assertEqual(['bucket-1'], collector.buckets_seen)
+        ticks = scheduler.stats[0].samples
+        self.assertGreaterEqual(ticks, 5)
+        self.assertLessEqual(requests['/pools/default/buckets'], ticks)
+        self.assertGreater(scheduler.stats[2].overruns, 0)
+        self.assertLess(scheduler.stats[0].max_lag, 0.1)
+
+
+class XdcrLagTest(TestCase):
+
+    def test_vbucket(self):
+        # Reference mapping of libcouchbase (cbc hash) for 1024 vBuckets
+        for key, vb in ('foo', 115), ('hello', 528), ('key0', 859), ('a', 183):
+            self.assertEqual(vb, vbucket(key, 1024))
+        self.assertEqual(115 % 64, vbucket('foo', 64))
+
+    def test_gen_key(self):
+        np.random.seed(0)
+        collector = XdcrLag.__new__(XdcrLag)
+        for num_vbuckets in 64, 1024:
+            group_size = num_vbuckets // XdcrLag.PROBES
+            for group in range(XdcrLag.PROBES):
+                for _ in range(10):
+                    key = collector.gen_key(group, num_vbuckets)
+                    self.assertTrue(key.string.startswith('xdcr'))
+                    self.assertEqual(group, vbucket(key.string, num_vbuckets) // group_size)
+
+
+class FakePool:
+
+    def __init__(self):
+        self.clients = 0
+
+    def get_client(self):
+        self.clients += 1
+        return object()
+
+    def release_client(self, client):
+        self.clients -= 1
+
+
+class ObserveLatencyTest(TestCase):
+
+    @staticmethod
+    def stub_observer(measure: Callable, rate: float, probes: int,
+                      buckets: int) -> ObserveIndexLatency:
+        observer = ObserveIndexLatency.__new__(ObserveIndexLatency)
+        observer.probe_rate = rate
+        observer.probes = probes
+        observer.skipped = 0
+        observer.pools = [('bucket-{}'.format(i + 1), FakePool())
+                          for i in range(buckets)]
+        observer.cluster = 'cluster'
+        observer.store = mock.Mock(**{
+            'build_dbname.side_effect': lambda cluster, server, bucket, index, collector: bucket,
+        })
+        observer.sketches = SketchStore()
+        observer._measure_lags = measure
+        return observer
+
+    @staticmethod
+    def run_observer(observer: ObserveIndexLatency, duration: float):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=observer.probes))
+        try:
+            loop.run_until_complete(asyncio.wait_for(observer.run(), duration))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            loop.run_until_complete(asyncio.sleep(0.2))  # Running probes
+            loop.close()
+            asyncio.set_event_loop(asyncio.new_event_loop())
+
+    def test_schedule(self):
+        starts = []
+
+        def measure(client):
+            starts.append(time.time())
+            return {'latency_observe': 1}
+
+        observer = self.stub_observer(measure, rate=40, probes=10, buckets=2)
+        self.run_observer(observer, duration=0.5)
+
+        # The rate is shared by all buckets, which take turns
+        self.assertEqual(0, observer.skipped)
+        self.assertTrue(18 <= len(starts) <= 22)
+        buckets = [call[1]['bucket'] for call in observer.store.append.call_args_list]
+        self.assertEqual(['bucket-1', 'bucket-2'] * (len(buckets) // 2),
+                         buckets[:len(buckets) // 2 * 2])
+        gaps = np.diff(starts)
+        self.assertTrue(0.015 < np.median(gaps) < 0.035)
+
+        # Every probe is recorded in a sketch, whatever the sketches option
+        sketch = observer.sketches.merged(['bucket-1', 'bucket-2'], 'latency_observe')
+        self.assertEqual(len(buckets), sketch.count)
+
+    def test_skipped_ticks(self):
+        def measure(client):
+            time.sleep(0.12)
+            return {'latency_observe': 120}
+
+        observer = self.stub_observer(measure, rate=20, probes=1, buckets=1)
+        self.run_observer(observer, duration=0.5)
+
+        probes = observer.store.append.call_count
+        self.assertTrue(9 <= probes + observer.skipped <= 11)
+        self.assertTrue(3 <= probes <= 4)
+
+    def test_client_release(self):
+        def measure(client):
+            raise Exception('timeout')
+
+        observer = self.stub_observer(measure, rate=20, probes=2, buckets=2)
+        with self.assertLogs(level='WARNING') as logs:
+            self.run_observer(observer, duration=0.2)
+
+        self.assertIn('timeout', logs.output[0])
+        for _, pool in observer.pools:
+            self.assertEqual(0, pool.clients)
+
+
+class ResponseCacheTest(TestCase):
+
+    def test_parse_tail(self):
+        text = '{"op": {"lastTStamp": 3, "samples": {"ops": [1, 2.5, -3e2], ' \
+               '"cmd_get": [null, 4], "timestamp": [1000, 2000, 3000]}}, ' \
+               '"hostnames": ["a", "b"], "empty": []}'
+        self.assertEqual({'op': {'lastTStamp': 3,
+                                 'samples': {'ops': [-300.0],
+                                             'cmd_get': [4],
+                                             'timestamp': [3000]}},
+                          'hostnames': ['a', 'b'], 'empty': []},
+                         parse_tail(text))
+
+        cache = ResponseCache()
+        for path in '/pools/default/buckets/bucket-1/stats', \
+                '/pools/default/overviewStats', \
+                '/_uistats?bucket=bucket-1&zoom=minute':
+            self.assertIs(parse_tail, cache.match(path).parser)
+        self.assertIsNot(parse_tail, cache.match('/pools/default/buckets').parser)
+        self.assertIsNone(cache.match('/pools/default/tasks'))
+
+    def test_conditional_requests(self):
+        uri = '/pools/default/buckets/bucket-1/stats'
+        stats = {'op': {'lastTStamp': 2, 'samples': {'ops': [1, 2]}}}
+        requests = defaultdict(int)
+
+        def do_get(request):
+            requests[request.path] += 1
+            if request.headers.get('If-None-Match') == '"v1"':
+                reply(request, status=304)
+            elif request.path == '/pools/default':
+                reply(request, {'nodes': [{'hostname': '127.0.0.1:8091'}]},
+                      headers={'ETag': '"v1"'})
+            else:
+                reply(request, stats, headers={'ETag': '"v1"'})
+
+        async def get_concurrently():
+            async with aiohttp.ClientSession() as collector.async_session:
+                collector.semaphore = asyncio.Semaphore(2)
+                return await asyncio.gather(collector.get_http_async(uri),
+                                            collector.get_http_async(uri))
+
+        with fake_rest_server(do_get) as server:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                collector = stub_collector(server)(stub_settings())
+                cache = collector.responses = ResponseCache(
+                    rules=(Rule(re.compile(r'/pools/default/buckets/'), 0.1, parse_tail),)
+                )
+                tail = {'op': {'lastTStamp': 2, 'samples': {'ops': [2]}}}
+
+                self.assertEqual(tail, collector.get_http(uri))
+                self.assertEqual(tail, collector.get_http(uri))
+                self.assertEqual((1, 1, 0),
+                                 (cache.hits, cache.misses, cache.not_modified))
+
+                time.sleep(0.1)
+                self.assertEqual(tail, collector.get_http(uri))
+                self.assertEqual((1, 2, 1),
+                                 (cache.hits, cache.misses, cache.not_modified))
+
+                time.sleep(0.1)
+                self.assertEqual([tail, tail],
+                                 loop.run_until_complete(get_concurrently()))
+                self.assertEqual((2, 3, 2),
+                                 (cache.hits, cache.misses, cache.not_modified))
+            finally:
+                loop.close()
+                asyncio.set_event_loop(asyncio.new_event_loop())
+
+        self.assertEqual(3, requests[uri])
+
+
+class MetadataTest(TestCase):
+
+    def test_bulk_registration(self):
+        requests = []
+        bulk_api = [True]
+
+        def do_get(request):
+            reply(request, {'nodes': [{'hostname': '127.0.0.1:8091'}]})
+
+        def do_post(request):
+            requests.append((request.path, parse_qs(read_body(request).decode())))
+            if request.path == '/cbmonitor/add_metrics/' and not bulk_api[0]:
+                reply(request, status=404)
+            else:
+                reply(request)
+
+        with fake_rest_server(do_get, do_post) as server, \
+                tempfile.TemporaryDirectory() as root:
+            settings = stub_settings(
+                interval=1, cbmonitor_host='127.0.0.1:{}'.format(server.server_port))
+
+            collector = stub_collector(server)(settings)
+            collector.mc.ROOT = root
+            collector.update_metric_metadata(['a', 'b/c'], bucket='bucket-1')
+            collector.update_metric_metadata(['a', 'd'], bucket='bucket-1')
+            collector.metadata_queue.join()
+
+            mc = MetadataClient(settings)
+            mc.ROOT = root
+            mc.add_metrics(['a', 'b_c', 'd'], bucket='bucket-1', collector='stub')
+            bulk_api[0] = False
+            mc.add_metrics(['a', 'e'], server='127.0.0.1', collector='stub')
+            mc.add_metrics(['a', 'e'], server='127.0.0.1', collector='stub')
+
+        self.assertEqual(['/cbmonitor/add_metrics/'] * 3 +
+                         ['/cbmonitor/add_metric/'] * 2,
+                         [path for path, _ in requests])
+        self.assertEqual([{'name': 'a', 'bucket': 'bucket-1', 'collector': 'stub'},
+                          {'name': 'b_c', 'bucket': 'bucket-1', 'collector': 'stub'}],
+                         json.loads(requests[0][1]['metrics'][0]))
+        self.assertEqual([{'name': 'd', 'bucket': 'bucket-1', 'collector': 'stub'}],
+                         json.loads(requests[1][1]['metrics'][0]))
+        self.assertEqual({'name': ['e'], 'cluster': ['cluster'],
+                          'server': ['127.0.0.1'], 'collector': ['stub']},
+                         requests[4][1])
+
+    def test_failed_registration(self):
+        def do_get(request):
+            reply(request, {'nodes': [{'hostname': '127.0.0.1:8091'}]})
+
+        with fake_rest_server(do_get) as server:
+            collector = stub_collector(server)(stub_settings())
+        collector.mc = mock.Mock()
+        collector.mc.add_metrics.side_effect = [Exception('cbmonitor is down'), None]
+
+        with self.assertLogs(level='ERROR'):
+            collector.update_metric_metadata(['a', 'b'], bucket='bucket-1')
+            collector.metadata_queue.join()
+        collector.update_metric_metadata(['a', 'b'], bucket='bucket-1')
+        collector.metadata_queue.join()
+        collector.update_metric_metadata(['a', 'b'], bucket='bucket-1')
+
+        self.assertEqual([mock.call(['a', 'b'], 'bucket-1', None, None, 'stub')] * 2,
+                         collector.mc.add_metrics.call_args_list)
+
+
+class TaskGraphTest(TestCase):
+
+    def test_dependencies(self):
+        events = []
+        barrier = Barrier(2, timeout=5)
+
+        def task(key):
+            events.append(('start', key))
+            if key in ('a1', 'b1'):
+                barrier.wait()  # Independent chains run concurrently
+            events.append(('end', key))
+            return key.upper()
+
+        graph = TaskGraph(max_workers=4)
+        a1 = graph.add('a1', partial(task, 'a1'))
+        a2 = graph.add('a2', partial(task, 'a2'), after=[a1])
+        b1 = graph.add('b1', partial(task, 'b1'))
+        graph.add('c', partial(task, 'c'), after=[a2, b1])
+
+        self.assertEqual({'a1': 'A1', 'a2': 'A2', 'b1': 'B1', 'c': 'C'}, graph.run())
+        for before, after in ('a1', 'a2'), ('a2', 'c'), ('b1', 'c'):
+            self.assertLess(events.index(('end', before)),
+                            events.index(('start', after)))
+
+        self.assertEqual([1, 4, 9], run_concurrently(partial(pow, i, 2) for i in (1, 2, 3)))
+
+    def test_errors(self):
+        graph = TaskGraph()
+        with self.assertRaises(ValueError):
+            graph.add('b', lambda: None, after=['a'])
+
+        started = []
+
+        def fail():
+            raise RuntimeError('failed')
+
+        graph.add('a', fail)
+        graph.add('b', partial(started.append, 'b'), after=['a'])
+        graph.add('c', partial(started.append, 'c'))
+        with self.assertRaises(RuntimeError):
+            graph.run()
+        self.assertNotIn('b', started)
+
+
+class TaskWatcherTest(TestCase):
+
+    @staticmethod
+    def task_watcher(server: HTTPServer) -> TaskWatcher:
+        rest = DefaultRestHelper.__new__(DefaultRestHelper)
+        rest.auth = 'user', 'password'
+        return TaskWatcher(rest, 'http://127.0.0.1:{}'.format(server.server_port),
+                           'rebalance')
+
+    def watch(self, long_polling: bool, duration: float = 1.5) -> tuple:
+        requests = defaultdict(int)
+        start = time.time()
+        completed = Event()
+
+        def progress():
+            return min(100 * (time.time() - start) / duration, 100)
+
+        def do_get(request):
+            path, _, query = request.path.partition('?')
+            requests[path] += 1
+            if path == '/pools/default/tasks':
+                if progress() < 100:
+                    reply(request, [{'type': 'rebalance', 'status': 'running',
+                                     'progress': progress()}])
+                else:
+                    reply(request, [{'type': 'rebalance', 'status': 'notRunning'}])
+            else:
+                params = parse_qs(query)
+                if 'waitChange' in params:
+                    requests['waitChange'] += 1
+                    completed.wait(int(params['waitChange'][0]) / 1000)
+                reply(request, {'etag': str(completed.is_set())} if long_polling else {})
+
+        def complete():
+            time.sleep(duration)
+            completed.set()
+
+        with fake_rest_server(do_get, threading=True) as server:
+            Thread(target=complete, daemon=True).start()
+            watcher = self.task_watcher(server)
+            watcher.MAX_INTERVAL = 0.5
+            is_running = True
+            while is_running:
+                watcher.wait()
+                _, is_running = watcher.poll()
+        return watcher, requests, start + duration
+
+    def test_long_polling(self):
+        watcher, requests, end_time = self.watch(long_polling=True)
+        self.assertTrue(watcher.long_polling)
+        self.assertGreater(requests['waitChange'], 0)
+        self.assertLess(abs(watcher.trace.end_time - end_time), 0.2)
+        self.assertGreater(len(watcher.trace.points), 1)
+        self.assertAlmostEqual(100 / 1.5, watcher.trace.rate(), delta=15)
+
+    def test_adaptive_polling(self):
+        watcher, requests, end_time = self.watch(long_polling=False)
+        self.assertFalse(watcher.long_polling)
+        self.assertEqual(0, requests['waitChange'])
+        self.assertLess(abs(watcher.trace.end_time - end_time), 0.2)
+
+    def test_retry(self):
+        statuses = [503, 200]
+
+        def do_get(request):
+            status = statuses.pop(0)
+            reply(request, [{'type': 'rebalance', 'status': 'notRunning'}], status)
+
+        with fake_rest_server(do_get) as server, \
+                mock.patch('perfrunner.helpers.rest.RETRY_DELAY', 0):
+            tasks, is_running = self.task_watcher(server).poll()
+
+        self.assertEqual([], statuses)
+        self.assertEqual(1, len(tasks))
+        self.assertFalse(is_running)
+
+
+class TimedOutChannelFile:
+
+    def read(self):
+        raise socket.timeout()
+
+
+class LocalSSHClient:
+
+    """Run the commands of an SSH session in a local subprocess."""
+
+    def __init__(self):
+        self.transport = mock.Mock()
+        self.transport.is_active.return_value = True
+
+    def set_missing_host_key_policy(self, policy):
+        pass
+
+    def connect(self, **kwargs):
+        pass
+
+    def get_transport(self):
+        return self.transport
+
+    def exec_command(self, command: str, timeout: float = None):
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, start_new_session=True)
+        try:
+            stdout = io.BytesIO(process.communicate(timeout=timeout)[0])
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.communicate()
+            stdout = TimedOutChannelFile()
+        return None, stdout, None
+
+    def close(self):
+        self.transport.is_active.return_value = False
+
+
+def local_ssh(test: TestCase):
+    for patcher in (mock.patch('paramiko.SSHClient', LocalSSHClient),
+                    mock.patch.dict(env, shell='/bin/bash -c')):  # No login scripts
+        patcher.start()
+        test.addCleanup(patcher.stop)
+
+
+class LogFollowerTest(TestCase):
+
+    LINE = '[ns_server:info,2020-01-01T00:00:0{}.000Z,ns_1@127.0.0.1:<0.1.0>:{}] {}\n'
+
+    def setUp(self):
+        local_ssh(self)
+        self.session = SSHSession('localhost', 'user', 'password')
+
+    def test_incremental_reads(self):
+        with tempfile.NamedTemporaryFile('w') as fh:
+            follower = LogFollower(self.session, path=fh.name)
+            detected = []
+            follower.subscribe('failover_end', detected.append)
+
+            fh.write(self.LINE.format(0, 'ns_rebalancer', 'Starting failing over'))
+            fh.write(self.LINE.format(1, 'ns_memcached', 'Unrelated message'))
+            fh.flush()
+            self.assertEqual(['auto_failover', 'hard_failover_start'],
+                             [event.name for event in follower.poll()])
+            offset = follower.offset
+            self.assertEqual(os.path.getsize(fh.name), offset)
+
+            # Incomplete lines are read once they are complete
+            line = self.LINE.format(2, 'ns_orchestrator', 'Failed over n_1: ok')
+            fh.write(line[:30])
+            fh.flush()
+            self.assertEqual([], follower.poll())
+            self.assertEqual(offset, follower.offset)
+            fh.write(line[30:])
+            fh.flush()
+            self.assertEqual(['failover_end'], [event.name for event in follower.poll()])
+            self.assertEqual('2020-01-01T00:00:02.000Z', detected[0].timestamp)
+
+            self.assertEqual([], follower.poll())
+            self.assertEqual('2020-01-01T00:00:00.000Z', follower.first('auto_failover'))
+            self.assertIsNone(follower.first('graceful_failover_start'))
+
+            # Rotation
+            fh.seek(0)
+            fh.truncate()
+            fh.write(self.LINE.format(3, 'ns_orchestrator', 'Starting vbucket moves'))
+            fh.flush()
+            self.assertEqual(['graceful_failover_start'],
+                             [event.name for event in follower.poll()])
+
+    def test_fallback(self):
+        with tempfile.NamedTemporaryFile('w') as fh, \
+                mock.patch('perfrunner.remote.logs.READ_COMMAND', '{fallback}'):
+            follower = LogFollower(self.session, path=fh.name)
+            self.assertEqual([], follower.poll())
+
+            fh.write(self.LINE.format(0, 'ns_memcached', 'Unrelated message'))
+            fh.write(self.LINE.format(1, 'ns_orchestrator', 'Failed over n_1: ok'))
+            fh.flush()
+            self.assertEqual(['failover_end'], [event.name for event in follower.poll()])
+            self.assertEqual(os.path.getsize(fh.name), follower.offset)
+            self.assertEqual([], follower.poll())
+
+    def test_read_error(self):
+        follower = LogFollower(self.session, path='/nonexistent/info.log')
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual([], follower.poll())
+        self.assertEqual(0, follower.offset)
+
+    def test_concurrent_polls(self):
+        with tempfile.NamedTemporaryFile('w') as fh:
+            follower = LogFollower(self.session, path=fh.name)
+            for i in range(10):
+                fh.write(self.LINE.format(i, 'ns_orchestrator', 'Failed over n_1: ok'))
+            fh.flush()
+
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                polls = list(executor.map(lambda _: follower.poll(), range(4)))
+
+            self.assertEqual([10, 0, 0, 0], sorted(map(len, polls), reverse=True))
+            self.assertEqual(10, len(follower.events['failover_end']))
+
+    def test_windows_follower(self):
+        cluster_spec = mock.Mock(ssh_credentials=['user', 'password'])
+        remote = RemoteWindows(cluster_spec, 'windows')
+        follower = remote.log_follower('127.0.0.1')
+        self.assertIs(follower, remote.log_follower('127.0.0.1'))
+        self.assertEqual(RemoteWindows.INFO_LOG, follower.path)
+
+
+class SSHPoolTest(TestCase):
+
+    def test_reconnect(self):
+        with mock.patch('paramiko.SSHClient') as ssh_client:
+            lost, connected = mock.Mock(), mock.Mock()
+            lost.exec_command.side_effect = paramiko.SSHException('Connection lost')
+            connected.exec_command.return_value = None, io.BytesIO(b'output'), None
+            ssh_client.side_effect = [lost, connected]
+
+            session = SSHSession('host', 'user', 'password')
+            self.assertEqual('output', session.execute('echo output'))
+
+        self.assertEqual(2, ssh_client.call_count)
+        lost.close.assert_called_once_with()
+        connected.connect.assert_called_once_with(hostname='host', username='user',
+                                                  password='password')
+        self.assertIs(connected, session.client)
+
+    def test_timeout(self):
+        with mock.patch('paramiko.SSHClient') as ssh_client:
+            ssh_client.return_value.exec_command.return_value = \
+                None, TimedOutChannelFile(), None
+
+            session = SSHSession('host', 'user', 'password')
+            with self.assertRaises(CommandTimeout):
+                session.run('sleep 5', timeout=0.5)
+
+        ssh_client.return_value.exec_command.assert_called_once_with(mock.ANY, timeout=0.5)
+
+    def test_batches(self):
+        local_ssh(self)
+        session = SSHSession('localhost', 'user', 'password')
+        results = session.run_batch([
+            'echo first; echo second',
+            'printf partial',
+            'echo error >&2; false',
+            'true',
+        ])
+        self.assertEqual(['first\nsecond', 'partial', 'error', ''], results)
+        self.assertEqual([0, 0, 1, 0], [result.return_code for result in results])
+        self.assertTrue(results[2].failed)
+        self.assertEqual('true', results[3].command)
+
+        with self.assertRaises(CommandTimeout):
+            session.run('sleep 5', timeout=0.5)
+
+    def test_remote_stats(self):
+        local_ssh(self)
+
+        class StubStats(RemoteStats):
+
+            @parallel_task(server_side=True)
+            def get_samples(self):
+                t0 = time.time()
+                self.run('sleep 0.5')
+                return self.context.host, float(self.run('echo 1')), time.time() - t0
+
+        stats = StubStats(['localhost', '127.0.0.1'], [], 'user', 'password')
+        t0 = time.time()
+        samples = stats.get_samples()
+        elapsed = time.time() - t0
+        # Hosts are sampled concurrently
+        self.assertLess(elapsed, 0.75 * sum(sample[2] for sample in samples.values()))
+        self.assertEqual({'localhost', '127.0.0.1'}, set(samples))
+        for host, (sample_host, value, _) in samples.items():
+            self.assertEqual(host, sample_host)
+            self.assertEqual(1.0, value)
+
+
+class IndexProvisionerTest(TestCase):
+
+    INDEXES = {
+        'bucket-1': {
+            '_default': {'_default': {'idx1': 'a', 'idx2': 'b,c:b > 1'}},
+            'scope-1': {'collection-1': {'idx1': 'a'}},
+        },
+        'bucket-2': {'scope-1': {'collection-1': {'idx{}'.format(i): 'a' for i in range(5)}}},
+    }
+
+    def test_definitions(self):
+        definitions = index_definitions(self.INDEXES)
+        self.assertEqual(8, len(definitions))
+        self.assertEqual(['b', 'c'], definitions[1].fields)
+        self.assertEqual('b > 1', definitions[1].where)
+        self.assertEqual(['bucket-1', 'bucket-1:scope-1:collection-1'],
+                         [keyspace(d) for d in definitions[1:3]])
+        self.assertEqual(index_definitions({'idx1': 'a'}, 'bucket-1')[:1], definitions[:1])
+
+        groups = build_groups(definitions)
+        self.assertEqual([1, 2, 5], sorted(len(group) for group in groups))
+        for group in groups:
+            self.assertEqual(1, len({keyspace(d) for d in group}))
+
+        self.assertEqual(
+            '-type create -bucket bucket-1 -fields \'`b`,`c`\' -where \'b > 1\' '
+            '-using plasma -index idx2 -with \'{"defer_build":true}\'',
+            RemoteLinux.cbindex_create_options(definitions[1], 'plasma'))
+        self.assertEqual(
+            '-type create -bucket bucket-1 -scope scope-1 -collection collection-1 '
+            '-fields `a` -index idx1 -with {"defer_build":true}',
+            RemoteLinux.cbindex_create_options(definitions[2], 'memory_optimized',
+                                               shell=False))
+
+    def test_resume(self):
+        status = {'status': []}
+        calls = []
+
+        class FakeMonitor:
+
+            def get_index_states(self, host):
+                calls.append('status')
+                return index_states(status)
+
+        class FakeRemote:
+
+            failures = 1
+
+            def create_indexes(self, host, definitions, storage, batch_process):
+                calls.append('create')
+                for bucket, bucket_definitions in definitions.items():
+                    for d in bucket_definitions:
+                        status['status'].append({'bucket': d.bucket, 'scope': d.scope,
+                                                 'collection': d.collection,
+                                                 'name': d.name, 'status': 'Created'})
+                        if self.failures:  # Fail after the first index
+                            self.failures -= 1
+                            raise IndexProvisioningError('failed')
+
+            def build_indexes(self, host, groups):
+                calls.append('build')
+                for bucket, bucket_groups in groups.items():
+                    for group in bucket_groups:
+                        for d in group:
+                            for entry in status['status']:
+                                if entry['name'] == d.name and entry['bucket'] == d.bucket:
+                                    entry['status'] = 'Ready'
+
+        definitions = index_definitions(self.INDEXES)
+        provisioner = IndexProvisioner(FakeRemote(), FakeMonitor(), 'localhost', 'plasma')
+        with mock.patch('perfrunner.helpers.indexes.time.sleep') as sleep:
+            provisioner.create(definitions)
+        sleep.assert_called_once_with(IndexProvisioner.RETRY_DELAY)
+        self.assertEqual(['status', 'create', 'status', 'create'], calls)
+        self.assertEqual(8, len(index_states(status)))
+
+        provisioner.build(definitions)
+        provisioner.build(definitions)
+        self.assertEqual(['status', 'build', 'status'], calls[4:])
+        self.assertEqual({'Ready'}, set(index_states(status).values()))